@@ -1,10 +1,12 @@
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
+from typing import TYPE_CHECKING
 from fastapi import HTTPException
 from starlette.requests import Request
 from starlette.responses import RedirectResponse
 import os
 
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
+
 # OAuth2 configuration
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.send',
@@ -19,6 +21,7 @@ class GoogleAuthManager:
         )
         
     async def get_authorization_url(self) -> str:
+        from google_auth_oauthlib.flow import Flow
         flow = Flow.from_client_secrets_file(
             self.client_secrets_file,
             scopes=SCOPES,
@@ -30,7 +33,8 @@ class GoogleAuthManager:
         )
         return authorization_url, state
     
-    async def process_oauth_callback(self, code: str) -> Credentials:
+    async def process_oauth_callback(self, code: str) -> 'Credentials':
+        from google_auth_oauthlib.flow import Flow
         try:
             flow = Flow.from_client_secrets_file(
                 self.client_secrets_file,
@@ -0,0 +1,79 @@
+"""Bulk personalization run against fakeredis and a local Groq stand-in.
+
+Interrupts the job part-way, resumes it, and checks that no finished row
+was generated twice.
+
+Usage:
+    python -m benchmarks.bench_personalize --rows 2000 --concurrency 32
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import fakeredis
+import pandas as pd
+
+from benchmarks.stubs import FakeGroqServer
+
+
+async def run(args):
+    async with FakeGroqServer(latency=args.latency) as server:
+        os.environ['GROQ_BASE_URL'] = server.url
+        os.environ.setdefault('GROQ_API_KEY', 'stub')
+
+        from utils.llm_utils import LLMService
+        from utils.personalization_utils import PersonalizationPipeline
+        from utils.storage_utils import StorageManager
+
+        redis_client = fakeredis.aioredis.FakeRedis()
+        df = pd.DataFrame({
+            'email': [f"user{i}@example.com" for i in range(args.rows)],
+            'name': [f"Name{i}" for i in range(args.rows)],
+        })
+        storage = StorageManager(redis_client)
+        await storage.store_csv_data(df)
+
+        def make_pipeline():
+            return PersonalizationPipeline(
+                redis_client, LLMService(redis_client), storage,
+                concurrency=args.concurrency,
+                requests_per_minute=args.rpm,
+                tokens_per_minute=args.rpm * 1000,
+                chunk_size=args.chunk_size
+            )
+
+        start = time.perf_counter()
+        pipeline = make_pipeline()
+        job_id = await pipeline.start("Write to {name} at {email}")
+        await asyncio.sleep(args.interrupt_after)
+        pipeline._tasks[job_id].cancel()
+        await asyncio.sleep(0)
+        interrupted = await pipeline.get_progress(job_id)
+
+        resumed = make_pipeline()
+        await resumed.resume_incomplete()
+        await resumed._tasks[job_id]
+        elapsed = time.perf_counter() - start
+        progress = await resumed.get_progress(job_id)
+
+    print(f"interrupted at {interrupted['completed']} rows (checkpoint {interrupted['checkpoint_row']})")
+    print(f"finished: status={progress['status']} completed={progress['completed']} "
+          f"failed={progress['failed']} upstream calls={server.completions}")
+    print(f"throughput: {args.rows / elapsed:.1f} rows/s")
+    assert server.completions <= args.rows + args.concurrency, "finished rows were regenerated"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--rpm', type=int, default=600000)
+    parser.add_argument('--chunk-size', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--interrupt-after', type=float, default=0.5)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
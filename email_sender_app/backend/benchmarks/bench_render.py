@@ -0,0 +1,64 @@
+"""Template rendering benchmark over a synthetic recipient DataFrame.
+
+Compares the old per-row str.replace loop with CompiledTemplate.render_frame.
+
+Usage:
+    python -m benchmarks.bench_render --rows 1000000
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from utils.template_utils import compile_template
+
+TEMPLATE = (
+    "<p>Hi {first_name},</p><p>We noticed {company} in {location} is growing fast. "
+    "Our {product} helps teams like yours ship faster.</p>" + "<p>Lorem ipsum dolor sit amet.</p>" * 20
+)
+
+
+def make_frame(rows: int) -> pd.DataFrame:
+    return pd.DataFrame({
+        'email': [f"user{i}@example.com" for i in range(rows)],
+        'first_name': [f"Name{i}" for i in range(rows)],
+        'company': [f"Company {i % 1000}" for i in range(rows)],
+        'location': ['Pune', 'Berlin', 'Austin', 'Lagos'] * (rows // 4) + ['Pune'] * (rows % 4),
+        'product': 'Mailer',
+        'notes': 'unused column',
+    })
+
+
+def render_loop(df: pd.DataFrame):
+    bodies = []
+    for row in df.to_dict('records'):
+        content = TEMPLATE
+        for key, value in row.items():
+            content = content.replace(f"{{{key}}}", str(value))
+        bodies.append(content)
+    return bodies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--loop-rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    df = make_frame(args.rows)
+
+    start = time.perf_counter()
+    loop_bodies = render_loop(df.head(args.loop_rows))
+    loop_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bodies = compile_template(TEMPLATE).render_frame(df)
+    elapsed = time.perf_counter() - start
+
+    assert bodies[:len(loop_bodies)] == loop_bodies
+    print(f"str.replace loop: {args.loop_rows / loop_elapsed:12.0f} rows/s ({args.loop_rows} rows)")
+    print(f"render_frame:     {args.rows / elapsed:12.0f} rows/s ({args.rows} rows, {elapsed:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
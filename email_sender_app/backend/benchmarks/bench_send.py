@@ -0,0 +1,76 @@
+"""Send-engine benchmark against a local SendGrid stand-in.
+
+Compares the old one-at-a-time send loop with ESPService.send_many and
+the personalization-packed ESPService.send_bulk.
+
+Usage:
+    python -m benchmarks.bench_send --messages 2000 --latency 0.05 --concurrency 200
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.stubs import FakeSendGridServer
+from utils.esp_utils import ESPService
+
+
+def make_messages(count: int):
+    return [
+        {
+            'to_email': f"user{i}@example.com",
+            'subject': 'Hello',
+            'content': f"<p>Hello user {i}</p>",
+            'tracking_id': f"bench-{i}"
+        }
+        for i in range(count)
+    ]
+
+
+async def run(args):
+    messages = make_messages(args.messages)
+    async with FakeSendGridServer(latency=args.latency) as server:
+        serial = ESPService(max_concurrency=1, api_url=server.url)
+        start = time.perf_counter()
+        for message in messages[:args.serial_messages]:
+            await serial.send_email(**message)
+        serial_rate = args.serial_messages / (time.perf_counter() - start)
+        await serial.close()
+
+        concurrent = ESPService(max_concurrency=args.concurrency, api_url=server.url)
+        start = time.perf_counter()
+        results = await concurrent.send_many(messages)
+        elapsed = time.perf_counter() - start
+        await concurrent.close()
+
+        bulk = ESPService(max_concurrency=args.concurrency, api_url=server.url)
+        recipients = [
+            {'to_email': m['to_email'], 'tracking_id': m['tracking_id'], 'row': {'id': i}}
+            for i, m in enumerate(messages)
+        ]
+        requests_before = server.requests
+        start = time.perf_counter()
+        bulk_results = await bulk.send_bulk(recipients, 'Hello', '<p>Hello user {id}</p>')
+        bulk_elapsed = time.perf_counter() - start
+        bulk_requests = server.requests - requests_before
+        await bulk.close()
+
+    failed = sum(1 for result in results if not result['success'])
+    bulk_failed = sum(1 for result in bulk_results if not result['success'])
+    print(f"serial:     {serial_rate:10.1f} sends/s ({args.serial_messages} messages)")
+    print(f"concurrent: {len(messages) / elapsed:10.1f} sends/s ({len(messages)} messages, "
+          f"concurrency={args.concurrency}, failed={failed})")
+    print(f"bulk:       {len(messages) / bulk_elapsed:10.1f} sends/s ({len(messages)} messages, "
+          f"{bulk_requests} requests, failed={bulk_failed})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--serial-messages', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05, help="stand-in response latency (s)")
+    parser.add_argument('--concurrency', type=int, default=200)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""Deterministic behaviour checks against the local provider stand-ins.
+
+Unlike the benchmarks these assert outcomes rather than measure speed:
+each check scripts the stand-in's responses, drives the real client code
+and fails with an AssertionError when the behaviour differs. The process
+exits non-zero when any check fails.
+
+Usage:
+    python -m benchmarks.checks
+    python -m benchmarks.checks --only esp_throttle,sheets_sync
+"""
+import argparse
+import asyncio
+import copy
+import functools
+import os
+import sys
+import time
+import traceback
+from collections import deque
+from typing import Awaitable, Callable, Dict
+
+import fakeredis
+from fakeredis.commands_mixins.generic_mixin import GenericCommandsMixin
+
+from benchmarks.stubs import FakeGroqServer, FakeSendGridServer, FakeSheetsService
+
+# fakeredis' COPY leaves both keys sharing one value, so writes to the copy
+# show through the original. Make it copy the value, as Redis does.
+_fake_copy = GenericCommandsMixin.copy
+
+
+@functools.wraps(_fake_copy)
+def _copy_value(self, key, newkey, *args):
+    copied = _fake_copy(self, key, newkey, *args)
+    if copied:
+        expireat = key.expireat
+        newkey.value = copy.deepcopy(key.value)
+        newkey.expireat = expireat
+    return copied
+
+
+GenericCommandsMixin.copy = _copy_value
+
+Check = Callable[[], Awaitable[None]]
+CHECKS: Dict[str, Check] = {}
+
+
+def check(func: Check) -> Check:
+    CHECKS[func.__name__.replace('check_', '')] = func
+    return func
+
+
+class ScriptedSendGrid(FakeSendGridServer):
+    """SendGrid stand-in that answers the given (status, headers) faults first, in order"""
+
+    def __init__(self, *faults, **kwargs):
+        super().__init__(**kwargs)
+        self.faults = deque(faults)
+
+    def inject_fault(self):
+        if not self.faults:
+            return None
+        status, headers = self.faults.popleft()
+        return status, headers, self.error_body('scripted fault')
+
+
+def messages(count: int):
+    return [
+        {'to_email': f"user{i}@example.com", 'subject': 'Hello', 'content': 'Hi', 'tracking_id': f"t{i}"}
+        for i in range(count)
+    ]
+
+
+@check
+async def check_esp_throttle():
+    """A round of 429s with Retry-After halves the limit once and pauses every send"""
+    from utils.concurrency_utils import AdaptiveConcurrency
+    from utils.esp_utils import ESPService
+    throttled = (429, {'Retry-After': '1'})
+    async with ScriptedSendGrid(*[throttled] * 8) as server:
+        esp = ESPService(max_concurrency=16, api_url=server.url)
+        esp.concurrency = AdaptiveConcurrency(initial=8, maximum=16)
+        try:
+            results = await esp.send_many(messages(8))
+            assert all(r['retryable'] and r['retry_after'] == 1.0 for r in results), results
+            assert esp.concurrency.limit == 4, f"limit {esp.concurrency.limit}, expected one halving to 4"
+            assert not esp.concurrency.slow_start
+
+            started = time.monotonic()
+            pause = esp.concurrency.paused_until - started
+            assert pause > 0.5, f"paused for {pause:.2f}s only"
+            [result] = await esp.send_many(messages(1))
+            assert result['success'], result
+            assert time.monotonic() - started >= pause, "sent before the Retry-After elapsed"
+            assert server.requests == 9
+        finally:
+            await esp.close()
+
+
+@check
+async def check_esp_breaker():
+    """Consecutive failures open the breaker; after the reset timeout one probe closes it.
+
+    Rate-limit permits are only spent on requests the breaker admits.
+    """
+    from utils.concurrency_utils import CircuitBreaker
+    from utils.esp_utils import ESPService
+    permits = []
+
+    async def throttle(count: int):
+        permits.append(count)
+
+    async with ScriptedSendGrid(*[(500, {})] * 3, latency=0.05) as server:
+        esp = ESPService(max_concurrency=16, api_url=server.url)
+        esp.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.5)
+        try:
+            for message in messages(3):
+                result = (await esp.send_many([message], throttle=throttle))[0]
+                assert not result['success'] and result['retryable'], result
+            assert esp.breaker.state == CircuitBreaker.OPEN
+            assert len(permits) == 3
+
+            refused = await esp.send_many(messages(5), throttle=throttle)
+            assert all(r['error'] == 'ESP circuit open' for r in refused), refused
+            assert server.requests == 3, "requests reached SendGrid while the breaker was open"
+            assert len(permits) == 3, "permits spent while the breaker was open"
+
+            await asyncio.sleep(esp.breaker.retry_in())
+            results = await esp.send_many(messages(5), throttle=throttle)
+            assert server.requests == 4, f"{server.requests - 3} probes sent, expected 1"
+            assert len(permits) == 4, f"{len(permits) - 3} permits spent while half-open, expected 1"
+            assert sum(r['success'] for r in results) == 1, results
+            assert esp.breaker.state == CircuitBreaker.CLOSED
+
+            assert all(r['success'] for r in await esp.send_many(messages(5), throttle=throttle))
+            assert len(permits) == 9
+        finally:
+            await esp.close()
+
+
+@check
+async def check_esp_rejected_personalizations():
+    """A 400 naming invalid personalizations fails only those recipients; the rest are resent"""
+    from utils.esp_utils import ESPService
+    os.environ.setdefault('SENDER_EMAIL', 'sender@example.com')
+    recipients = [
+        {'to_email': f"user{i}@example.com" if i not in (1, 3) else f"invalid{i}", 'tracking_id': f"t{i}", 'row': {}}
+        for i in range(5)
+    ]
+    async with FakeSendGridServer(record=True) as server:
+        esp = ESPService(api_url=server.url)
+        try:
+            results = await esp.send_bulk(recipients, 'Hello', 'Hi')
+            assert [r['success'] for r in results] == [True, False, True, False, True], results
+            assert not results[1]['retryable'] and not results[3]['retryable']
+            assert 'valid address' in results[1]['error'], results[1]
+            assert server.requests == 2 and server.messages == 3
+            assert [t for _, t in server.accepted] == ['t0', 't2', 't4']
+        finally:
+            await esp.close()
+
+
+@check
+async def check_llm_cancelled_leader():
+    """Requests coalesced onto a cancelled one are released and make the call themselves"""
+    async with FakeGroqServer(latency=0.2) as groq_server:
+        os.environ['GROQ_BASE_URL'] = groq_server.url
+        os.environ.setdefault('GROQ_API_KEY', 'stub')
+        from utils.llm_utils import LLMService
+        service = LLMService(fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer()))
+        messages = [{'role': 'user', 'content': 'Write to customer 1'}]
+        leader = asyncio.create_task(service.generate(messages))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(service.generate(messages))
+        await asyncio.sleep(0.05)
+        assert service.stats['coalesced'] == 1, service.stats
+        leader.cancel()
+        content = await asyncio.wait_for(follower, timeout=5)
+        assert content == 'Generated email for: Write to customer 1', content
+        assert leader.cancelled() and not service._inflight
+
+
+@check
+async def check_template_braces():
+    """CSS and script braces are literal text; only {field} names are placeholders"""
+    from utils.scheduler_utils import EmailScheduler
+    from utils.storage_utils import StorageManager
+    from utils.template_utils import TemplateError, compile_template
+    template = (
+        "<html><head><style>body { margin: 0 } p{color:red}</style></head>"
+        "<body><p>Hi {first_name} at {Company Name}</p><script>function f(){return x}</script></body></html>"
+    )
+    compiled = compile_template(template)
+    assert compiled.placeholders == ['first_name', 'Company Name'], compiled.placeholders
+    assert compiled.render({'first_name': 'Ada', 'Company Name': 'Acme'}) == (
+        template.replace('{first_name}', 'Ada').replace('{Company Name}', 'Acme')
+    )
+
+    redis_client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+    upload = b"email,first_name,Company Name\nada@example.com,Ada,Acme\n"
+
+    async def chunks():
+        yield upload
+
+    await StorageManager(redis_client).ingest_csv_stream(chunks())
+    scheduler = EmailScheduler(redis_client)
+    try:
+        campaign = await scheduler.create_campaign(template, "Hello {first_name}", "2030-01-01T09:00:00", 100, 5)
+        assert campaign['campaign_id'], campaign
+        try:
+            await scheduler.create_campaign(template + "{last_name}", "Hello", "2030-01-01T09:00:00", 100, 5)
+        except TemplateError as e:
+            assert e.unknown_fields == ['last_name'], e.unknown_fields
+        else:
+            raise AssertionError("unknown {last_name} was accepted")
+    finally:
+        await scheduler.esp_service.close()
+
+
+@check
+async def check_interrupted_scheduling():
+    """Scheduling cut off by a restart is marked failed; finished and live scheduling is left alone"""
+    from utils.scheduler_utils import SCHEDULING_KEY, EmailScheduler, campaign_key, scheduling_lease_key
+    from utils.storage_utils import StorageManager
+    redis_client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+    upload = b"email,name\n" + b"".join(f"user{i}@example.com,Name{i}\n".encode() for i in range(50))
+
+    async def chunks():
+        yield upload
+
+    await StorageManager(redis_client).ingest_csv_stream(chunks())
+    scheduler = EmailScheduler(redis_client)
+    try:
+        finished, live, interrupted = [
+            (await scheduler.create_campaign("Hi {name}", "Hello", "2030-01-01T09:00:00", 10, 5))['campaign_id']
+            for _ in range(3)
+        ]
+        await scheduler.schedule_campaign(finished)
+        assert not await redis_client.smembers(SCHEDULING_KEY), "finished scheduling left registered"
+        assert not await redis_client.exists(scheduling_lease_key(finished))
+
+        # What a process killed mid-schedule leaves behind: one with a live lease elsewhere, one without
+        for campaign_id in (live, interrupted):
+            await redis_client.sadd(SCHEDULING_KEY, campaign_id)
+            await redis_client.hset(campaign_key(campaign_id), 'scheduling_status', 'running')
+        await redis_client.set(scheduling_lease_key(live), 1, px=30000)
+
+        assert await scheduler.fail_interrupted_scheduling() == [interrupted]
+        progress = await scheduler.get_scheduling_progress(interrupted)
+        assert progress['status'] == 'failed' and 'restart' in progress['error'], progress
+        assert (await scheduler.get_scheduling_progress(live))['status'] == 'running'
+        assert (await scheduler.get_scheduling_progress(finished))['status'] == 'scheduled'
+        assert await redis_client.smembers(SCHEDULING_KEY) == {live.encode()}
+    finally:
+        await scheduler.esp_service.close()
+
+
+@check
+async def check_sheets_sync():
+    """Full then incremental sheet syncs write exactly the diff, swap it in whole and keep the row index consistent"""
+    from utils.google_sheets_utils import SyncKeys, SheetsSync
+    from utils.storage_utils import CSV_ROWS_KEY, INGEST_READ_SIZE, StorageManager
+    redis_client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+    sheet = [['email', 'name']] + [[f"user{i}@example.com", f"Name{i}"] for i in range(2500)]
+    service = FakeSheetsService({'Sheet1': sheet})
+    sync = SheetsSync(redis_client, service=service)
+    storage = StorageManager(redis_client)
+
+    keys = SyncKeys.for_source(sync.source_id('sheet', 'Sheet1'))
+
+    async def assert_matches_sheet():
+        stored = await storage.get_csv_data()
+        assert sorted(row['email'] for row in stored) == sorted(row[0] for row in sheet[1:]), "rows differ"
+        order = [k.decode() for k in await redis_client.lrange(keys.keys, 0, -1)]
+        index = {k.decode(): int(v) for k, v in (await redis_client.hgetall(keys.index)).items()}
+        assert index == {key: position for position, key in enumerate(order)}, "row index out of step"
+        assert [row['email'] for row in stored] == order, "rows and row keys out of step"
+        return order
+
+    stats = await sync.sync('sheet')
+    assert stats['full'] and stats['added'] == 2500 and stats['pages'] == 3, stats
+    await assert_matches_sheet()
+
+    reads = service.reads
+    stats = await sync.sync('sheet')
+    assert not stats['full'] and stats['unchanged'] == 2500, stats
+    assert stats['added'] == stats['changed'] == stats['removed'] == 0, stats
+    assert service.reads - reads == 3
+
+    # Deleting rows swaps the last row into their place instead of shifting the rest
+    before = await assert_matches_sheet()
+    sheet[10][1] = 'Changed'
+    del sheet[600], sheet[3]
+    sheet.append(['new@example.com', 'New'])
+
+    # Readers see the previous rows until the whole sync is swapped in
+    live_rows = await redis_client.lrange(CSV_ROWS_KEY, 0, -1)
+    apply_page = sync._apply_page
+
+    async def apply_page_unseen(*args):
+        length = await apply_page(*args)
+        assert await redis_client.lrange(CSV_ROWS_KEY, 0, -1) == live_rows, "live rows changed mid-sync"
+        return length
+
+    sync._apply_page = apply_page_unseen
+    stats = await sync.sync('sheet')
+    del sync._apply_page
+    assert not stats['full'], stats
+    assert (stats['added'], stats['changed'], stats['removed'], stats['total']) == (1, 1, 2, 2499), stats
+    after = await assert_matches_sheet()
+    moved = [key for position, key in enumerate(before[:len(after)]) if key in after and after[position] != key]
+    assert len(moved) <= 2, f"{len(moved)} rows moved for 2 deletions"
+    assert [row['name'] for row in await storage.get_csv_data() if row['email'] == 'user9@example.com'] == ['Changed']
+
+    sheet[0] = ['email', 'name', 'city']
+    stats = await sync.sync('sheet')
+    assert stats['full'] and stats['added'] == 2499, stats
+    await assert_matches_sheet()
+
+    # An upload landing mid-sync wins; the sync's staged rows are dropped
+    upload = b"email,name\nother@example.com,Other\n"
+
+    async def chunks():
+        for start in range(0, len(upload), INGEST_READ_SIZE):
+            yield upload[start:start + INGEST_READ_SIZE]
+
+    async def apply_page_then_upload(*args):
+        sync._apply_page = apply_page
+        await storage.ingest_csv_stream(chunks())
+        return await apply_page(*args)
+
+    sync._apply_page = apply_page_then_upload
+    try:
+        await sync.sync('sheet')
+    except ValueError as e:
+        assert 'replaced by an upload' in str(e), e
+    else:
+        raise AssertionError("sync overwrote an upload made while it ran")
+    del sync._apply_page
+    assert [row['email'] for row in await storage.get_csv_data()] == ['other@example.com']
+    assert not await redis_client.exists(*SyncKeys.for_source(sync.source_id('sheet', 'Sheet1'), staging=True).all())
+    stats = await sync.sync('sheet')
+    assert stats['full'] and stats['added'] == 2499, stats
+    await assert_matches_sheet()
+
+    # A CSV upload takes the dataset over and stops the scheduled sync
+    await sync.schedule('sheet', 'Sheet1', 'email', 0)
+    assert (await sync.run_due())['unchanged'] == 2499
+    await redis_client.delete('sheets_sync:schedule:lock')
+    await storage.ingest_csv_stream(chunks())
+    assert await sync.run_due() is None and await sync.get_schedule() is None
+    assert [row['email'] for row in await storage.get_csv_data()] == ['other@example.com']
+
+
+async def run(names) -> int:
+    failures = 0
+    for name in names:
+        started = time.perf_counter()
+        try:
+            await CHECKS[name]()
+        except Exception:
+            failures += 1
+            print(f"FAIL {name}")
+            traceback.print_exc()
+        else:
+            print(f"ok   {name} ({time.perf_counter() - started:.2f}s)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', help=f"comma-separated subset of: {', '.join(CHECKS)}")
+    args = parser.parse_args()
+    failures = asyncio.run(run(args.only.split(',') if args.only else list(CHECKS)))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
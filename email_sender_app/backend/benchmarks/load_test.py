@@ -0,0 +1,346 @@
+"""End-to-end load test: upload, schedule, send and webhook round trip.
+
+Starts the SendGrid and Groq stand-ins (with optional latency, 5xx and 429
+injection), then either spawns the API (uvicorn) and send workers pointed
+at them or drives an already running API given with --api-url; in that
+case its workers must use the stand-ins, e.g. via --sendgrid-port and
+SENDGRID_API_URL. The run:
+
+1. uploads a synthetic CSV through /api/upload_csv,
+2. optionally personalizes every row through /api/personalize (Groq),
+3. schedules one campaign through /api/schedule_emails,
+4. answers every recipient the SendGrid stand-in accepts with a
+   "delivered" webhook event posted back to /webhook/email-events,
+
+and reports upload rate, scheduling lag, send throughput and webhook
+ingestion lag. Spawned processes need a real Redis (REDIS_HOST/REDIS_PORT);
+the test adds recipients and analytics to it, so use a scratch database.
+
+Usage:
+    REDIS_DB=15 python -m benchmarks.load_test --recipients 100k --workers 4 --esp-latency 0.05
+    python -m benchmarks.load_test --recipients 10k --esp-error-rate 0.01 --esp-throttle-rate 0.05 --bulk
+    python -m benchmarks.load_test --recipients 50k --esp-capacity 500   # adaptive concurrency vs a rate limit
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List
+
+import aiohttp
+
+from benchmarks.stubs import FakeGroqServer, FakeSendGridServer
+from benchmarks.suite import format_size, parse_size
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def csv_file(rows: int) -> bytes:
+    buffer = io.StringIO()
+    buffer.write("email,name,company\n")
+    for i in range(rows):
+        buffer.write(f"load{i}@example.com,User {i},Company {i % 100}\n")
+    return buffer.getvalue().encode()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Services:
+    """API and send-worker subprocesses wired to the stand-ins"""
+
+    def __init__(self, args, sendgrid_url: str, groq_url: str):
+        self.args = args
+        self.env = dict(
+            os.environ,
+            SENDGRID_API_URL=sendgrid_url,
+            SENDGRID_API_KEY=os.getenv('SENDGRID_API_KEY', 'stub'),
+            SENDER_EMAIL=os.getenv('SENDER_EMAIL', 'sender@example.com'),
+            GROQ_BASE_URL=groq_url,
+            GROQ_API_KEY=os.getenv('GROQ_API_KEY', 'stub'),
+        )
+        self.processes: List[subprocess.Popen] = []
+
+    def start(self) -> str:
+        self.processes.append(subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(self.args.api_port),
+             '--workers', str(self.args.api_workers), '--log-level', 'warning'],
+            cwd=BACKEND_DIR, env=self.env
+        ))
+        self.processes.append(subprocess.Popen(
+            [sys.executable, 'worker.py', '--processes', str(self.args.workers),
+             '--concurrency', str(self.args.concurrency), '--claim-idle', '30'],
+            cwd=BACKEND_DIR, env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ))
+        return f"http://127.0.0.1:{self.args.api_port}"
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for process in self.processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def wait_ready(session: aiohttp.ClientSession, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get('/health/') as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError("API did not become ready")
+        await asyncio.sleep(0.5)
+
+
+async def call(session: aiohttp.ClientSession, method: str, path: str, **kwargs) -> Dict:
+    async with session.request(method, path, **kwargs) as response:
+        body = await response.json()
+        if response.status >= 400:
+            raise RuntimeError(f"{method} {path} failed with {response.status}: {body}")
+        return body
+
+
+class WebhookSender:
+    """Answers accepted recipients with delivered events, like the ESP's event webhook"""
+
+    def __init__(self, session: aiohttp.ClientSession, sendgrid: FakeSendGridServer,
+                 batch_size: int, interval: float):
+        self.session = session
+        self.sendgrid = sendgrid
+        self.batch_size = batch_size
+        self.interval = interval
+        self.posted = 0
+        self.failed_posts = 0
+        self.post_latencies: List[float] = []
+
+    async def run(self, stop: asyncio.Event):
+        while not (stop.is_set() and not self.sendgrid.accepted):
+            if not self.sendgrid.accepted:
+                await asyncio.sleep(self.interval)
+                continue
+            events = []
+            while self.sendgrid.accepted and len(events) < self.batch_size:
+                email, tracking_id = self.sendgrid.accepted.popleft()
+                events.append({
+                    'email': email,
+                    'tracking_id': tracking_id,
+                    'event': 'delivered',
+                    'sg_event_id': uuid.uuid4().hex,
+                    'timestamp': int(time.time())
+                })
+            started = time.perf_counter()
+            try:
+                async with self.session.post('/webhook/email-events', data=json.dumps(events),
+                                             headers={'Content-Type': 'application/json'}) as response:
+                    await response.read()
+                    response.raise_for_status()
+                self.posted += len(events)
+            except aiohttp.ClientError:
+                self.failed_posts += 1
+            self.post_latencies.append(time.perf_counter() - started)
+
+
+async def wait_for_sends(sendgrid: FakeSendGridServer, expected: int, settle: float, timeout: float,
+                         started: float) -> Dict:
+    """Wait until every recipient was accepted, or no request arrived for settle seconds"""
+    first_request = None
+    last_change = time.monotonic()
+    last_requests = 0
+    while time.monotonic() - started < timeout:
+        if sendgrid.requests != last_requests:
+            last_requests = sendgrid.requests
+            last_change = time.monotonic()
+            first_request = first_request or last_change
+        if sendgrid.messages >= expected:
+            break
+        if first_request and time.monotonic() - last_change > settle:
+            break
+        await asyncio.sleep(0.1)
+    # When sends stopped short, the idle settle period is not sending time
+    finished = time.monotonic() if sendgrid.messages >= expected else last_change
+    sending = finished - (first_request or finished)
+    return {
+        'accepted': sendgrid.messages,
+        'requests': sendgrid.requests,
+        'errors_injected': sendgrid.errors,
+        'throttled_injected': sendgrid.throttled,
+        'first_send_after_s': round((first_request or finished) - started, 3),
+        'send_seconds': round(sending, 3),
+        'sends_per_second': round(sendgrid.messages / sending, 1) if sending else 0.0,
+        'end_to_end_seconds': round(finished - started, 3)
+    }
+
+
+async def run(args) -> Dict:
+    recipients = args.recipients
+    faults = dict(latency=args.esp_latency, jitter=args.esp_jitter, error_rate=args.esp_error_rate,
+                  throttle_rate=args.esp_throttle_rate, retry_after=args.retry_after, capacity=args.esp_capacity)
+    groq_faults = dict(latency=args.groq_latency, error_rate=args.groq_error_rate,
+                       throttle_rate=args.groq_throttle_rate, retry_after=args.retry_after)
+    report: Dict = {'recipients': recipients}
+
+    async with FakeSendGridServer(port=args.sendgrid_port, record=True, **faults) as sendgrid, \
+            FakeGroqServer(port=args.groq_port, **groq_faults) as groq:
+        services = None
+        api_url = args.api_url
+        if not api_url:
+            services = Services(args, sendgrid.url, groq.url)
+            api_url = services.start()
+        try:
+            async with aiohttp.ClientSession(base_url=api_url,
+                                             timeout=aiohttp.ClientTimeout(total=600)) as session:
+                await wait_ready(session)
+
+                form = aiohttp.FormData()
+                form.add_field('file', csv_file(recipients), filename='load.csv', content_type='text/csv')
+                started = time.perf_counter()
+                upload = await call(session, 'POST', '/api/upload_csv', data=form)
+                elapsed = time.perf_counter() - started
+                report['upload'] = {
+                    'rows': upload['total_records'],
+                    'seconds': round(elapsed, 3),
+                    'rows_per_second': round(recipients / elapsed, 1)
+                }
+
+                if args.personalize:
+                    started = time.perf_counter()
+                    job = await call(session, 'POST', '/api/personalize',
+                                     json={'prompt_template': 'Write to {name} at {company}', 'max_tokens': 100})
+                    while True:
+                        progress = await call(session, 'GET', f"/api/personalize/{job['job_id']}")
+                        if progress.get('status') in ('completed', 'failed'):
+                            break
+                        await asyncio.sleep(0.5)
+                    elapsed = time.perf_counter() - started
+                    report['personalize'] = {
+                        'status': progress.get('status'),
+                        'completed': progress.get('completed'),
+                        'failed': progress.get('failed'),
+                        'seconds': round(elapsed, 3),
+                        'rows_per_second': round(int(progress.get('completed') or 0) / elapsed, 1),
+                        'errors_injected': groq.errors,
+                        'throttled_injected': groq.throttled
+                    }
+
+                lag_before = await call(session, 'GET', '/webhook/lag')
+                stop = asyncio.Event()
+                webhooks = WebhookSender(session, sendgrid, args.webhook_batch, args.webhook_interval)
+                webhook_task = asyncio.create_task(webhooks.run(stop))
+                lag_samples = []
+
+                async def sample_lag():
+                    while True:
+                        lag_samples.append(await call(session, 'GET', '/webhook/lag'))
+                        await asyncio.sleep(args.sample_interval)
+
+                sampler = asyncio.create_task(sample_lag())
+
+                started = time.monotonic()
+                request_started = time.perf_counter()
+                campaign = await call(session, 'POST', '/api/schedule_emails', json={
+                    'prompt_template': '<p>Hello {name} from {company}</p>',
+                    'subject': 'Load test',
+                    'schedule_time': None,
+                    'batch_size': args.batch_size,
+                    'interval_minutes': 0,
+                    'bulk_send': args.bulk
+                })
+                request_seconds = time.perf_counter() - request_started
+                while True:
+                    progress = await call(session, 'GET', f"/api/schedule_emails/{campaign['campaign_id']}/progress")
+                    if progress['status'] in ('scheduled', 'failed'):
+                        break
+                    await asyncio.sleep(0.1)
+                report['scheduling'] = {
+                    'status': progress['status'],
+                    'request_seconds': round(request_seconds, 3),
+                    'lag_seconds': round(time.monotonic() - started, 3),
+                    'batches': campaign.get('batches')
+                }
+
+                report['sending'] = await wait_for_sends(sendgrid, recipients, args.settle, args.timeout, started)
+
+                stop.set()
+                await webhook_task
+                drain_started = time.monotonic()
+                expected = lag_before['events'] + webhooks.posted
+                while time.monotonic() - drain_started < args.timeout:
+                    lag = await call(session, 'GET', '/webhook/lag')
+                    if lag['events'] >= expected and lag['backlog_payloads'] == 0:
+                        break
+                    await asyncio.sleep(0.1)
+                sampler.cancel()
+                report['webhooks'] = {
+                    'posted_events': webhooks.posted,
+                    'failed_posts': webhooks.failed_posts,
+                    'post_p50_ms': round(percentile(webhooks.post_latencies, 0.5) * 1000, 2),
+                    'post_p99_ms': round(percentile(webhooks.post_latencies, 0.99) * 1000, 2),
+                    'applied': lag['applied'] - lag_before['applied'],
+                    'max_lag_seconds': max((s['lag_seconds'] for s in lag_samples), default=0.0),
+                    'max_backlog_payloads': max((s['backlog_payloads'] for s in lag_samples), default=0),
+                    'drain_seconds': round(time.monotonic() - drain_started, 3)
+                }
+        finally:
+            if services:
+                services.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--recipients', type=parse_size, default=parse_size('10k'))
+    parser.add_argument('--api-url', help="drive a running API instead of spawning one")
+    parser.add_argument('--api-port', type=int, default=8800)
+    parser.add_argument('--api-workers', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1, help="send worker processes")
+    parser.add_argument('--concurrency', type=int, default=8, help="batches in flight per worker process")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--bulk', action='store_true', help="pack recipients into personalizations")
+    parser.add_argument('--personalize', action='store_true', help="also personalize every row through Groq")
+    parser.add_argument('--sendgrid-port', type=int, default=0)
+    parser.add_argument('--groq-port', type=int, default=0)
+    parser.add_argument('--esp-latency', type=float, default=0.05)
+    parser.add_argument('--esp-jitter', type=float, default=0.0)
+    parser.add_argument('--esp-error-rate', type=float, default=0.0)
+    parser.add_argument('--esp-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--esp-capacity', type=int, help="SendGrid requests per second before it answers 429")
+    parser.add_argument('--groq-latency', type=float, default=0.2)
+    parser.add_argument('--groq-error-rate', type=float, default=0.0)
+    parser.add_argument('--groq-throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1.0, help="Retry-After seconds on injected 429s")
+    parser.add_argument('--webhook-batch', type=int, default=1000, help="events per webhook POST")
+    parser.add_argument('--webhook-interval', type=float, default=0.2)
+    parser.add_argument('--sample-interval', type=float, default=0.5, help="seconds between /webhook/lag samples")
+    parser.add_argument('--settle', type=float, default=10.0,
+                        help="stop waiting for sends after this many idle seconds")
+    parser.add_argument('--timeout', type=float, default=1800.0)
+    parser.add_argument('--output', type=Path, help="write the report as JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(f"Load test with {format_size(args.recipients)} recipients")
+    print(json.dumps(report, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Cold-start cost of the API and send worker entry points.
+
+Imports each module in fresh interpreters (so nothing is cached in
+sys.modules), reports the median wall time and the modules with the largest
+cumulative import cost from -X importtime, and exits non-zero when a median
+exceeds --budget seconds.
+
+Usage:
+    python -m benchmarks.startup                        # main and worker, 1s budget
+    python -m benchmarks.startup --modules main --runs 10 --budget 0.75 --top 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+TIMER = (
+    "import time; started = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - started)"
+)
+
+
+def time_import(module: str) -> float:
+    result = subprocess.run(
+        [sys.executable, '-c', TIMER.format(module=module)],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def import_profile(module: str, top: int) -> List[Tuple[str, float]]:
+    """Modules with the largest cumulative import time, in seconds"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    )
+    costs: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        # Only top-level packages, so nested imports are not counted twice
+        if '.' not in name and name not in (module, 'site', 'encodings'):
+            costs[name] = max(costs.get(name, 0), int(cumulative) / 1e6)
+    return sorted(costs.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modules', default='main,worker', help="comma-separated entry modules")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=float(os.getenv('STARTUP_BUDGET_SECONDS', 1.0)),
+                        help="maximum median import seconds per module")
+    parser.add_argument('--top', type=int, default=10, help="heaviest imported packages to report")
+    args = parser.parse_args()
+
+    report = {}
+    over_budget = []
+    for module in args.modules.split(','):
+        # Warm the OS file cache so runs measure the interpreter, not the disk
+        time_import(module)
+        samples = [time_import(module) for _ in range(args.runs)]
+        median = statistics.median(samples)
+        report[module] = {
+            'median_seconds': round(median, 4),
+            'min_seconds': round(min(samples), 4),
+            'heaviest_imports': {name: round(seconds, 4) for name, seconds in import_profile(module, args.top)},
+        }
+        if median > args.budget:
+            over_budget.append(f"{module}: {median:.3f}s > {args.budget:.3f}s budget")
+
+    print(json.dumps(report, indent=2))
+    for failure in over_budget:
+        print(f"OVER BUDGET {failure}", file=sys.stderr)
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
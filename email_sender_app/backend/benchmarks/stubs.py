@@ -0,0 +1,278 @@
+"""Local HTTP stand-ins for the external providers used by the backend.
+
+The servers speak just enough HTTP/1.1 (with keep-alive) to be driven by
+aiohttp, so benchmarks exercise real sockets and connection pooling without
+touching the network. Latency, server errors and 429 throttling can be
+injected to load-test the retry and backoff paths.
+
+Run standalone to point a deployed API and its workers at them:
+    python -m benchmarks.stubs --sendgrid-port 8765 --groq-port 8766 --latency 0.05 --throttle-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+class StubHTTPServer:
+    """Base server; each request waits latency (+ up to jitter) seconds.
+
+    A fraction error_rate of requests fails with 500 and a fraction
+    throttle_rate with 429 and a Retry-After of retry_after seconds. With
+    capacity, requests beyond that many per second are also answered 429,
+    with a Retry-After until the next second, like a real rate limit.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, retry_after: float = 1.0,
+                 seed: Optional[int] = None, capacity: Optional[int] = None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.capacity = capacity
+        self._window = 0
+        self._window_requests = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port, backlog=4096)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def handle(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Response:
+        raise NotImplementedError
+
+    def error_body(self, message: str) -> bytes:
+        return json.dumps({'errors': [{'message': message}]}).encode()
+
+    def inject_fault(self) -> Optional[Response]:
+        if self.capacity:
+            now = time.time()
+            if int(now) != self._window:
+                self._window, self._window_requests = int(now), 0
+            self._window_requests += 1
+            if self._window_requests > self.capacity:
+                self.throttled += 1
+                retry_after = math.ceil(self._window + 1 - now)
+                return 429, {'Retry-After': str(retry_after)}, self.error_body('rate limit exceeded')
+        draw = self._random.random()
+        if draw < self.throttle_rate:
+            self.throttled += 1
+            return 429, {'Retry-After': f"{self.retry_after:g}"}, self.error_body('too many requests')
+        if draw < self.throttle_rate + self.error_rate:
+            self.errors += 1
+            return 500, {}, self.error_body('internal error')
+        return None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                method, path, _ = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                self.requests += 1
+                delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+                if delay:
+                    await asyncio.sleep(delay)
+                status, response_headers, response_body = (
+                    self.inject_fault() or await self.handle(method, path, headers, body)
+                )
+
+                head_lines = [f"HTTP/1.1 {status} X", f"Content-Length: {len(response_body)}"]
+                head_lines += [f"{name}: {value}" for name, value in response_headers.items()]
+                writer.write(('\r\n'.join(head_lines) + '\r\n\r\n').encode('latin-1') + response_body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+class FakeSendGridServer(StubHTTPServer):
+    """Accepts POST /v3/mail/send like SendGrid and counts delivered personalizations.
+
+    Like SendGrid, a request is rejected as a whole (400) if any recipient is
+    invalid; here that means an address without an '@'. With record=True the
+    (email, tracking_id) of every accepted recipient is appended to
+    accepted, for a load test to answer with webhook events.
+    """
+
+    def __init__(self, *args, record: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.messages = 0
+        self.record = record
+        self.accepted: Deque[Tuple[str, Optional[str]]] = deque()
+
+    async def handle(self, method, path, headers, body):
+        if method != 'POST' or path != '/v3/mail/send':
+            return 404, {}, b'{"errors": [{"message": "not found"}]}'
+        payload = json.loads(body)
+        personalizations = payload.get('personalizations', [])
+        errors = [
+            {'message': 'Does not contain a valid address.', 'field': f"personalizations.{i}.to"}
+            for i, personalization in enumerate(personalizations)
+            if '@' not in personalization['to'][0]['email']
+        ]
+        if errors:
+            return 400, {}, json.dumps({'errors': errors}).encode()
+        self.messages += len(personalizations)
+        if self.record:
+            self.accepted.extend(
+                (p['to'][0]['email'], (p.get('custom_args') or {}).get('tracking_id'))
+                for p in personalizations
+            )
+        return 202, {'X-Message-Id': uuid.uuid4().hex}, b''
+
+
+class FakeGroqServer(StubHTTPServer):
+    """OpenAI-compatible POST /openai/v1/chat/completions, as used by the groq SDK"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.completions = 0
+
+    def error_body(self, message: str) -> bytes:
+        return json.dumps({'error': {'message': message}}).encode()
+
+    async def handle(self, method, path, headers, body):
+        if method != 'POST' or path != '/openai/v1/chat/completions':
+            return 404, {}, b'{"error": {"message": "not found"}}'
+        payload = json.loads(body)
+        self.completions += 1
+        prompt = payload['messages'][-1]['content']
+        content = f"Generated email for: {prompt}"
+        response = {
+            'id': f"chatcmpl-{uuid.uuid4().hex}",
+            'object': 'chat.completion',
+            'created': 0,
+            'model': payload.get('model'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop'
+            }],
+            'usage': {
+                'prompt_tokens': len(prompt) // 4,
+                'completion_tokens': len(content) // 4,
+                'total_tokens': (len(prompt) + len(content)) // 4
+            }
+        }
+        return 200, {'Content-Type': 'application/json'}, json.dumps(response).encode()
+
+
+class FakeSheetsService:
+    """In-process stand-in for the googleapiclient Sheets v4 service.
+
+    Supports spreadsheets().get() for sheet properties and
+    spreadsheets().values().get() for whole-row ranges such as 'Sheet1'!2:1001.
+    sheets maps sheet titles to lists of rows; edit them between syncs.
+    """
+
+    class _Request:
+        def __init__(self, result):
+            self.result = result
+
+        def execute(self):
+            return self.result()
+
+    def __init__(self, sheets: Dict[str, list]):
+        self.sheets = sheets
+        self.reads = 0
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId: str, fields: Optional[str] = None, range: Optional[str] = None):
+        if range is None:
+            return self._Request(lambda: {'sheets': [
+                {'properties': {'title': title, 'gridProperties': {'rowCount': max(len(rows), 1000)}}}
+                for title, rows in self.sheets.items()
+            ]})
+
+        def read():
+            self.reads += 1
+            title, rows = range.rsplit('!', 1)
+            start, end = (int(row) for row in rows.split(':'))
+            values = [list(row) for row in self.sheets[title.strip("'")][start - 1:end]]
+            while values and not values[-1]:
+                values.pop()
+            return {'range': range, 'values': values} if values else {'range': range}
+
+        return self._Request(read)
+
+
+async def serve(args):
+    faults = dict(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                  throttle_rate=args.throttle_rate, retry_after=args.retry_after, capacity=args.capacity)
+    async with FakeSendGridServer(port=args.sendgrid_port, **faults) as sendgrid, \
+            FakeGroqServer(port=args.groq_port, **faults) as groq:
+        print(f"SENDGRID_API_URL={sendgrid.url}")
+        print(f"GROQ_BASE_URL={groq.url}")
+        while True:
+            await asyncio.sleep(10)
+            print(f"sendgrid: {sendgrid.requests} requests, {sendgrid.messages} messages, "
+                  f"{sendgrid.errors} errors, {sendgrid.throttled} throttled; "
+                  f"groq: {groq.completions} completions, {groq.errors} errors, {groq.throttled} throttled")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the SendGrid and Groq stand-ins")
+    parser.add_argument('--sendgrid-port', type=int, default=8765)
+    parser.add_argument('--groq-port', type=int, default=8766)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many extra seconds, uniformly")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered 500")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="fraction of requests answered 429")
+    parser.add_argument('--retry-after', type=float, default=1.0, help="Retry-After seconds on 429s")
+    parser.add_argument('--capacity', type=int, help="requests per second served before answering 429")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""Micro-benchmark suite for the backend hot paths, with regression checks.
+
+Each benchmark runs against a fresh fakeredis server (or the Redis at
+--redis-url, which is FLUSHED between benchmarks) and the local SendGrid
+and Groq stand-ins, once per recipient count. It reports latency per
+operation, throughput and peak memory growth (sampled process RSS), then
+compares the run with the stored baselines. The process exits non-zero
+when throughput drops by more than --tolerance, or peak memory grows by
+more than --tolerance plus --peak-slack-mb.
+
+Throughput depends on the machine, so every run also measures a fixed
+reference workload (Python work plus Redis round trips on the same
+backend) and each baseline stores the reference throughput of the run
+that recorded it. Baselines are scaled by this run's reference over
+theirs before comparing, so a slower machine or CI runner does not read
+as a regression. Keep baselines per Redis backend (fakeredis runs Lua far
+slower than Redis, so use --redis-url for 1M-recipient runs) with
+--baselines or BENCH_BASELINES.
+
+Usage:
+    python -m benchmarks.suite                                  # 1k,100k against baselines.json
+    python -m benchmarks.suite --sizes 1k,100k,1M --redis-url redis://localhost:6379/15
+    python -m benchmarks.suite --only upload_csv,get_analytics --update-baselines
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import fakeredis
+import redis.asyncio as aioredis
+
+from benchmarks.stubs import FakeGroqServer, FakeSendGridServer
+
+BASELINES_PATH = Path(os.getenv('BENCH_BASELINES') or Path(__file__).with_name('baselines.json'))
+SIZE_SUFFIXES = {'k': 1000, 'm': 1000000}
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    if text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    for suffix, factor in (('M', 1000000), ('k', 1000)):
+        if size >= factor and size % factor == 0:
+            return f"{size // factor}{suffix}"
+    return str(size)
+
+
+@dataclass
+class Measurement:
+    ops: int
+    items: int
+    seconds: float
+    peak_bytes: int
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            'ops': self.ops,
+            'items': self.items,
+            'latency_ms': round(self.seconds / self.ops * 1000, 4),
+            'throughput': round(self.items / self.seconds, 2),
+            'peak_mb': round(self.peak_bytes / 1024 / 1024, 3),
+        }
+
+
+def current_rss() -> int:
+    """Resident set size in bytes (Linux /proc; elsewhere the non-resettable high-water mark)"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class Probe:
+    """Times the measured section of a benchmark and samples its peak RSS growth.
+
+    Sampling runs in a thread every few milliseconds, which unlike tracemalloc
+    leaves the measured code running at full speed.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.result: Optional[Measurement] = None
+
+    @asynccontextmanager
+    async def measure(self, ops: int, items: int):
+        baseline = current_rss()
+        peak = baseline
+        done = threading.Event()
+
+        def sample():
+            nonlocal peak
+            while not done.wait(self.interval):
+                peak = max(peak, current_rss())
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            done.set()
+            sampler.join()
+        peak = max(peak, current_rss())
+        self.result = Measurement(ops, items, seconds, peak - baseline)
+
+
+@dataclass
+class Env:
+    redis_client: aioredis.Redis
+    sendgrid_url: str
+    groq_url: str
+
+
+Benchmark = Callable[[Env, int, Probe], Awaitable[None]]
+BENCHMARKS: Dict[str, Benchmark] = {}
+MAX_SIZES: Dict[str, int] = {}
+
+
+def benchmark(max_size: Optional[int] = None):
+    def register(func: Benchmark) -> Benchmark:
+        BENCHMARKS[func.__name__.replace('bench_', '')] = func
+        if max_size:
+            MAX_SIZES[func.__name__.replace('bench_', '')] = max_size
+        return func
+    return register
+
+
+def csv_bytes(rows: int) -> bytes:
+    buffer = io.StringIO()
+    buffer.write("email,first_name,company\n")
+    for i in range(rows):
+        buffer.write(f"user{i}@example.com,Name{i},Company {i % 1000}\n")
+    return buffer.getvalue().encode()
+
+
+async def byte_chunks(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def upload(env: Env, rows: int):
+    from utils.storage_utils import StorageManager, INGEST_READ_SIZE
+    storage = StorageManager(env.redis_client)
+    await storage.ingest_csv_stream(byte_chunks(csv_bytes(rows), INGEST_READ_SIZE))
+    return storage
+
+
+@benchmark()
+async def bench_get_analytics(env: Env, size: int, probe: Probe):
+    """Dashboard read with `size` recipients tracked (counters seeded directly)"""
+    from utils.redis_utils import (RedisService, STATUS_COUNTERS_KEY, DELIVERY_COUNTERS_KEY,
+                                   SCHEDULED_KEY, TOTAL_KEY)
+    r = env.redis_client
+    now = time.time()
+    for start in range(0, size, 10000):
+        await r.zadd(SCHEDULED_KEY, {f"t{i}": now + (i % 2 * 2 - 1) * 3600 for i in range(start, min(start + 10000, size))})
+    await r.set(TOTAL_KEY, size)
+    await r.hset(STATUS_COUNTERS_KEY, mapping={'sent': size // 2, 'Scheduled': size - size // 2})
+    await r.hset(DELIVERY_COUNTERS_KEY, mapping={'Delivered': size // 3, 'pending': size - size // 3})
+
+    service = RedisService(r)
+    calls = 500
+    async with probe.measure(ops=calls, items=calls):
+        for _ in range(calls):
+            await service.get_analytics()
+
+
+@benchmark()
+async def bench_upload_csv(env: Env, size: int, probe: Probe):
+    """Streaming CSV ingestion of `size` rows"""
+    from utils.storage_utils import StorageManager, INGEST_READ_SIZE
+    data = csv_bytes(size)
+    storage = StorageManager(env.redis_client)
+    async with probe.measure(ops=1, items=size):
+        await storage.ingest_csv_stream(byte_chunks(data, INGEST_READ_SIZE))
+
+
+@benchmark()
+async def bench_schedule_emails(env: Env, size: int, probe: Probe):
+    """Campaign creation plus bulk scheduling of `size` uploaded recipients"""
+    from utils.scheduler_utils import EmailScheduler
+    await upload(env, size)
+    scheduler = EmailScheduler(env.redis_client)
+    async with probe.measure(ops=1, items=size):
+        campaign = await scheduler.create_campaign(
+            "Hi {first_name} at {company}", "Hello {first_name}", "2030-01-01T09:00:00",
+            batch_size=1000, interval_minutes=5
+        )
+        await scheduler.schedule_campaign(campaign['campaign_id'])
+    await scheduler.esp_service.close()
+
+
+@benchmark()
+async def bench_esp_webhook(env: Env, size: int, probe: Probe):
+    """Ack-fast append of `size` events (1000 per POST) and batched application"""
+    from utils.redis_utils import DELIVERY_COUNTERS_KEY, RedisService
+    from utils.webhook_utils import WebhookIngest
+    # Events only update recipients already on record, so create them first
+    service = RedisService(env.redis_client)
+    for start in range(0, size, 1000):
+        pipe = env.redis_client.pipeline(transaction=False)
+        for i in range(start, min(start + 1000, size)):
+            await service.queue_email_status(pipe, f"t{i}", {'to_email': f"user{i}@example.com", 'status': 'sent'})
+        await pipe.execute()
+
+    ingest = WebhookIngest(env.redis_client, consumer='bench')
+    await ingest.ensure_group()
+    per_payload = 1000
+    payloads = [
+        json.dumps([
+            {'tracking_id': f"t{i}", 'event': 'delivered', 'sg_event_id': f"e{i}", 'email': f"user{i}@example.com"}
+            for i in range(start, min(start + per_payload, size))
+        ]).encode()
+        for start in range(0, size, per_payload)
+    ]
+    async with probe.measure(ops=len(payloads), items=size):
+        for payload in payloads:
+            await ingest.append(payload)
+        while True:
+            entries = await ingest.read()
+            if not entries:
+                break
+            await ingest.apply(entries)
+    delivered = await env.redis_client.hget(DELIVERY_COUNTERS_KEY, 'Delivered')
+    assert int(delivered or 0) == size, f"{int(delivered or 0)} of {size} events applied"
+
+
+@benchmark()
+async def bench_process_email_batch(env: Env, size: int, probe: Probe):
+    """Render, send (stubbed SendGrid) and record `size` recipients in 1000-row batches"""
+    from utils.esp_utils import ESPService
+    from utils.scheduler_utils import EmailScheduler, campaign_key
+    scheduler = EmailScheduler(env.redis_client)
+    scheduler.esp_service = ESPService(max_concurrency=200, api_url=env.sendgrid_url)
+
+    batch_size = 1000
+    fields = ['email', 'first_name', 'company']
+
+    async def rows():
+        for start in range(0, size, batch_size):
+            yield [
+                {'email': f"user{i}@example.com", 'first_name': f"Name{i}", 'company': f"Company {i % 1000}"}
+                for i in range(start, min(start + batch_size, size))
+            ]
+
+    await scheduler.recipient_store.write_campaign('bench', fields, rows(), batch_size)
+    await env.redis_client.hset(campaign_key('bench'), mapping={
+        'prompt_template': "<p>Hi {first_name}, a note for {company}.</p>",
+        'subject': "Hello {first_name}",
+        'bulk': 0,
+        'send_rate': ''
+    })
+
+    slots = asyncio.Semaphore(8)  # batches in flight, as in one worker process
+    # Imported on the first send; keep them out of the measurement
+    import aiohttp  # noqa: F401
+    import pandas  # noqa: F401
+
+    async def send(start: int):
+        async with slots:
+            await scheduler.process_campaign_batch('bench', start, min(start + batch_size, size))
+
+    async with probe.measure(ops=(size + batch_size - 1) // batch_size, items=size):
+        await asyncio.gather(*(send(start) for start in range(0, size, batch_size)))
+    await scheduler.esp_service.close()
+
+
+@benchmark(max_size=100000)
+async def bench_llm_generate(env: Env, size: int, probe: Probe):
+    """`size` generations over size/10 distinct prompts (Groq stand-in, cache on)"""
+    os.environ['GROQ_BASE_URL'] = env.groq_url
+    os.environ.setdefault('GROQ_API_KEY', 'stub')
+    from utils.llm_utils import LLMService
+    service = LLMService(env.redis_client, local_cache_size=max(size // 100, 1))
+    distinct = max(size // 10, 1)
+    slots = asyncio.Semaphore(64)
+    import groq  # noqa: F401  imported on the first generation; keep it out of the measurement
+
+    async def generate(i: int):
+        async with slots:
+            await service.generate([{'role': 'user', 'content': f"Write to customer {i % distinct}"}])
+
+    async with probe.measure(ops=size, items=size):
+        await asyncio.gather(*(generate(i) for i in range(size)))
+
+
+async def fresh_redis(redis_url: Optional[str]) -> aioredis.Redis:
+    if redis_url:
+        client = aioredis.from_url(redis_url)
+        await client.flushdb()
+        return client
+    return fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer())
+
+
+async def measure_reference(redis_url: Optional[str], items: int = 20000) -> float:
+    """Items/s of a fixed mix of JSON encoding and pipelined Redis writes and reads, best of three"""
+    best = 0.0
+    for _ in range(3):
+        redis_client = await fresh_redis(redis_url)
+        start = time.perf_counter()
+        for batch in range(0, items, 1000):
+            pipe = redis_client.pipeline(transaction=False)
+            for i in range(batch, batch + 1000):
+                pipe.hset(f"reference:{i % 100}", f"user{i}", json.dumps({'email': f"user{i}@example.com", 'n': i}))
+            await pipe.execute()
+            pipe = redis_client.pipeline(transaction=False)
+            for i in range(batch, batch + 1000):
+                pipe.hget(f"reference:{i % 100}", f"user{i}")
+            for value in await pipe.execute():
+                json.loads(value)
+        best = max(best, items / (time.perf_counter() - start))
+        await redis_client.aclose()
+    return round(best, 2)
+
+
+async def run(args) -> Dict[str, Dict]:
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    results = {}
+    reference = await measure_reference(args.redis_url)
+    print(f"{'reference':36} {reference:31.1f} items/s", flush=True)
+    async with FakeSendGridServer() as sendgrid, FakeGroqServer() as groq:
+        for name in names:
+            for size in sizes:
+                key = f"{name}[{format_size(size)}]"
+                if size > MAX_SIZES.get(name, size):
+                    print(f"{key:36} skipped (max {format_size(MAX_SIZES[name])})")
+                    continue
+                redis_client = await fresh_redis(args.redis_url)
+                probe = Probe()
+                await BENCHMARKS[name](Env(redis_client, sendgrid.url, groq.url), size, probe)
+                await redis_client.aclose()
+                results[key] = dict(probe.result.as_dict(), reference=reference)
+                row = results[key]
+                print(f"{key:36} {row['latency_ms']:12.3f} ms/op {row['throughput']:14.1f} items/s "
+                      f"{row['peak_mb']:10.2f} MB peak", flush=True)
+    return results
+
+
+def compare(results: Dict[str, Dict], baselines: Dict[str, Dict], tolerance: float,
+            peak_slack_mb: float = 0.0) -> List[str]:
+    regressions = []
+    for key, row in results.items():
+        base = baselines.get(key)
+        if not base:
+            continue
+        # The baseline as this machine would run it
+        expected = base['throughput']
+        if base.get('reference') and row.get('reference'):
+            expected *= row['reference'] / base['reference']
+        if row['throughput'] < expected * (1 - tolerance):
+            regressions.append(f"{key}: throughput {row['throughput']:.1f} < baseline {expected:.1f} "
+                               f"({base['throughput']:.1f} at reference {base.get('reference', '?')})")
+        # Sampled RSS also moves with allocator arenas and one-off allocations
+        # (first connections, lazily built caches), so allow a fixed slack on top
+        if row['peak_mb'] > base['peak_mb'] * (1 + tolerance) + peak_slack_mb:
+            regressions.append(f"{key}: peak {row['peak_mb']:.2f} MB > baseline {base['peak_mb']:.2f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1k,100k', help="recipient counts, e.g. 1k,100k,1M")
+    parser.add_argument('--only', help=f"comma-separated subset of: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--redis-url', help="benchmark a real Redis instead of fakeredis (the DB is flushed)")
+    parser.add_argument('--baselines', type=Path, default=BASELINES_PATH,
+                        help="baselines file, e.g. one per Redis backend (default: BENCH_BASELINES or baselines.json)")
+    parser.add_argument('--tolerance', type=float, default=0.3, help="allowed fractional regression")
+    parser.add_argument('--peak-slack-mb', type=float, default=16.0,
+                        help="peak memory growth (MB) allowed beyond the tolerance")
+    parser.add_argument('--update-baselines', action='store_true')
+    parser.add_argument('--output', type=Path, help="also write this run's results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2, sort_keys=True) + '\n')
+
+    baselines = json.loads(args.baselines.read_text()) if args.baselines.exists() else {}
+    if args.update_baselines:
+        baselines.update(results)
+        args.baselines.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+        print(f"baselines updated: {args.baselines}")
+        return
+
+    regressions = compare(results, baselines, args.tolerance, args.peak_slack_mb)
+    missing = [key for key in results if key not in baselines]
+    if missing:
+        print(f"no baseline for: {', '.join(missing)}")
+    if regressions:
+        print("REGRESSIONS:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
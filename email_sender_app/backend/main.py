@@ -1,28 +1,40 @@
-from fastapi import FastAPI, UploadFile, Form, BackgroundTasks, HTTPException, File, WebSocket
+import time
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, UploadFile, Form, BackgroundTasks, HTTPException, File, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import pandas as pd
-import redis
 from datetime import datetime
-import groq
 from typing import Optional, List
 import asyncio
-from utils.email_utils import send_email, get_esp_client
-from utils.google_sheets_utils import connect_google_sheets
+from utils.google_sheets_utils import SheetsSync
 from utils.scheduler_utils import EmailScheduler
 from models.email_data import EmailData, EmailStatus
-import uvicorn
 from dotenv import load_dotenv
 import os
 import logging
 from auth.google_auth import GoogleAuthManager
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import io
-from fastapi import Request
-from utils.storage_utils import StorageManager
+from fastapi import Request, Query
+from utils.storage_utils import StorageManager, INGEST_READ_SIZE
+from utils.redis_utils import RedisService
+from utils.template_utils import compile_template, TemplateError
+from utils.llm_utils import LLMService, EMAIL_SYSTEM_PROMPT
+from utils.personalization_utils import PersonalizationPipeline
+from utils.webhook_utils import WebhookIngest
+from utils.rollup_utils import EventRollups
+from websocket_handler import ws_manager, ANALYTICS_CHANNEL
+from utils.redis_pool import create_redis
+from utils.metrics import MetricsMiddleware, record_startup, render_metrics, scrape_gauges
+from contextlib import asynccontextmanager
+import json
 from models.csv_data import CSVUploadResponse
 from io import StringIO
 
+# Heavy SDKs (pandas, groq, sendgrid, Google API client) are imported where first used
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,8 +42,55 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Verify Redis and run background consumers for the lifetime of the app"""
+    started = time.perf_counter()
+    try:
+        await redis_client.ping()
+        logger.info("Successfully connected to Redis")
+
+        # Pick up personalization jobs interrupted by the last shutdown, and
+        # later those of other processes that stop mid-job
+        await personalization_pipeline.resume_incomplete()
+        personalization_watch = asyncio.create_task(personalization_pipeline.watch())
+
+        # Campaigns whose scheduling was cut off by a restart are marked failed
+        scheduling_watch = asyncio.create_task(email_scheduler.watch_scheduling())
+
+        # Coalesced analytics fan-out to this process's dashboards, fed by
+        # updates published from any API process or send worker
+        ws_manager.start(redis_service.get_analytics, pubsub_client=redis_client)
+
+        # Apply queued webhook events, broadcasting once per applied batch
+        webhook_consumer = asyncio.create_task(
+            webhook_ingest.consume(on_batch=lambda applied: broadcast_analytics_update())
+        )
+
+        # Scheduled Google Sheets recipient sync
+        sheets_sync_task = asyncio.create_task(sheets_sync.run_scheduled())
+
+        record_startup('API', imports=IMPORT_SECONDS, lifespan=time.perf_counter() - started)
+    except Exception as e:
+        logger.error(f"Startup check failed: {str(e)}")
+        raise
+
+    yield
+
+    try:
+        webhook_consumer.cancel()
+        sheets_sync_task.cancel()
+        personalization_watch.cancel()
+        scheduling_watch.cancel()
+        await ws_manager.stop()
+        await email_scheduler.esp_service.close()
+        await redis_client.connection_pool.disconnect()
+        logger.info("Redis connection pool closed")
+    except Exception as e:
+        logger.error(f"Error during shutdown: {str(e)}")
+
 # Initialize FastAPI app
-app = FastAPI(title="Dashboard")
+app = FastAPI(title="Dashboard", lifespan=lifespan)
 
 # CORS Configuration
 app.add_middleware(
@@ -41,70 +100,59 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
-# Redis Configuration
-REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
-REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
-REDIS_DB = int(os.getenv('REDIS_DB', 0))
-REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', None)
-
-# Initialize Redis with error handling
-try:
-    redis_client = redis.Redis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        db=REDIS_DB,
-        decode_responses=True,
-        socket_timeout=5,
-        retry_on_timeout=True
-    )
-    # Test Redis connection
-    redis_client.ping()
-    logger.info("Successfully connected to Redis")
-except redis.ConnectionError as e:
-    logger.error(f"Failed to connect to Redis: {str(e)}")
-    raise
+# One asyncio connection pool shared by every component (see utils/redis_pool.py)
+redis_client = create_redis()
+
+# Initialize cached LLM service (shared Groq client, LRU + Redis cache)
+llm_service = LLMService(redis_client)
 
-# Initialize Groq client for LLM
-groq_client = groq.Groq(api_key=os.getenv("GROQ_API_KEY", "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"))
+# Uploaded recipient data
+storage_manager = StorageManager(redis_client)
 
-# Initialize ESP client (SendGrid in this case)
-esp_client = get_esp_client()
+# Bulk per-recipient LLM personalization jobs
+personalization_pipeline = PersonalizationPipeline(redis_client, llm_service, storage_manager)
 
 # Initialize scheduler
-email_scheduler = EmailScheduler()
+email_scheduler = EmailScheduler(redis_client)
 
 auth_manager = GoogleAuthManager()
 
+redis_service = RedisService(redis_client)
+
+# ESP webhook events: queued on arrival, applied by a background consumer
+webhook_ingest = WebhookIngest(redis_client)
+
+# Per-minute and per-hour event counts for the analytics charts
+event_rollups = EventRollups(redis_client)
+
+# Incremental Google Sheets -> recipient data sync
+sheets_sync = SheetsSync(redis_client)
+
+# Read only when /metrics is scraped
+scrape_gauges.register('email_queue', 'Send-batch queue', email_scheduler.batch_queue.get_depth)
+scrape_gauges.register('webhook', 'Webhook ingestion', webhook_ingest.get_lag)
+scrape_gauges.register('websocket', 'Analytics WebSocket fan-out', ws_manager.get_stats)
+scrape_gauges.register('llm_cache', 'LLM response cache', llm_service.get_stats)
+
+# Largest page served by the cursor-paginated listings
+MAX_PAGE_SIZE = 1000
+
+class SheetsSyncRequest(BaseModel):
+    spreadsheet_id: str
+    sheet_name: str = 'Sheet1'
+    key_column: str = 'email'
+    interval_minutes: Optional[int] = None
+    full: bool = False
+
 class EmailRequest(BaseModel):
     prompt_template: str
+    subject: Optional[str] = ''
     schedule_time: Optional[str]
     batch_size: Optional[int] = 50
     interval_minutes: Optional[int] = 60
 
-@app.on_event("startup")
-async def startup_event():
-    """Runs on application startup"""
-    try:
-        # Test Redis connection
-        redis_client.ping()
-        logger.info("Redis connection verified during startup")
-        
-        # Clear any stale data (optional)
-        # redis_client.flushdb()
-    except Exception as e:
-        logger.error(f"Startup check failed: {str(e)}")
-        raise
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Runs on application shutdown"""
-    try:
-        redis_client.close()
-        logger.info("Redis connection closed")
-    except Exception as e:
-        logger.error(f"Error during shutdown: {str(e)}")
-
 @app.post("/generate_email/")
 async def generate_email(prompt_template: str, company: str, location: str, products: str):
     try:
@@ -117,14 +165,14 @@ async def generate_email(prompt_template: str, company: str, location: str, prod
         Make it personalized and professional.
         """
         
-        response = groq_client.chat.completions.create(
+        generated_content = await llm_service.generate(
             messages=[{"role": "user", "content": prompt}],
             model="mixtral-8x7b-32768",
             temperature=0.7,
             max_tokens=1000
         )
         
-        return {"generated_content": response.choices[0].message.content}
+        return {"generated_content": generated_content}
     except Exception as e:
         logger.error(f"Error generating email: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -132,95 +180,97 @@ async def generate_email(prompt_template: str, company: str, location: str, prod
 @app.post("/schedule_emails/")
 async def schedule_emails(request: EmailRequest, background_tasks: BackgroundTasks):
     try:
-        keys = redis_client.keys("email:*")
-        total_emails = len(keys)
-        
         if request.schedule_time:
             schedule_time = datetime.strptime(request.schedule_time, "%Y-%m-%d %H:%M")
         else:
             schedule_time = datetime.now()
-            
-        batch_size = request.batch_size
-        interval_minutes = request.interval_minutes
-        
-        for i in range(0, total_emails, batch_size):
-            batch_keys = keys[i:i + batch_size]
-            batch_time = schedule_time + pd.Timedelta(minutes=interval_minutes * (i // batch_size))
-            
-            for key in batch_keys:
-                email_data = EmailData.parse_obj(redis_client.hgetall(key))
-                email_data.scheduled_time = batch_time.isoformat()
-                email_data.status = 'Scheduled'
-                redis_client.hset(key, mapping=email_data.dict())
-                
-                background_tasks.add_task(
-                    email_scheduler.schedule_email,
-                    email_data,
-                    request.prompt_template,
-                    batch_time
-                )
-        
-        return {
-            "message": "Emails scheduled successfully",
-            "total_scheduled": total_emails,
-            "batches": (total_emails + batch_size - 1) // batch_size
-        }
+
+        return await _start_campaign_scheduling(
+            background_tasks,
+            prompt_template=request.prompt_template,
+            subject=request.subject,
+            schedule_time=schedule_time.isoformat(),
+            batch_size=request.batch_size,
+            interval_minutes=request.interval_minutes
+        )
+    except (TemplateError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error scheduling emails: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _start_campaign_scheduling(background_tasks: BackgroundTasks, **campaign) -> dict:
+    """Record the campaign, then schedule its recipients after the response is sent"""
+    created = await email_scheduler.create_campaign(**campaign)
+    if created['total_records'] == 0:
+        raise ValueError("No emails to schedule.")
+    background_tasks.add_task(email_scheduler.schedule_campaign, created['campaign_id'])
+    return {
+        "message": "Email scheduling started",
+        "campaign_id": created['campaign_id'],
+        "total_scheduled": created['total_records'],
+        "batches": created['batch_count']
+    }
+
 @app.get("/api/analytics")
 async def get_analytics():
     try:
-        keys = redis_client.keys("email:*")
-        analytics = {
-            "total_emails": len(keys),
-            "status_breakdown": {},
-            "delivery_status": {},
-            "scheduled_breakdown": {
-                "past": 0,
-                "upcoming": 0
-            }
-        }
-        
-        now = datetime.now()
-        
-        for key in keys:
-            email_data = EmailData.parse_obj(redis_client.hgetall(key))
-            
-            analytics["status_breakdown"][email_data.status] = \
-                analytics["status_breakdown"].get(email_data.status, 0) + 1
-            
-            analytics["delivery_status"][email_data.delivery_status] = \
-                analytics["delivery_status"].get(email_data.delivery_status, 0) + 1
-            
-            if email_data.scheduled_time:
-                scheduled_time = datetime.fromisoformat(email_data.scheduled_time)
-                if scheduled_time < now:
-                    analytics["scheduled_breakdown"]["past"] += 1
-                else:
-                    analytics["scheduled_breakdown"]["upcoming"] += 1
-        
-        return analytics
+        return await redis_service.get_analytics()
     except Exception as e:
         logger.error(f"Error getting analytics: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/analytics/rebuild")
+async def rebuild_analytics():
+    """Reconcile the analytics counters with the stored email records"""
+    try:
+        return await redis_service.rebuild_analytics()
+    except Exception as e:
+        logger.error(f"Error rebuilding analytics: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analytics/timeseries")
+async def get_analytics_timeseries(start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                   hours: float = Query(24, gt=0), step: Optional[int] = Query(None, ge=60),
+                                   campaign_id: Optional[str] = None, events: Optional[str] = None):
+    """Event counts per step (seconds) from start to end, defaulting to the last `hours` hours.
+
+    events is an optional comma-separated filter, e.g. "sent,delivered,opened".
+    """
+    try:
+        end_ts = end.timestamp() if end else datetime.now().timestamp()
+        start_ts = start.timestamp() if start else end_ts - hours * 3600
+        if start_ts >= end_ts:
+            raise HTTPException(status_code=400, detail="start must be before end")
+        return await event_rollups.query(
+            start_ts, end_ts, step, campaign_id,
+            events=events.split(',') if events else None
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting analytics timeseries: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/analytics/recipient/{email}")
+async def get_recipient_status(email: str):
+    """Resolve a single recipient through the recipient index"""
+    try:
+        status = await redis_service.get_email_status_by_recipient(email)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Recipient not found")
+        return status
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting recipient status: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/esp-webhook/")
-async def esp_webhook(event_data: dict):
+async def esp_webhook(request: Request):
     """Handle ESP webhook events for email tracking"""
     try:
-        email = event_data.get("email")
-        event_type = event_data.get("event")
-        
-        keys = redis_client.keys("email:*")
-        for key in keys:
-            email_data = EmailData.parse_obj(redis_client.hgetall(key))
-            if email_data.email == email:
-                email_data.delivery_status = event_type.capitalize()
-                redis_client.hset(key, mapping=email_data.dict())
-                break
-        
+        await webhook_ingest.append(await request.body(), source='esp')
         return {"message": "Webhook processed successfully"}
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
@@ -231,7 +281,7 @@ async def health_check():
     """Health check endpoint"""
     try:
         # Test Redis connection
-        redis_client.ping()
+        await redis_client.ping()
         return {
             "status": "healthy",
             "redis": "connected",
@@ -244,6 +294,16 @@ async def health_check():
             detail="Service unhealthy"
         )
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics for this process (or every process, in multiprocess mode)"""
+    try:
+        body, content_type = await render_metrics()
+        return Response(content=body, headers={'Content-Type': content_type})
+    except Exception as e:
+        logger.error(f"Error rendering metrics: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/auth/google")
 async def google_auth():
     """Start Google OAuth flow"""
@@ -294,10 +354,44 @@ async def google_sheets_auth():
             detail=str(e)
         )
 
+@app.post("/api/sheets/sync")
+async def sync_google_sheet(request: SheetsSyncRequest):
+    """Sync recipients from a sheet now and, with interval_minutes, keep syncing on that schedule"""
+    try:
+        stats = await sheets_sync.sync(
+            request.spreadsheet_id, request.sheet_name, request.key_column, full=request.full
+        )
+        if request.interval_minutes:
+            await sheets_sync.schedule(
+                request.spreadsheet_id, request.sheet_name, request.key_column, request.interval_minutes * 60
+            )
+        return {"success": True, **stats}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error syncing Google Sheet: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/sheets/sync")
+async def get_sheet_sync_schedule():
+    try:
+        return {"schedule": await sheets_sync.get_schedule()}
+    except Exception as e:
+        logger.error(f"Error getting sheet sync schedule: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/api/sheets/sync")
+async def stop_sheet_sync():
+    try:
+        await sheets_sync.unschedule()
+        return {"success": True}
+    except Exception as e:
+        logger.error(f"Error stopping sheet sync: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/get_csv_fields")
 async def get_csv_fields():
     try:
-        storage_manager = StorageManager()
         fields = await storage_manager.get_csv_fields()
         return {"fields": fields}
     except Exception as e:
@@ -310,71 +404,105 @@ async def schedule_emails(
     email_data: EmailData
 ):
     try:
-        keys = redis_client.keys("email:*")
-        total_emails = len(keys)
-        
-        logger.info(f"Total emails to schedule: {total_emails}")
-        
-        if total_emails == 0:
-            raise HTTPException(status_code=400, detail="No emails to schedule.")
-
         if email_data.schedule_time:
             schedule_time = datetime.strptime(email_data.schedule_time, "%Y-%m-%d %H:%M")
         else:
             schedule_time = datetime.now()
-        
-        batch_size = email_data.batch_size
-        interval_minutes = email_data.interval_minutes
-        
-        for i in range(0, total_emails, batch_size):
-            batch_keys = keys[i:i + batch_size]
-            logger.info(f"Processing batch: {batch_keys}")
-            
-            if not batch_keys:
-                logger.warning("No keys found for the current batch.")
-                continue
-            
-            batch_time = schedule_time + pd.Timedelta(minutes=interval_minutes * (i // batch_size))
-            
-            for key in batch_keys:
-                email_data = EmailData.parse_obj(redis_client.hgetall(key))
-                email_data.scheduled_time = batch_time.isoformat()
-                email_data.status = 'Scheduled'
-                redis_client.hset(key, mapping=email_data.dict())
-                
-                background_tasks.add_task(
-                    email_scheduler.schedule_email,
-                    email_data,
-                    email_data.prompt_template,
-                    batch_time
-                )
-        
-        return {
-            "message": "Emails scheduled successfully",
-            "total_scheduled": total_emails,
-            "batches": (total_emails + batch_size - 1) // batch_size
-        }
+
+        # Validation runs now; per-recipient work happens in the background
+        return await _start_campaign_scheduling(
+            background_tasks,
+            prompt_template=email_data.prompt_template,
+            subject=email_data.subject,
+            schedule_time=schedule_time.isoformat(),
+            batch_size=email_data.batch_size,
+            interval_minutes=email_data.interval_minutes,
+            bulk=email_data.bulk_send,
+            throttle_rate=email_data.throttle_rate,
+            rate_limit=email_data.rate_limit
+        )
+    except (TemplateError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error scheduling emails: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/schedule_emails/{campaign_id}/progress")
+async def get_scheduling_progress(campaign_id: str):
+    try:
+        progress = await email_scheduler.get_scheduling_progress(campaign_id)
+        if progress is None:
+            raise HTTPException(status_code=404, detail="Campaign not found")
+        return progress
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting scheduling progress: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/campaigns")
+async def list_campaigns(start: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE)):
+    """Newest campaigns first"""
+    try:
+        return {"campaigns": await email_scheduler.campaign_store.list(start, limit)}
+    except Exception as e:
+        logger.error(f"Error listing campaigns: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/campaigns/{campaign_id}")
+async def get_campaign(campaign_id: str):
+    """Campaign config, progress and its own status counters"""
+    try:
+        campaign = await email_scheduler.campaign_store.get(campaign_id)
+        if campaign is None:
+            raise HTTPException(status_code=404, detail="Campaign not found")
+        return campaign
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting campaign: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/campaigns/{campaign_id}/recipients")
+async def get_campaign_recipients(campaign_id: str, cursor: int = 0,
+                                  limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    """One page of the campaign's recipients; pass next_cursor back until it is null"""
+    try:
+        next_cursor, recipients = await email_scheduler.campaign_store.list_recipients(campaign_id, cursor, limit)
+        return {"recipients": recipients, "next_cursor": next_cursor or None}
+    except Exception as e:
+        logger.error(f"Error listing campaign recipients: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/campaigns/{campaign_id}/archive")
+async def archive_campaign(campaign_id: str):
+    """Archive now instead of waiting for the post-completion grace period"""
+    try:
+        return await email_scheduler.campaign_store.archive(campaign_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error archiving campaign: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/api/generate_email")
 async def generate_email(request: dict):
     try:
-        # Initialize Groq client
-        groq_client = groq.Groq(api_key=os.getenv("GROQ_API_KEY"))
-        
         # Replace placeholders with sample data
-        template = request["prompt_template"]
-        for key, value in request.items():
-            if key != "prompt_template":
-                template = template.replace(f"{{{key}}}", value)
+        sample_data = {
+            key: value for key, value in request.items()
+            if key != "prompt_template" and isinstance(value, str)
+        }
+        sample_data.update(request.get("sample_data") or {})
+        template = compile_template(request["prompt_template"]).render(sample_data)
         
-        # Generate content using Groq
-        response = await groq_client.chat.completions.create(
+        # Generate content using Groq (served from cache for repeated prompts)
+        generated_content = await llm_service.generate(
             messages=[{
                 "role": "system",
-                "content": "You are an email content generator. Generate professional email content based on the template."
+                "content": EMAIL_SYSTEM_PROMPT
             }, {
                 "role": "user",
                 "content": template
@@ -383,80 +511,135 @@ async def generate_email(request: dict):
             temperature=0.7,
         )
         
-        generated_content = response.choices[0].message.content
         return {"generated_content": generated_content}
     except Exception as e:
         logger.error(f"Error generating email: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/generate_email/cache_stats")
+async def generate_email_cache_stats():
+    """LLM cache hit/miss counters for this process"""
+    return llm_service.get_stats()
+
+class PersonalizeRequest(BaseModel):
+    prompt_template: str
+    max_tokens: int = 500
+    job_id: Optional[str] = None
+
+@app.post("/api/personalize")
+async def start_personalization(request: PersonalizeRequest):
+    """Start (or resume, when job_id is given) LLM personalization of every CSV row"""
+    try:
+        job_id = await personalization_pipeline.start(
+            request.prompt_template, max_tokens=request.max_tokens, job_id=request.job_id
+        )
+        return {"job_id": job_id}
+    except TemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error starting personalization: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/personalize/{job_id}")
+async def get_personalization_progress(job_id: str):
+    progress = await personalization_pipeline.get_progress(job_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Personalization job not found")
+    return progress
+
+@app.get("/api/personalize/{job_id}/results")
+async def get_personalization_results(job_id: str, start: int = 0, count: int = 50):
+    return {"results": await personalization_pipeline.get_results(job_id, start, min(count, 500))}
+
 @app.post("/webhook/email-events")
 async def handle_email_events(request: Request):
+    """Queue a SendGrid event batch and return immediately; see WebhookIngest"""
     try:
-        payload = await request.json()
-        redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
-        
-        for event in payload:
-            tracking_id = event.get('tracking_id')
-            if tracking_id:
-                key = f"email:{tracking_id}"
-                current_status = event.get('event')
-                
-                if current_status in ['delivered', 'opened', 'bounced', 'dropped']:
-                    redis_client.hset(key, 'delivery_status', current_status)
-                    
-                # Broadcast update through WebSocket
-                await broadcast_analytics_update()
-        
+        await webhook_ingest.append(await request.body())
         return {"status": "success"}
     except Exception as e:
         logger.error(f"Error processing webhook: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-async def broadcast_analytics_update():
+@app.get("/webhook/lag")
+async def get_webhook_lag():
+    """Webhook ingestion backlog and lag"""
     try:
-        analytics = await get_analytics()
-        for connection in active_connections:
-            await connection.send_json(analytics)
+        return await webhook_ingest.get_lag()
     except Exception as e:
-        logger.error(f"Error broadcasting update: {str(e)}")
+        logger.error(f"Error getting webhook lag: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-active_connections: List[WebSocket] = []
+async def broadcast_analytics_update():
+    """Announce an analytics change to every API process; never waits on clients"""
+    try:
+        await redis_client.publish(ANALYTICS_CHANNEL, 'analytics')
+    except Exception as e:
+        logger.error(f"Error publishing analytics update: {str(e)}")
+        # Still refresh dashboards attached to this process
+        ws_manager.notify()
 
 @app.websocket("/ws/analytics")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    active_connections.append(websocket)
+    await ws_manager.connect(websocket)
     try:
         while True:
+            # Any message from the client requests a full snapshot
             await websocket.receive_text()
-            analytics = await get_analytics()
-            await websocket.send_json(analytics)
+            await ws_manager.resync(websocket)
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         logger.error(f"WebSocket error: {str(e)}")
     finally:
-        active_connections.remove(websocket)
-from io import StringIO
+        ws_manager.disconnect(websocket)
 
 @app.post("/api/upload_csv")
-async def upload_csv(file: UploadFile = File(...)):
+async def upload_csv(file: UploadFile = File(...), upload_id: Optional[str] = None):
     try:
-        contents = await file.read()
-        df = pd.read_csv(StringIO(contents.decode('utf-8')))
-        
-        # Store CSV data in Redis
-        redis_client.set('current_csv_data', contents.decode('utf-8'))  # Store as string
-        
-        return CSVUploadResponse(
-            message=f"Successfully saved {len(df)} records",
-            fields=list(df.columns),
-            total_records=len(df)
-        )
-    except pd.errors.EmptyDataError:
-        raise HTTPException(status_code=400, detail="CSV file is empty")
+        async def chunks():
+            while True:
+                chunk = await file.read(INGEST_READ_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+        # Parse and store rows chunk by chunk instead of loading the whole file
+        result = await storage_manager.ingest_csv_stream(chunks(), upload_id)
+        return _upload_response(result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error uploading CSV: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/upload_csv/stream")
+async def upload_csv_stream(request: Request, upload_id: Optional[str] = None):
+    """Ingest a raw text/csv request body while it is still arriving"""
+    try:
+        result = await storage_manager.ingest_csv_stream(request.stream(), upload_id)
+        return _upload_response(result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error uploading CSV: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.get("/api/upload_csv/{upload_id}/progress")
+async def get_upload_progress(upload_id: str):
+    progress = await storage_manager.get_upload_progress(upload_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return progress
+
+def _upload_response(result: dict) -> CSVUploadResponse:
+    return CSVUploadResponse(
+        message=f"Successfully saved {result['total_records']} records",
+        fields=result['fields'],
+        total_records=result['total_records'],
+        upload_id=result['upload_id']
+    )
+
 @app.post("/api/store_email")
 async def store_email(email_data: dict):
     try:
@@ -465,7 +648,10 @@ async def store_email(email_data: dict):
             raise HTTPException(status_code=400, detail="Email is required")
 
         # Store email in Redis
-        redis_client.hset(f"email:{email}", mapping={"status": "connected", "delivery_status": "pending"})
+        await redis_service.store_email_status(
+            email,
+            {"to_email": email, "status": "connected", "delivery_status": "pending"}
+        )
         
         return {"message": "Email stored successfully"}
     except Exception as e:
@@ -473,35 +659,47 @@ async def store_email(email_data: dict):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/get_user_emails")
-async def get_user_emails():
+async def get_user_emails(cursor: int = 0, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    """One page of recipient addresses; pass next_cursor back until it is null"""
     try:
-        # Retrieve all keys matching the email pattern
-        keys = redis_client.keys("email:*")
-        emails = []
-
-        for key in keys:
-            # Extract the email from the key
-            email = key.split(":")[1]  # Assuming keys are in the format "email:<email>"
-            emails.append(email)
-
-        return {"emails": emails}
+        next_cursor, page = await redis_service.list_recipients(cursor, limit)
+        return {
+            "emails": [recipient['email'] for recipient in page],
+            "next_cursor": next_cursor or None
+        }
     except Exception as e:
         logger.error(f"Error retrieving user emails: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/get_user_emails/export")
+async def export_user_emails():
+    """Stream every recipient as NDJSON, one SCAN page at a time"""
+    async def lines():
+        async for page in redis_service.iter_recipients(MAX_PAGE_SIZE):
+            yield ''.join(json.dumps(recipient) + '\n' for recipient in page)
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=recipients.ndjson"}
+    )
+
 @app.get("/api/get_csv_preview")
 async def get_csv_preview():
     try:
-        csv_data = redis_client.get('current_csv_data')
-        if not csv_data:
+        preview = await storage_manager.get_csv_preview()  # First few rows only
+        if not preview:
             raise HTTPException(status_code=404, detail="No CSV data found.")
         
-        df = pd.read_csv(StringIO(csv_data))  # Convert string back to DataFrame
-        preview = df.head().to_dict(orient='records')  # Get the first few rows as a preview
         return {"preview": preview}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error getting CSV preview: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
\ No newline at end of file
+    import uvicorn
+    # Dashboards on any worker receive updates through Redis pub/sub
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, log_level="info",
+                workers=int(os.getenv('API_WORKERS', 1)))
\ No newline at end of file
@@ -0,0 +1,45 @@
+"""Maintenance commands for the email sender backend.
+
+Usage:
+    python manage.py rebuild-analytics
+    python manage.py rebuild-index
+"""
+import argparse
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+from utils.redis_utils import RedisService
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def rebuild_analytics(args):
+    analytics = await RedisService().rebuild_analytics(batch_size=args.batch_size)
+    logger.info(f"Analytics counters reconciled: {analytics}")
+
+
+async def rebuild_index(args):
+    indexed = await RedisService().rebuild_recipient_index(batch_size=args.batch_size)
+    logger.info(f"Recipient index rebuilt for {indexed} email records")
+
+
+COMMANDS = {
+    'rebuild-analytics': rebuild_analytics,
+    'rebuild-index': rebuild_index,
+}
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(COMMANDS[args.command](args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 class CSVUploadResponse(BaseModel):
     message: str
     fields: List[str]
-    total_records: int 
\ No newline at end of file
+    total_records: int
+    upload_id: Optional[str] = None
\ No newline at end of file
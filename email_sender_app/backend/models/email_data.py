@@ -8,7 +8,9 @@ class EmailData(BaseModel):
     schedule_time: Optional[str]
     batch_size: int = 50
     interval_minutes: int = 60
-    throttle_rate: str = 'hourly'
+    throttle_rate: str = 'hourly'  # period for rate_limit, or a full rate such as '100/minute'
+    rate_limit: Optional[int] = None  # sends per throttle_rate period; None keeps batch/interval pacing
+    bulk_send: bool = False
 
 class EmailStatus(BaseModel):
     tracking_id: str
@@ -0,0 +1,330 @@
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import msgpack
+import redis.asyncio as aioredis
+
+from .redis_pool import create_redis
+from .redis_utils import (CAMPAIGN_INDEX_KEY, DELIVERY_COUNTERS_KEY, RECIPIENT_INDEX_KEY, SCHEDULED_KEY,
+                          STATUS_COUNTERS_KEY, TOTAL_KEY, _decode, campaign_delivery_key, campaign_key,
+                          campaign_members_key, campaign_status_key, email_key)
+
+logger = logging.getLogger(__name__)
+
+CAMPAIGNS_KEY = 'campaigns'                          # zset campaign_id -> created epoch
+ARCHIVE_DUE_KEY = 'campaigns:archive_due'            # zset campaign_id -> epoch to archive at
+
+# Late webhook events (opens, clicks) keep arriving after the last send
+ARCHIVE_AFTER_SECONDS = int(os.getenv('CAMPAIGN_ARCHIVE_AFTER_SECONDS', 3 * 86400))
+# An archiving run that has not finished after this long is presumed dead and may be retaken
+ARCHIVE_CLAIM_SECONDS = int(os.getenv('CAMPAIGN_ARCHIVE_CLAIM_SECONDS', 3600))
+# A failed archiving run is queued again this much later
+ARCHIVE_RETRY_SECONDS = int(os.getenv('CAMPAIGN_ARCHIVE_RETRY_SECONDS', 300))
+# Archived summaries and counters expire after this long (0 keeps them)
+ARCHIVE_TTL_SECONDS = int(os.getenv('CAMPAIGN_ARCHIVE_TTL_SECONDS', 90 * 86400))
+ARCHIVE_CHUNK_SIZE = 1000
+
+ARCHIVE_FIELDS = ['to_email', 'status', 'delivery_status', 'scheduled_time', 'sent_time']
+COUNT_FIELDS = ['batch_size', 'interval_minutes', 'total_records', 'batch_count', 'recipients_scheduled',
+                'batches_enqueued', 'batches_sent', 'total_recipients', 'archived_recipients']
+
+
+def campaign_archive_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}:archive"
+
+
+def campaign_archive_staging_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}:archive:staging"
+
+
+def campaign_sent_batches_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}:sent_batches"
+
+
+# KEYS: campaign hash, archive-due zset, sent-batch set
+# ARGV: job_id of the batch just sent ('' to only check), now epoch, archive-at epoch, campaign_id
+# Idempotent per batch, so redelivered batches can report again. Marks the campaign
+# completed once every enqueued batch has been sent; returns 1 if it just completed
+BATCH_SENT_SCRIPT = """
+if ARGV[1] ~= '' then
+    redis.call('SADD', KEYS[3], ARGV[1])
+end
+local sent = redis.call('SCARD', KEYS[3])
+redis.call('HSET', KEYS[1], 'batches_sent', sent)
+local state = redis.call('HMGET', KEYS[1], 'scheduling_status', 'batch_count', 'state')
+if state[1] == 'scheduled' and sent >= tonumber(state[2]) and not state[3] then
+    redis.call('HSET', KEYS[1], 'state', 'completed', 'completed_at', ARGV[2])
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[4])
+    return 1
+end
+return 0
+"""
+
+# KEYS: campaign hash; ARGV: now epoch, claim timeout seconds
+# Moves a completed campaign (or one whose archiving run went stale) to 'archiving'.
+# Returns 'claimed', or the state that prevented it
+ARCHIVE_CLAIM_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'state', 'archiving_at')
+local stale = state[1] == 'archiving' and tonumber(ARGV[1]) - tonumber(state[2] or 0) > tonumber(ARGV[2])
+if state[1] ~= 'completed' and not stale then
+    return state[1] or 'active'
+end
+redis.call('HSET', KEYS[1], 'state', 'archiving', 'archiving_at', ARGV[1])
+return 'claimed'
+"""
+
+# KEYS: status counters, delivery counters, scheduled zset, total, campaign index,
+#       recipient index, then the email hash of every archived recipient
+# ARGV: tracking_id, email, ... in the same order as the hashes
+# Removes the recipients from the live data and takes them off the global counters
+# in the same step, so those keep matching rebuild_analytics. Safe to run again
+ARCHIVE_RECIPIENTS_SCRIPT = """
+for i = 7, #KEYS do
+    local tracking_id = ARGV[(i - 7) * 2 + 1]
+    local email = ARGV[(i - 7) * 2 + 2]
+    local record = redis.call('HMGET', KEYS[i], 'status', 'delivery_status')
+    if redis.call('DEL', KEYS[i]) == 1 then
+        if record[1] then redis.call('HINCRBY', KEYS[1], record[1], -1) end
+        if record[2] then redis.call('HINCRBY', KEYS[2], record[2], -1) end
+        redis.call('DECR', KEYS[4])
+    end
+    redis.call('ZREM', KEYS[3], tracking_id)
+    redis.call('HDEL', KEYS[5], tracking_id)
+    if email ~= '' and redis.call('HGET', KEYS[6], email) == tracking_id then
+        redis.call('HDEL', KEYS[6], email)
+    end
+end
+return 0
+"""
+
+
+class CampaignStore:
+    """Campaign entities: config, member set and counters, archived once complete.
+
+    Each recipient status write also maintains its campaign's member set and
+    status/delivery counters (see UPDATE_STATUS_SCRIPT), so campaign
+    analytics and listings cost O(campaign) however many campaigns exist.
+
+    When the last batch is sent the campaign is completed and queued for
+    archiving ARCHIVE_AFTER_SECONDS later. Archiving packs every recipient's
+    final status into msgpack column chunks and deletes the per-recipient
+    hashes. Global analytics cover live (not yet archived) recipients only:
+    archived ones are taken off the counters as their hashes are deleted,
+    and their final statuses stay in the campaign's own counters.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None):
+        self.redis_client = redis_client or create_redis()
+        self.batch_sent_script = self.redis_client.register_script(BATCH_SENT_SCRIPT)
+        self.archive_claim_script = self.redis_client.register_script(ARCHIVE_CLAIM_SCRIPT)
+        self.archive_recipients_script = self.redis_client.register_script(ARCHIVE_RECIPIENTS_SCRIPT)
+
+    async def create(self, campaign_id: str, config: Dict[str, Any]):
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.hset(campaign_key(campaign_id), mapping=config)
+        pipe.zadd(CAMPAIGNS_KEY, {campaign_id: time.time()})
+        await pipe.execute()
+
+    async def record_batch_sent(self, campaign_id: str, job_id: Optional[str] = None) -> bool:
+        """Record a sent batch (or, without job_id, just check); True when this completed the campaign"""
+        now = time.time()
+        return bool(await self.batch_sent_script(
+            keys=[campaign_key(campaign_id), ARCHIVE_DUE_KEY, campaign_sent_batches_key(campaign_id)],
+            args=[job_id or '', now, now + ARCHIVE_AFTER_SECONDS, campaign_id]
+        ))
+
+    async def get(self, campaign_id: str) -> Optional[Dict[str, Any]]:
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hgetall(campaign_key(campaign_id))
+        pipe.scard(campaign_members_key(campaign_id))
+        pipe.hgetall(campaign_status_key(campaign_id))
+        pipe.hgetall(campaign_delivery_key(campaign_id))
+        config, members, statuses, deliveries = await pipe.execute()
+        if not config:
+            return None
+        campaign = {_decode(k): _decode(v) for k, v in config.items()}
+        for field in COUNT_FIELDS:
+            if field in campaign:
+                campaign[field] = int(campaign[field])
+        campaign['campaign_id'] = campaign_id
+        campaign['state'] = campaign.get('state', 'active')
+        if campaign['state'] != 'archived':
+            campaign['total_recipients'] = members
+        campaign['status_breakdown'] = {_decode(k): int(v) for k, v in statuses.items() if int(v) > 0}
+        campaign['delivery_status'] = {_decode(k): int(v) for k, v in deliveries.items() if int(v) > 0}
+        return campaign
+
+    async def list(self, start: int = 0, count: int = 50) -> List[Dict[str, Any]]:
+        """Newest campaigns first, without their counters"""
+        ids = [_decode(i) for i in await self.redis_client.zrevrange(CAMPAIGNS_KEY, start, start + count - 1)]
+        pipe = self.redis_client.pipeline(transaction=False)
+        for campaign_id in ids:
+            pipe.hmget(campaign_key(campaign_id), 'subject', 'created_at', 'scheduling_status',
+                       'state', 'total_records', 'batches_sent', 'batch_count')
+        campaigns = []
+        for campaign_id, values in zip(ids, await pipe.execute()):
+            subject, created_at, scheduling_status, state, total, sent, batch_count = [_decode(v) for v in values]
+            if created_at is None:
+                continue
+            campaigns.append({
+                'campaign_id': campaign_id,
+                'subject': subject,
+                'created_at': created_at,
+                'scheduling_status': scheduling_status,
+                'state': state or 'active',
+                'total_records': int(total or 0),
+                'batches_sent': int(sent or 0),
+                'batch_count': int(batch_count or 0)
+            })
+        return campaigns
+
+    async def list_recipients(self, campaign_id: str, cursor: int = 0,
+                              count: int = 100) -> Tuple[int, List[Dict[str, Any]]]:
+        """One page of recipients with their statuses; a returned cursor of 0 ends the listing.
+
+        Active campaigns page through the member set with SSCAN; archived ones
+        page through archive chunks, the cursor being the next chunk index.
+        """
+        if await self.redis_client.hget(campaign_key(campaign_id), 'state') == b'archived':
+            packed = await self.redis_client.hget(campaign_archive_key(campaign_id), cursor)
+            if packed is None:
+                return 0, []
+            columns = msgpack.unpackb(packed, raw=False)
+            rows = [dict(zip(['tracking_id'] + ARCHIVE_FIELDS, values)) for values in zip(*columns)]
+            more = await self.redis_client.hexists(campaign_archive_key(campaign_id), cursor + 1)
+            return (cursor + 1 if more else 0), rows
+
+        cursor, members = await self.redis_client.sscan(campaign_members_key(campaign_id), cursor=cursor, count=count)
+        tracking_ids = [_decode(m) for m in members]
+        return cursor, await self._read_recipients(tracking_ids)
+
+    async def _read_recipients(self, tracking_ids: List[str]) -> List[Dict[str, Any]]:
+        pipe = self.redis_client.pipeline(transaction=False)
+        for tracking_id in tracking_ids:
+            pipe.hmget(email_key(tracking_id), ARCHIVE_FIELDS)
+        return [
+            {'tracking_id': tracking_id, **dict(zip(ARCHIVE_FIELDS, [_decode(v) for v in values]))}
+            for tracking_id, values in zip(tracking_ids, await pipe.execute())
+        ]
+
+    async def archive_due(self, limit: int = 1) -> List[str]:
+        """Archive campaigns whose grace period has passed; safe to run from every worker"""
+        archived = []
+        due = await self.redis_client.zrangebyscore(ARCHIVE_DUE_KEY, '-inf', time.time(), start=0, num=limit)
+        for campaign_id in (_decode(c) for c in due):
+            # Whoever removes the entry owns the archiving
+            if await self.redis_client.zrem(ARCHIVE_DUE_KEY, campaign_id):
+                await self.archive(campaign_id)
+                archived.append(campaign_id)
+        return archived
+
+    async def archive(self, campaign_id: str) -> Dict[str, Any]:
+        """Pack recipient statuses into compact chunks and release the per-recipient data.
+
+        Only completed campaigns can be archived (ValueError otherwise).
+        Archiving an archived campaign again finishes releasing its recipients
+        if an earlier run was interrupted, and returns the same summary.
+        """
+        key = campaign_key(campaign_id)
+        try:
+            if not await self.redis_client.exists(key):
+                raise KeyError(f"Campaign {campaign_id} not found")
+            claim = _decode(await self.archive_claim_script(keys=[key], args=[time.time(), ARCHIVE_CLAIM_SECONDS]))
+            if claim == 'archived':
+                await self._release_recipients(campaign_id)
+                archived = await self.redis_client.hget(key, 'archived_recipients')
+                chunks = await self.redis_client.hlen(campaign_archive_key(campaign_id))
+                return {'campaign_id': campaign_id, 'archived_recipients': int(archived or 0), 'chunks': chunks}
+            if claim != 'claimed':
+                raise ValueError(f"Campaign {campaign_id} is {claim}; only completed campaigns can be archived")
+        except Exception as e:
+            logger.error(f"Error archiving campaign {campaign_id}: {str(e)}")
+            raise
+
+        try:
+            summary = await self._write_archive(campaign_id)
+        except Exception as e:
+            logger.error(f"Error archiving campaign {campaign_id}: {str(e)}")
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.hset(key, 'state', 'completed')
+            pipe.zadd(ARCHIVE_DUE_KEY, {campaign_id: time.time() + ARCHIVE_RETRY_SECONDS})
+            await pipe.execute()
+            raise
+
+        try:
+            await self._release_recipients(campaign_id)
+        except Exception as e:
+            logger.error(f"Error releasing archived campaign {campaign_id}: {str(e)}")
+            await self.redis_client.zadd(ARCHIVE_DUE_KEY, {campaign_id: time.time() + ARCHIVE_RETRY_SECONDS})
+            raise
+        logger.info(f"Archived campaign {campaign_id}: {summary['archived_recipients']} recipients "
+                    f"in {summary['chunks']} chunks")
+        return summary
+
+    async def _write_archive(self, campaign_id: str) -> Dict[str, Any]:
+        """Write the chunks aside, then swap them in and mark the campaign archived in one step"""
+        staging_key = campaign_archive_staging_key(campaign_id)
+        await self.redis_client.delete(staging_key)
+
+        total = 0
+        chunk_index = 0
+        buffer: List[Dict[str, Any]] = []
+        cursor = 0
+        while True:
+            cursor, members = await self.redis_client.sscan(
+                campaign_members_key(campaign_id), cursor=cursor, count=ARCHIVE_CHUNK_SIZE
+            )
+            buffer.extend(await self._read_recipients([_decode(m) for m in members]))
+            while len(buffer) >= ARCHIVE_CHUNK_SIZE or (cursor == 0 and buffer):
+                chunk, buffer = buffer[:ARCHIVE_CHUNK_SIZE], buffer[ARCHIVE_CHUNK_SIZE:]
+                columns = [[row[field] for row in chunk] for field in ['tracking_id'] + ARCHIVE_FIELDS]
+                await self.redis_client.hset(staging_key, chunk_index, msgpack.packb(columns, use_bin_type=True))
+                total += len(chunk)
+                chunk_index += 1
+            if cursor == 0:
+                break
+
+        key = campaign_key(campaign_id)
+        archive_key = campaign_archive_key(campaign_id)
+        pipe = self.redis_client.pipeline(transaction=True)
+        if chunk_index:
+            pipe.rename(staging_key, archive_key)
+        else:
+            pipe.delete(archive_key)
+        pipe.hset(key, mapping={
+            'state': 'archived',
+            'archived_at': time.time(),
+            'archived_recipients': total,
+            'total_recipients': total
+        })
+        pipe.hdel(key, 'archiving_at')
+        if ARCHIVE_TTL_SECONDS:
+            for expiring in (key, archive_key, campaign_status_key(campaign_id),
+                             campaign_delivery_key(campaign_id)):
+                pipe.expire(expiring, ARCHIVE_TTL_SECONDS)
+        pipe.zrem(ARCHIVE_DUE_KEY, campaign_id)
+        await pipe.execute()
+        return {'campaign_id': campaign_id, 'archived_recipients': total, 'chunks': chunk_index}
+
+    async def _release_recipients(self, campaign_id: str):
+        """Delete the archived recipients' hashes and index entries; the member set goes last"""
+        members_key = campaign_members_key(campaign_id)
+        cursor = 0
+        while True:
+            cursor, members = await self.redis_client.sscan(members_key, cursor=cursor, count=ARCHIVE_CHUNK_SIZE)
+            tracking_ids = [_decode(m) for m in members]
+            if tracking_ids:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for tracking_id in tracking_ids:
+                    pipe.hget(email_key(tracking_id), 'to_email')
+                emails = [_decode(e) or '' for e in await pipe.execute()]
+                await self.archive_recipients_script(
+                    keys=[STATUS_COUNTERS_KEY, DELIVERY_COUNTERS_KEY, SCHEDULED_KEY, TOTAL_KEY,
+                          CAMPAIGN_INDEX_KEY, RECIPIENT_INDEX_KEY] + [email_key(t) for t in tracking_ids],
+                    args=[value for pair in zip(tracking_ids, emails) for value in pair]
+                )
+            if cursor == 0:
+                break
+        await self.redis_client.delete(members_key, campaign_sent_batches_key(campaign_id))
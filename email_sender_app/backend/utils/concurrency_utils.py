@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date)"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on in-flight requests, tuned from the responses themselves.
+
+    Like TCP, the limit starts in slow start, growing by increase per fast,
+    successful response (doubling every round trip) until the first sign of
+    congestion. From then on every such response raises it by about one per
+    round trip (increase / limit per response). A throttled response, or
+    one slower than the latency target, multiplies it by decrease, at most
+    once per round trip: responses to requests started before the last
+    decrease do not count again. The latency target is latency_target
+    seconds if set, otherwise latency_tolerance times the fastest recent
+    response. pause() holds back every new request, e.g. for a Retry-After.
+    """
+
+    def __init__(self, initial: Optional[int] = None, minimum: int = 1, maximum: int = 100,
+                 latency_target: Optional[float] = None, latency_tolerance: float = 2.0,
+                 latency_floor: float = 0.05, increase: float = 1.0, decrease: float = 0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial or int(os.getenv('ESP_INITIAL_CONCURRENCY', 10)), minimum), maximum))
+        self.latency_target = latency_target
+        self.latency_tolerance = latency_tolerance
+        self.latency_floor = latency_floor
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self.slow_start = True
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._recent_latencies = deque(maxlen=200)
+        self._changed: Optional[asyncio.Condition] = None
+
+    @property
+    def changed(self) -> asyncio.Condition:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def congestion_threshold(self) -> float:
+        if self.latency_target:
+            return self.latency_target
+        baseline = min(self._recent_latencies, default=0.0)
+        return max(baseline * self.latency_tolerance, self.latency_floor)
+
+    async def acquire(self) -> float:
+        """Wait for a free slot (and the end of any pause); returns the request start time"""
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            async with self.changed:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return time.monotonic()
+                await self.changed.wait()
+
+    async def release(self, started: float, outcome: str):
+        """Return a slot; outcome is 'ok', 'throttled', 'error' or 'skipped' (never sent)"""
+        now = time.monotonic()
+        latency = now - started
+        if outcome == 'ok':
+            congested = latency > self.congestion_threshold()
+            self._recent_latencies.append(latency)
+        else:
+            congested = outcome == 'throttled'
+
+        if congested:
+            self.slow_start = False
+            if started >= self._last_decrease:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._last_decrease = now
+        elif outcome == 'ok':
+            step = self.increase if self.slow_start else self.increase / self.limit
+            self.limit = min(self.maximum, self.limit + step)
+
+        async with self.changed:
+            self.in_flight -= 1
+            # Wake only as many waiters as there are free slots
+            self.changed.notify(max(int(self.limit) - self.in_flight, 0))
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"Circuit open, retry in {retry_after:.1f}s")
+
+
+class CircuitBreaker:
+    """Fail fast while a dependency is down.
+
+    Opens after failure_threshold consecutive failures. Once open, calls are
+    refused until reset_timeout has passed; then a single probe is let
+    through, which closes the breaker on success or reopens it on failure.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold: Optional[int] = None, reset_timeout: Optional[float] = None):
+        self.failure_threshold = failure_threshold or int(os.getenv('ESP_BREAKER_FAILURES', 10))
+        self.reset_timeout = reset_timeout or float(os.getenv('ESP_BREAKER_RESET_SECONDS', 30))
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def retry_in(self) -> float:
+        """Seconds until the breaker lets a probe through (0 when closed)"""
+        if self.state == self.CLOSED:
+            return 0.0
+        return max(self.opened_at + self.reset_timeout - time.monotonic(), 0.0)
+
+    def is_open(self) -> bool:
+        """Whether calls are currently refused, without claiming the probe"""
+        return self.state == self.OPEN and self.retry_in() > 0
+
+    def would_allow(self) -> bool:
+        """Whether allow() would currently admit a call, without claiming the probe"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return self.retry_in() == 0
+        return not self._probing
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.retry_in() == 0:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def abandon(self):
+        """Give back an admitted call that was never made, so another can probe"""
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Circuit closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            logger.error(f"Circuit opened after {self.failures} consecutive failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
@@ -1,24 +1,31 @@
 # utils/email_utils.py
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
 import os
-from typing import Optional
+from typing import TYPE_CHECKING, Dict, List, Optional
 import logging
+from .template_utils import compile_template
+
+if TYPE_CHECKING:
+    from sendgrid import SendGridAPIClient
 
 logger = logging.getLogger(__name__)
 
+# SendGrid v3 accepts at most 1000 personalizations per mail/send request
+MAX_PERSONALIZATIONS = 1000
+
 def get_esp_client():
     """Initialize and return SendGrid client"""
+    from sendgrid import SendGridAPIClient
     return SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
 
 async def send_email(
     to_email: str,
     subject: str,
     content: str,
-    esp_client: SendGridAPIClient,
+    esp_client: 'SendGridAPIClient',
     tracking_id: Optional[str] = None
 ):
     """Send email using SendGrid with tracking"""
+    from sendgrid.helpers.mail import Mail
     try:
         message = Mail(
             from_email=os.getenv('FROM_EMAIL'),
@@ -50,3 +57,42 @@ async def send_email(
             'error': str(e)
         }
 
+def build_bulk_payloads(
+    recipients: List[Dict],
+    subject: str,
+    content: str,
+    from_email: str,
+    max_personalizations: int = MAX_PERSONALIZATIONS
+) -> List[Dict]:
+    """Pack recipients into as few v3 mail/send bodies as possible.
+
+    Each recipient dict needs 'to_email', 'tracking_id' and the CSV row under
+    'row'. The {field} placeholders in subject and content are left in place
+    and filled per personalization through SendGrid substitutions.
+    """
+    placeholders = set(compile_template(subject).placeholders) | set(compile_template(content).placeholders)
+
+    payloads = []
+    for start in range(0, len(recipients), max_personalizations):
+        personalizations = []
+        for recipient in recipients[start:start + max_personalizations]:
+            row = recipient.get('row', {})
+            personalizations.append({
+                'to': [{'email': recipient['to_email']}],
+                'substitutions': {
+                    f"{{{field}}}": str(row.get(field, '')) for field in placeholders
+                },
+                'custom_args': {'tracking_id': recipient['tracking_id']}
+            })
+        payloads.append({
+            'personalizations': personalizations,
+            'from': {'email': from_email},
+            'subject': subject,
+            'content': [{'type': 'text/html', 'value': content}],
+            'tracking_settings': {
+                'click_tracking': {'enable': True},
+                'open_tracking': {'enable': True}
+            }
+        })
+    return payloads
+
@@ -1,39 +1,266 @@
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Content
+import asyncio
+import json
 import os
-from typing import Dict, List
+import re
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Tuple
 import logging
+from .concurrency_utils import AdaptiveConcurrency, CircuitBreaker, CircuitOpenError, parse_retry_after
+from .email_utils import build_bulk_payloads, get_esp_client, MAX_PERSONALIZATIONS
+from .metrics import record_esp_flow, record_esp_request, record_esp_results
+
+if TYPE_CHECKING:
+    import aiohttp
 
 logger = logging.getLogger(__name__)
 
+SENDGRID_API_URL = os.getenv('SENDGRID_API_URL', 'https://api.sendgrid.com')
+
+# SendGrid reports per-recipient problems as e.g. field="personalizations.12.to"
+PERSONALIZATION_FIELD = re.compile(r"^personalizations\.(\d+)")
+
+# Responses worth retrying later; other 4xx will fail the same way again
+RETRYABLE_STATUSES = {408, 429}
+
 class ESPService:
-    def __init__(self):
-        self.client = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
-        
-    async def send_email(self, to_email: str, subject: str, content: str, tracking_id: str) -> Dict:
-        try:
-            message = Mail(
-                from_email=os.getenv('SENDER_EMAIL'),
-                to_emails=to_email,
-                subject=subject,
-                html_content=content
+    """SendGrid mail/send over a pooled aiohttp session.
+
+    In-flight requests are capped by an AIMD limit (up to max_concurrency)
+    that backs off on 429s and rising latency, and every request waits out
+    a Retry-After. A circuit breaker fails sends fast while SendGrid is
+    erroring. Failed results say whether they are worth retrying
+    ('retryable') and after how long at the earliest ('retry_after').
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None, api_url: Optional[str] = None):
+        self._client = None
+        self.api_url = api_url or SENDGRID_API_URL
+        self.max_concurrency = max_concurrency or int(os.getenv('ESP_MAX_CONCURRENCY', 100))
+        self.timeout = float(os.getenv('ESP_TIMEOUT_SECONDS', 30))
+        self._session: Optional['aiohttp.ClientSession'] = None
+        latency_target = os.getenv('ESP_LATENCY_TARGET_SECONDS')
+        self.concurrency = AdaptiveConcurrency(
+            maximum=self.max_concurrency,
+            latency_target=float(latency_target) if latency_target else None
+        )
+        self.breaker = CircuitBreaker()
+
+    @property
+    def client(self):
+        """SendGrid SDK client, only needed for the stats API; built on first use"""
+        if self._client is None:
+            self._client = get_esp_client()
+        return self._client
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        """Keep-alive pool sized to the concurrency limit, created on first send"""
+        if self._session is None or self._session.closed:
+            import aiohttp
+            self._session = aiohttp.ClientSession(
+                base_url=self.api_url,
+                headers={'Authorization': f"Bearer {os.getenv('SENDGRID_API_KEY')}"},
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
             )
-            message.custom_args = {'tracking_id': tracking_id}
-            
-            response = await self.client.send(message)
+        return self._session
+
+    def build_message(self, to_email: str, subject: str, content: str, tracking_id: str) -> Dict:
+        """Build a v3 mail/send body equivalent to the sendgrid Mail helper"""
+        return {
+            'personalizations': [{
+                'to': [{'email': to_email}],
+                'custom_args': {'tracking_id': tracking_id}
+            }],
+            'from': {'email': os.getenv('SENDER_EMAIL')},
+            'subject': subject,
+            'content': [{'type': 'text/html', 'value': content}]
+        }
+
+    async def _post(self, payload: Dict,
+                    throttle: Optional[Callable[[int], Awaitable]] = None) -> Tuple[int, str, Dict, bytes]:
+        """POST one mail/send body within the concurrency limit; raises CircuitOpenError while open.
+
+        throttle, if given, is awaited with the number of recipients once the
+        breaker has admitted the request, so refused requests spend no permits.
+        """
+        started = await self.concurrency.acquire()
+        # Checked once a slot is free: the breaker may have opened while this request waited
+        if not self.breaker.allow():
+            await self.concurrency.release(started, 'skipped')
+            raise CircuitOpenError(self.breaker.retry_in())
+        if throttle:
+            try:
+                await throttle(len(payload['personalizations']))
+            except BaseException:
+                await self.concurrency.release(started, 'skipped')
+                self.breaker.abandon()
+                raise
+            # Time the response, not the wait for rate-limit permits
+            started = time.monotonic()
+        timer = time.perf_counter()
+        status = 'error'
+        outcome = 'error'
+        try:
+            session = self._get_session()
+            async with session.post('/v3/mail/send', json=payload) as response:
+                body = await response.read()
+                status = response.status
+                if status == 429:
+                    outcome = 'throttled'
+                    self.concurrency.pause(parse_retry_after(response.headers.get('Retry-After')) or 1.0)
+                elif status < 500:
+                    outcome = 'ok'
+                return status, response.reason, dict(response.headers), body
+        finally:
+            record_esp_request(timer, status)
+            if outcome == 'error':
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            await self.concurrency.release(started, outcome)
+            record_esp_flow(self.concurrency.limit, self.breaker.is_open())
+
+    @staticmethod
+    def _failure(error: str, retryable: bool, retry_after: Optional[float] = None) -> Dict:
+        return {
+            'success': False,
+            'error': error,
+            'status': 'failed',
+            'retryable': retryable,
+            'retry_after': retry_after
+        }
+
+    def _unavailable(self) -> Dict:
+        return self._failure('ESP circuit open', True, self.breaker.retry_in())
+
+    async def send_email(self, to_email: str, subject: str, content: str, tracking_id: str,
+                         throttle: Optional[Callable[[int], Awaitable]] = None) -> Dict:
+        message = self.build_message(to_email, subject, content, tracking_id)
+        try:
+            status, reason, headers, _ = await self._post(message, throttle)
+        except CircuitOpenError as e:
+            return self._failure(str(e), True, e.retry_after)
+        except Exception as e:
+            logger.error(f"Error sending email: {str(e)}")
+            return self._failure(str(e), True)
+
+        if status < 400:
             return {
                 'success': True,
-                'message_id': response.headers.get('X-Message-Id'),
+                'message_id': headers.get('X-Message-Id'),
                 'status': 'sent'
             }
+        error = f"{status} {reason}"
+        logger.error(f"Error sending email: {error}")
+        return self._failure(
+            error, status in RETRYABLE_STATUSES or status >= 500, parse_retry_after(headers.get('Retry-After'))
+        )
+
+    async def send_many(self, messages: List[Dict],
+                        throttle: Optional[Callable[[int], Awaitable]] = None) -> List[Dict]:
+        """Send messages concurrently under the adaptive concurrency limit; results keep input order.
+
+        throttle, if given, is awaited with the number of recipients before each
+        request the circuit breaker admits.
+        """
+        async def send(message):
+            # Don't queue for a slot while the breaker would refuse the send anyway
+            if not self.breaker.would_allow():
+                return self._unavailable()
+            return await self.send_email(
+                to_email=message['to_email'],
+                subject=message['subject'],
+                content=message['content'],
+                tracking_id=message['tracking_id'],
+                throttle=throttle
+            )
+
+        results = await asyncio.gather(*(send(message) for message in messages))
+        record_esp_results(results)
+        return results
+
+    async def send_bulk(self, recipients: List[Dict], subject: str, content: str,
+                        max_personalizations: int = MAX_PERSONALIZATIONS,
+                        throttle: Optional[Callable[[int], Awaitable]] = None) -> List[Dict]:
+        """Send one template to many recipients using personalizations.
+
+        Recipients are packed up to max_personalizations per request and the
+        requests run concurrently. Results are returned per recipient, in
+        input order, so callers can record each tracking_id's outcome.
+        """
+        payloads = build_bulk_payloads(
+            recipients, subject, content, os.getenv('SENDER_EMAIL'), max_personalizations
+        )
+        async def send(payload):
+            if not self.breaker.would_allow():
+                return [self._unavailable() for _ in payload['personalizations']]
+            return await self._send_payload(payload, throttle=throttle)
+
+        chunks = await asyncio.gather(*(send(payload) for payload in payloads))
+        results = [result for chunk in chunks for result in chunk]
+        record_esp_results(results)
+        return results
+
+    async def _send_payload(self, payload: Dict, retry_rejected: bool = True,
+                            throttle: Optional[Callable[[int], Awaitable]] = None) -> List[Dict]:
+        """Send one bulk body and map its outcome back onto its personalizations"""
+        count = len(payload['personalizations'])
+        try:
+            status, reason, headers, body = await self._post(payload, throttle)
+        except CircuitOpenError as e:
+            return [self._failure(str(e), True, e.retry_after) for _ in range(count)]
         except Exception as e:
-            logger.error(f"Error sending email: {str(e)}")
-            return {
-                'success': False,
-                'error': str(e),
-                'status': 'failed'
+            logger.error(f"Error sending bulk email request: {str(e)}")
+            return [self._failure(str(e), True) for _ in range(count)]
+
+        if status < 400:
+            result = {
+                'success': True,
+                'message_id': headers.get('X-Message-Id'),
+                'status': 'sent'
             }
-            
+            return [dict(result) for _ in range(count)]
+        error = f"{status} {reason}"
+        if status in RETRYABLE_STATUSES or status >= 500:
+            logger.error(f"Bulk email request failed for {count} recipients: {error}")
+            retry_after = parse_retry_after(headers.get('Retry-After'))
+            return [self._failure(error, True, retry_after) for _ in range(count)]
+        errors = self._parse_errors(body)
+
+        # SendGrid rejects the whole request when any personalization is invalid.
+        # Fail the offending recipients and resend the rest once.
+        rejected = {}
+        for item in errors:
+            match = PERSONALIZATION_FIELD.match(item.get('field') or '')
+            if match and int(match.group(1)) < count:
+                rejected[int(match.group(1))] = item.get('message', error)
+
+        if not rejected or not retry_rejected or len(rejected) == count:
+            logger.error(f"Bulk email request failed for {count} recipients: {error}")
+            return [self._failure(rejected.get(i, error), False) for i in range(count)]
+
+        accepted = [i for i in range(count) if i not in rejected]
+        retry_results = await self._send_payload(
+            dict(payload, personalizations=[payload['personalizations'][i] for i in accepted]),
+            retry_rejected=False
+        )
+        results = [self._failure(rejected[i], False) if i in rejected else None for i in range(count)]
+        for i, result in zip(accepted, retry_results):
+            results[i] = result
+        return results
+
+    @staticmethod
+    def _parse_errors(body: bytes) -> List[Dict]:
+        try:
+            return json.loads(body).get('errors', [])
+        except (ValueError, AttributeError):
+            return []
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
     async def get_email_status(self, tracking_id: str) -> Dict:
         try:
             response = await self.client.client.stats.get(
@@ -44,4 +271,4 @@ class ESPService:
             return response.to_dict()
         except Exception as e:
             logger.error(f"Error getting email status: {str(e)}")
-            return {'error': str(e)} 
\ No newline at end of file
+            return {'error': str(e)}
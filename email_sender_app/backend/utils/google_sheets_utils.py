@@ -1,9 +1,376 @@
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-
-def connect_google_sheets(credentials_file):
-    credentials = service_account.Credentials.from_service_account_info(credentials_file.file.read())
-    service = build('sheets', 'v4', credentials=credentials)
-    sheet = service.spreadsheets()
-    result = sheet.values().get(spreadsheetId='your_spreadsheet_id', range='Sheet1').execute()
-    return result.get('values', [])
\ No newline at end of file
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+
+from .redis_pool import create_redis
+from .storage_utils import CSV_FIELDS_KEY, CSV_META_KEY, CSV_ROWS_KEY, CSV_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
+SHEETS_PAGE_ROWS = int(os.getenv('SHEETS_PAGE_ROWS', 1000))
+SHEETS_SYNC_POLL_SECONDS = int(os.getenv('SHEETS_SYNC_POLL_SECONDS', 30))
+
+SHEETS_SCHEDULE_KEY = 'sheets_sync:schedule'   # the scheduled sync's config and next run
+
+# googleapiclient services are not thread-safe (one httplib2 connection each),
+# so every thread that calls the API gets its own
+_local = threading.local()
+
+
+def get_sheets_service(credentials_info: Dict[str, Any]):
+    """Sheets API client for a service account, built once per account and thread and reused"""
+    services = _local.__dict__.setdefault('services', {})
+    cache_key = hashlib.sha256(json.dumps(credentials_info, sort_keys=True).encode()).hexdigest()
+    service = services.get(cache_key)
+    if service is None:
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
+        credentials = service_account.Credentials.from_service_account_info(credentials_info, scopes=SHEETS_SCOPES)
+        service = build('sheets', 'v4', credentials=credentials, cache_discovery=False)
+        services[cache_key] = service
+    return service
+
+
+def default_credentials_info() -> Dict[str, Any]:
+    path = os.getenv('GOOGLE_SERVICE_ACCOUNT_FILE')
+    if not path:
+        raise ValueError("GOOGLE_SERVICE_ACCOUNT_FILE is not set")
+    with open(path) as f:
+        return json.load(f)
+
+
+def sheet_row_count(service, spreadsheet_id: str, sheet: str = 'Sheet1') -> int:
+    """Number of grid rows in the sheet, filled or not"""
+    metadata = service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields='sheets.properties(title,gridProperties.rowCount)'
+    ).execute()
+    row_count = next(
+        (s['properties']['gridProperties']['rowCount'] for s in metadata.get('sheets', [])
+         if s['properties']['title'] == sheet),
+        None
+    )
+    if row_count is None:
+        raise ValueError(f"Sheet {sheet!r} not found in spreadsheet {spreadsheet_id}")
+    return row_count
+
+
+def read_sheet_rows(service, spreadsheet_id: str, sheet: str, start: int, end: int) -> List[List[str]]:
+    """Values of rows start..end (1-based, inclusive)"""
+    result = service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id, range=f"'{sheet}'!{start}:{end}"
+    ).execute()
+    return result.get('values', [])
+
+
+def page_ranges(row_count: int, page_rows: int = SHEETS_PAGE_ROWS, first_row: int = 1) -> Iterator[Tuple[int, int]]:
+    for start in range(first_row, row_count + 1, page_rows):
+        yield start, min(start + page_rows - 1, row_count)
+
+
+def read_sheet_pages(service, spreadsheet_id: str, sheet: str = 'Sheet1',
+                     page_rows: int = SHEETS_PAGE_ROWS, first_row: int = 1) -> Iterator[List[List[str]]]:
+    """Yield the sheet's rows page by page, from first_row to the sheet's last grid row"""
+    row_count = sheet_row_count(service, spreadsheet_id, sheet)
+    for start, end in page_ranges(row_count, page_rows, first_row):
+        yield read_sheet_rows(service, spreadsheet_id, sheet, start, end)
+
+
+def connect_google_sheets(credentials_file, spreadsheet_id: str = 'your_spreadsheet_id', sheet: str = 'Sheet1'):
+    """All values of a sheet, read in pages through the cached client"""
+    service = get_sheets_service(json.loads(credentials_file.file.read()))
+    return [row for page in read_sheet_pages(service, spreadsheet_id, sheet) for row in page]
+
+
+@dataclass
+class SyncKeys:
+    """Recipient rows plus the per-row bookkeeping an incremental sync needs"""
+    rows: str     # list of JSON value arrays, the dataset readers use
+    keys: str     # list of row keys, parallel to rows
+    index: str    # hash row key -> position in rows
+    hashes: str   # hash row key -> row hash from the last sync
+
+    @classmethod
+    def for_source(cls, source: str, staging: bool = False) -> 'SyncKeys':
+        """The live keys, or the staging keys a sync is applied to before they replace them"""
+        prefix = f"sheets_sync:{source}{':staging' if staging else ''}"
+        rows = f"{prefix}:rows" if staging else CSV_ROWS_KEY
+        return cls(rows=rows, keys=f"{prefix}:keys", index=f"{prefix}:index", hashes=f"{prefix}:hashes")
+
+    def all(self) -> List[str]:
+        return [self.rows, self.keys, self.index, self.hashes]
+
+
+# KEYS: rows, keys, index, hashes; ARGV: row keys to remove
+# Swap-remove: the last row takes the removed row's position, so no other row moves
+REMOVE_ROWS_SCRIPT = """
+for _, key in ipairs(ARGV) do
+    local position = redis.call('HGET', KEYS[3], key)
+    if position then
+        position = tonumber(position)
+        local last = redis.call('LLEN', KEYS[1]) - 1
+        if position ~= last then
+            local moved_key = redis.call('LINDEX', KEYS[2], last)
+            redis.call('LSET', KEYS[1], position, redis.call('LINDEX', KEYS[1], last))
+            redis.call('LSET', KEYS[2], position, moved_key)
+            redis.call('HSET', KEYS[3], moved_key, position)
+        end
+        redis.call('RPOP', KEYS[1])
+        redis.call('RPOP', KEYS[2])
+        redis.call('HDEL', KEYS[3], key)
+        redis.call('HDEL', KEYS[4], key)
+    end
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+# KEYS: meta, fields, the staging keys, then the live keys they replace
+# ARGV: upload_id the sync started from, new upload_id, fields JSON, total, ttl
+# Swaps a staged sync in unless a CSV upload replaced the dataset meanwhile
+SWAP_IN_SCRIPT = """
+if (redis.call('HGET', KEYS[1], 'upload_id') or '') ~= ARGV[1] then
+    return 0
+end
+local count = (#KEYS - 2) / 2
+for i = 3, count + 2 do
+    local live = KEYS[i + count]
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('RENAME', KEYS[i], live)
+        redis.call('EXPIRE', live, ARGV[5])
+    else
+        redis.call('DEL', live)
+    end
+end
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[5])
+redis.call('HSET', KEYS[1], 'upload_id', ARGV[2], 'total_records', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+
+
+def row_hash(value: str) -> str:
+    return hashlib.blake2b(value.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class SheetsSync:
+    """Incremental sync of a Google Sheet into the stored recipient rows (csv_rows).
+
+    Rows are identified by their key column (email by default) and compared
+    with the previous sync by row hash. Only added, changed and removed rows
+    are sent, one MULTI per page, so a sync costs O(sheet) reads but only
+    O(diff) writes over the wire. They are applied to a server-side copy of
+    the dataset in staging keys that is swapped in atomically at the end, as
+    uploads are, so readers never see a half-applied sync. The first sync, a
+    changed header, or a dataset replaced by a CSV upload stages from empty.
+
+    service, if given, is used from worker threads as is; otherwise each
+    thread builds its own client from GOOGLE_SERVICE_ACCOUNT_FILE.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None, service=None):
+        self.redis_client = redis_client or create_redis()
+        self._service = service
+        self._credentials_info: Optional[Dict[str, Any]] = None
+        self.remove_script = self.redis_client.register_script(REMOVE_ROWS_SCRIPT)
+        self.swap_script = self.redis_client.register_script(SWAP_IN_SCRIPT)
+
+    async def _call(self, func, *args):
+        """Run a Sheets API call in a worker thread, with that thread's client"""
+        if self._service is None and self._credentials_info is None:
+            self._credentials_info = default_credentials_info()
+
+        def call():
+            service = self._service if self._service is not None else get_sheets_service(self._credentials_info)
+            return func(service, *args)
+        return await asyncio.to_thread(call)
+
+    @staticmethod
+    def source_id(spreadsheet_id: str, sheet: str) -> str:
+        return f"{spreadsheet_id}:{sheet}"
+
+    async def sync(self, spreadsheet_id: str, sheet: str = 'Sheet1', key_column: str = 'email',
+                   full: bool = False) -> Dict[str, Any]:
+        source = self.source_id(spreadsheet_id, sheet)
+        started = time.perf_counter()
+        try:
+            ranges = page_ranges(await self._call(sheet_row_count, spreadsheet_id, sheet))
+            first_page = next(ranges, None)
+            header_page = await self._call(read_sheet_rows, spreadsheet_id, sheet, *first_page) if first_page else []
+            if not header_page:
+                raise ValueError("Sheet is empty")
+            fields = [name.strip() for name in header_page[0]]
+            if key_column not in fields:
+                raise ValueError(f"Key column {key_column!r} not in sheet header")
+
+            stored_fields = await self.redis_client.get(CSV_FIELDS_KEY)
+            upload_id = await self.redis_client.hget(CSV_META_KEY, 'upload_id')
+            full = (full or upload_id is None or upload_id.decode() != f"sheets:{source}"
+                    or stored_fields is None or json.loads(stored_fields) != fields)
+
+            keys = SyncKeys.for_source(source, staging=True)
+            live_keys = SyncKeys.for_source(source)
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.delete(*keys.all())
+            if not full:
+                for live, staging in zip(live_keys.all(), keys.all()):
+                    pipe.copy(live, staging)
+            await pipe.execute()
+            stats = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0, 'pages': 1}
+            length = await self.redis_client.llen(keys.rows)
+            seen_key = f"sheets_sync:{source}:seen"
+            await self.redis_client.delete(seen_key)
+
+            occurrences: Dict[str, int] = {}
+            key_position = fields.index(key_column)
+            rows = header_page[1:]
+            while True:
+                length = await self._apply_page(keys, seen_key, fields, key_position, rows, occurrences,
+                                                length, stats)
+                page = next(ranges, None)
+                if page is None:
+                    break
+                rows = await self._call(read_sheet_rows, spreadsheet_id, sheet, *page)
+                stats['pages'] += 1
+
+            length = await self._remove_unseen(keys, seen_key, stats)
+            await self.redis_client.delete(seen_key)
+
+            # Swap the staged dataset in at once, as CSV uploads do
+            swapped = await self.swap_script(
+                keys=[CSV_META_KEY, CSV_FIELDS_KEY] + keys.all() + live_keys.all(),
+                args=[upload_id.decode() if upload_id else '', f"sheets:{source}", json.dumps(fields),
+                      length, CSV_TTL_SECONDS]
+            )
+            if not swapped:
+                await self.redis_client.delete(*keys.all())
+                raise ValueError("Recipient data was replaced by an upload during the sync")
+
+            stats.update(total=length, full=full, seconds=round(time.perf_counter() - started, 3))
+            logger.info(f"Synced sheet {source}: {stats}")
+            return stats
+        except Exception as e:
+            logger.error(f"Error syncing sheet {source}: {str(e)}")
+            raise
+
+    async def _apply_page(self, keys: SyncKeys, seen_key: str, fields: List[str], key_position: int,
+                          rows: List[List[str]], occurrences: Dict[str, int], length: int,
+                          stats: Dict[str, int]) -> int:
+        """Write one page's added and changed rows; returns the new row count"""
+        page: List[Tuple[str, str]] = []
+        for record in rows:
+            if not any(cell.strip() for cell in record):
+                continue
+            record = (list(record) + [''] * len(fields))[:len(fields)]
+            key = record[key_position].strip()
+            # Repeated keys stay distinct rows
+            occurrences[key] = occurrences.get(key, 0) + 1
+            if occurrences[key] > 1:
+                key = f"{key}#{occurrences[key]}"
+            page.append((key, json.dumps(record)))
+        if not page:
+            return length
+
+        page_keys = [key for key, _ in page]
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hmget(keys.hashes, page_keys)
+        pipe.hmget(keys.index, page_keys)
+        previous_hashes, positions = await pipe.execute()
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.sadd(seen_key, *page_keys)
+        for (key, value), previous, position in zip(page, previous_hashes, positions):
+            digest = row_hash(value)
+            if previous is not None and previous.decode() == digest:
+                stats['unchanged'] += 1
+                continue
+            if position is None:
+                pipe.rpush(keys.rows, value)
+                pipe.rpush(keys.keys, key)
+                pipe.hset(keys.index, key, length)
+                length += 1
+                stats['added'] += 1
+            else:
+                pipe.lset(keys.rows, int(position), value)
+                stats['changed'] += 1
+            pipe.hset(keys.hashes, key, digest)
+        await pipe.execute()
+        return length
+
+    async def _remove_unseen(self, keys: SyncKeys, seen_key: str, stats: Dict[str, int]) -> int:
+        """Drop rows that were not in this sync; returns the remaining row count"""
+        removed: List[str] = []
+        cursor = 0
+        while True:
+            cursor, batch = await self.redis_client.hscan(keys.index, cursor=cursor, count=1000)
+            batch_keys = list(batch.keys())
+            if batch_keys:
+                present = await self.redis_client.smismember(seen_key, batch_keys)
+                removed.extend(key.decode() for key, found in zip(batch_keys, present) if not found)
+            if cursor == 0:
+                break
+
+        for start in range(0, len(removed), 1000):
+            await self.remove_script(keys=keys.all(), args=removed[start:start + 1000])
+        stats['removed'] = len(removed)
+        return await self.redis_client.llen(keys.rows)
+
+    async def schedule(self, spreadsheet_id: str, sheet: str, key_column: str, interval_seconds: int):
+        await self.redis_client.hset(SHEETS_SCHEDULE_KEY, mapping={
+            'spreadsheet_id': spreadsheet_id,
+            'sheet': sheet,
+            'key_column': key_column,
+            'interval_seconds': interval_seconds,
+            'next_run': time.time() + interval_seconds
+        })
+
+    async def unschedule(self):
+        await self.redis_client.delete(SHEETS_SCHEDULE_KEY)
+
+    async def get_schedule(self) -> Optional[Dict[str, Any]]:
+        config = await self.redis_client.hgetall(SHEETS_SCHEDULE_KEY)
+        return {k.decode(): v.decode() for k, v in config.items()} or None
+
+    async def run_scheduled(self):
+        """Run the scheduled sync whenever it is due; one API process runs it at a time"""
+        while True:
+            try:
+                await self.run_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error running scheduled sheet sync: {str(e)}")
+            await asyncio.sleep(SHEETS_SYNC_POLL_SECONDS)
+
+    async def run_due(self) -> Optional[Dict[str, Any]]:
+        config = await self.get_schedule()
+        if not config or float(config['next_run']) > time.time():
+            return None
+        interval = int(config['interval_seconds'])
+        if not await self.redis_client.set(f"{SHEETS_SCHEDULE_KEY}:lock", os.getpid(), nx=True, ex=max(interval, 60)):
+            return None
+
+        # A CSV upload replaced the synced data: stop syncing over it
+        upload_id = await self.redis_client.hget(CSV_META_KEY, 'upload_id')
+        source = self.source_id(config['spreadsheet_id'], config['sheet'])
+        if upload_id is not None and upload_id.decode() != f"sheets:{source}":
+            logger.info(f"Recipient data was replaced by upload {upload_id.decode()}; stopping sheet sync")
+            await self.unschedule()
+            return None
+
+        try:
+            stats = await self.sync(config['spreadsheet_id'], config['sheet'], config['key_column'])
+            await self.redis_client.hset(SHEETS_SCHEDULE_KEY, mapping={
+                'last_run': time.time(), 'last_result': json.dumps(stats)
+            })
+            return stats
+        finally:
+            if await self.redis_client.exists(SHEETS_SCHEDULE_KEY):
+                await self.redis_client.hset(SHEETS_SCHEDULE_KEY, 'next_run', time.time() + interval)
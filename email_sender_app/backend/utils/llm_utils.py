@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import redis
+import redis.asyncio as aioredis
+
+from .metrics import record_groq_request
+from .redis_pool import create_redis
+
+if TYPE_CHECKING:
+    import groq
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = os.getenv('GROQ_MODEL', 'mixtral-8x7b-32768')
+CACHE_PREFIX = 'llm_cache:'
+
+EMAIL_SYSTEM_PROMPT = (
+    "You are an email content generator. Generate professional email content based on the template."
+)
+
+
+class LLMService:
+    """Groq chat completions behind a two-tier cache.
+
+    Lookups go in-process LRU -> Redis (shared, with TTL) -> Groq. Concurrent
+    requests for the same key wait on a single upstream call.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None, local_cache_size: Optional[int] = None,
+                 cache_ttl: Optional[int] = None):
+        self.redis_client = redis_client or create_redis()
+        self.local_cache_size = local_cache_size or int(os.getenv('LLM_LOCAL_CACHE_SIZE', 1024))
+        self.cache_ttl = cache_ttl or int(os.getenv('LLM_CACHE_TTL_SECONDS', 86400))
+        self._client: Optional['groq.AsyncGroq'] = None
+        self._local_cache: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0}
+
+    def _get_client(self) -> 'groq.AsyncGroq':
+        """One shared client (and connection pool) for every request, imported and built on first use"""
+        if self._client is None:
+            import groq
+            self._client = groq.AsyncGroq(
+                api_key=os.getenv('GROQ_API_KEY'),
+                base_url=os.getenv('GROQ_BASE_URL') or None
+            )
+        return self._client
+
+    @staticmethod
+    def cache_key(messages: List[Dict], model: str, temperature: float, max_tokens: Optional[int]) -> str:
+        body = json.dumps(
+            {'messages': messages, 'model': model, 'temperature': temperature, 'max_tokens': max_tokens},
+            sort_keys=True
+        )
+        return CACHE_PREFIX + hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+    async def generate(self, messages: List[Dict], model: str = DEFAULT_MODEL, temperature: float = 0.7,
+                       max_tokens: Optional[int] = None) -> str:
+        key = self.cache_key(messages, model, temperature, max_tokens)
+
+        if key in self._local_cache:
+            self._local_cache.move_to_end(key)
+            self.stats['local_hits'] += 1
+            return self._local_cache[key]
+
+        while key in self._inflight:
+            shared = self._inflight[key]
+            self.stats['coalesced'] += 1
+            try:
+                return await asyncio.shield(shared)
+            except asyncio.CancelledError:
+                # Only the leading request was cancelled: make the call ourselves
+                if not shared.cancelled():
+                    raise
+            if key in self._local_cache:
+                return self._local_cache[key]
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            content = await self._lookup_or_generate(key, messages, model, temperature, max_tokens)
+            self._remember(key, content)
+            future.set_result(content)
+            return content
+        except Exception as e:
+            self.stats['errors'] += 1
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting on it
+            future.exception()
+            raise
+        finally:
+            # Cancelled (e.g. the client disconnected): release the waiting followers
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+
+    async def _lookup_or_generate(self, key: str, messages: List[Dict], model: str, temperature: float,
+                                  max_tokens: Optional[int]) -> str:
+        try:
+            cached = await self.redis_client.get(key)
+        except redis.RedisError as e:
+            logger.warning(f"LLM cache unavailable, calling Groq directly: {str(e)}")
+            cached = None
+        if cached is not None:
+            self.stats['redis_hits'] += 1
+            return cached.decode() if isinstance(cached, bytes) else cached
+
+        self.stats['misses'] += 1
+        params = {'messages': messages, 'model': model, 'temperature': temperature}
+        if max_tokens:
+            params['max_tokens'] = max_tokens
+        started = time.perf_counter()
+        try:
+            response = await self._get_client().chat.completions.create(**params)
+        except Exception:
+            record_groq_request(started, 'error')
+            raise
+        record_groq_request(started, 'ok', response.usage)
+        content = response.choices[0].message.content
+
+        try:
+            await self.redis_client.set(key, content, ex=self.cache_ttl)
+        except redis.RedisError as e:
+            logger.warning(f"Could not cache LLM response: {str(e)}")
+        return content
+
+    def _remember(self, key: str, content: str):
+        self._local_cache[key] = content
+        self._local_cache.move_to_end(key)
+        while len(self._local_cache) > self.local_cache_size:
+            self._local_cache.popitem(last=False)
+
+    def get_stats(self) -> Dict:
+        lookups = self.stats['local_hits'] + self.stats['redis_hits'] + self.stats['misses'] + self.stats['coalesced']
+        hits = lookups - self.stats['misses']
+        return {
+            **self.stats,
+            'local_cache_entries': len(self._local_cache),
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,177 @@
+"""Prometheus instrumentation.
+
+HTTP, ESP, Groq and Redis metrics are recorded as they happen, at the cost
+of one histogram observation or counter increment each. Queue depth,
+webhook lag and WebSocket state are only read when /metrics is scraped, so
+they cost nothing between scrapes.
+
+Each process keeps its own metrics. Set PROMETHEUS_MULTIPROC_DIR (to an
+empty directory shared by the API and worker processes on a host) to have
+/metrics aggregate all of them; otherwise send workers can expose their own
+endpoint with --metrics-port.
+"""
+import inspect
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route template',
+    ['method', 'route', 'status'], buckets=LATENCY_BUCKETS
+)
+ESP_REQUEST_SECONDS = Histogram(
+    'esp_request_duration_seconds', 'SendGrid mail/send latency by response status ("error" when none)',
+    ['status'], buckets=LATENCY_BUCKETS
+)
+ESP_RECIPIENTS = Counter('esp_recipients_total', 'Recipients by send outcome', ['outcome'])
+ESP_CONCURRENCY_LIMIT = Gauge(
+    'esp_concurrency_limit', 'Adaptive limit on in-flight SendGrid requests', multiprocess_mode='liveall'
+)
+ESP_CIRCUIT_OPEN = Gauge('esp_circuit_open', '1 while the SendGrid circuit breaker refuses sends',
+                         multiprocess_mode='liveall')
+SEND_RETRIES = Counter('email_send_retries_total', 'Failed recipients by what happened next: retry or dead_letter',
+                       ['outcome'])
+GROQ_REQUEST_SECONDS = Histogram(
+    'groq_request_duration_seconds', 'Groq chat completion latency', ['outcome'], buckets=LATENCY_BUCKETS
+)
+GROQ_TOKENS = Counter('groq_tokens_total', 'Groq tokens used', ['type'])
+REDIS_COMMAND_SECONDS = Histogram(
+    'redis_command_duration_seconds', 'Redis command latency; PIPELINE and MULTI are one round trip each',
+    ['command'], buckets=LATENCY_BUCKETS
+)
+STARTUP_SECONDS = Gauge(
+    'startup_duration_seconds', 'Seconds spent starting up, by phase; "process" is process start to ready',
+    ['phase'], multiprocess_mode='max'
+)
+
+GaugeSource = Callable[[], Union[Dict[str, Any], Awaitable[Dict[str, Any]]]]
+
+
+class ScrapeGauges:
+    """Gauges computed from registered sources only when metrics are rendered.
+
+    A source returns a dict; each numeric value becomes a gauge named
+    <prefix>_<key>.
+    """
+
+    def __init__(self):
+        self.sources: List[Tuple[str, str, GaugeSource]] = []
+        self._families: List[GaugeMetricFamily] = []
+
+    def register(self, prefix: str, documentation: str, source: GaugeSource):
+        self.sources.append((prefix, documentation, source))
+
+    async def refresh(self):
+        families = []
+        for prefix, documentation, source in self.sources:
+            try:
+                values = source()
+                if inspect.isawaitable(values):
+                    values = await values
+            except Exception as e:
+                logger.error(f"Error reading {prefix} metrics: {str(e)}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    families.append(GaugeMetricFamily(f"{prefix}_{key}", f"{documentation}: {key}", value=value))
+        self._families = families
+
+    def collect(self):
+        return iter(self._families)
+
+
+scrape_gauges = ScrapeGauges()
+REGISTRY.register(scrape_gauges)
+
+
+async def render_metrics() -> Tuple[bytes, str]:
+    """Exposition body and content type, refreshing the scrape-time gauges first"""
+    await scrape_gauges.refresh()
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(scrape_gauges)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def process_age() -> Optional[float]:
+    """Seconds since this process started, from /proc (None where unavailable)"""
+    try:
+        with open('/proc/self/stat') as stat:
+            start_ticks = int(stat.read().rsplit(')', 1)[1].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, AttributeError, ValueError, IndexError):
+        return None
+
+
+def record_startup(component: str, **phases: float):
+    """Log and export how long startup took, per phase, once the component is ready"""
+    age = process_age()
+    if age is not None:
+        phases['process'] = age
+    for phase, seconds in phases.items():
+        STARTUP_SECONDS.labels(phase).set(seconds)
+    logger.info(f"{component} ready: " + ', '.join(f"{phase} {seconds:.3f}s" for phase, seconds in phases.items()))
+
+
+def record_esp_request(started: float, status: Union[int, str]):
+    ESP_REQUEST_SECONDS.labels(str(status)).observe(time.perf_counter() - started)
+
+
+def record_esp_flow(concurrency_limit: float, circuit_open: bool):
+    ESP_CONCURRENCY_LIMIT.set(concurrency_limit)
+    ESP_CIRCUIT_OPEN.set(1 if circuit_open else 0)
+
+
+def record_esp_results(results: List[Dict]):
+    sent = sum(1 for result in results if result.get('success'))
+    if sent:
+        ESP_RECIPIENTS.labels('sent').inc(sent)
+    if len(results) > sent:
+        ESP_RECIPIENTS.labels('failed').inc(len(results) - sent)
+
+
+def record_groq_request(started: float, outcome: str, usage: Any = None):
+    GROQ_REQUEST_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+    if usage is not None:
+        GROQ_TOKENS.labels('prompt').inc(getattr(usage, 'prompt_tokens', 0) or 0)
+        GROQ_TOKENS.labels('completion').inc(getattr(usage, 'completion_tokens', 0) or 0)
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request, labelled by route template rather than raw path"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get('route')
+            HTTP_REQUEST_SECONDS.labels(
+                scope['method'], getattr(route, 'path', 'unmatched'), str(status)
+            ).observe(time.perf_counter() - started)
@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from .llm_utils import LLMService, EMAIL_SYSTEM_PROMPT, DEFAULT_MODEL
+from .storage_utils import StorageManager
+from .template_utils import compile_template
+
+logger = logging.getLogger(__name__)
+
+JOBS_KEY = 'personalization:jobs'
+# A running job renews its lease every third of this; a process that dies
+# mid-job frees it for another process after at most this long
+LEASE_SECONDS = float(os.getenv('PERSONALIZATION_LEASE_SECONDS', 30))
+
+# KEYS: lease; ARGV: owner, lease milliseconds ('' to release)
+# Extends (or deletes) the lease only while the given owner holds it
+LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+
+def job_key(job_id: str) -> str:
+    return f"personalization:{job_id}"
+
+
+def results_key(job_id: str) -> str:
+    return f"personalization:{job_id}:results"
+
+
+def errors_key(job_id: str) -> str:
+    return f"personalization:{job_id}:errors"
+
+
+def lease_key(job_id: str) -> str:
+    return f"personalization:{job_id}:lease"
+
+
+class RequestBudget:
+    """Paces calls to a requests-per-minute and tokens-per-minute budget"""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def acquire(self, tokens: int):
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self._requests) * 60 / self.requests_per_minute,
+                    (tokens - self._tokens) * 60 / self.tokens_per_minute
+                )
+                await asyncio.sleep(wait)
+
+
+class PersonalizationPipeline:
+    """Generates one LLM-personalized email per row of the uploaded CSV.
+
+    Rows are streamed from storage chunk by chunk and fanned out to a fixed
+    number of workers. Every result is written to Redis as soon as it
+    completes, and the job records the first row of the first unfinished
+    chunk as its checkpoint, so a restarted job skips finished chunks and
+    only regenerates rows that have no stored result.
+
+    A job runs in one process at a time: whoever runs it holds a Redis lease
+    (SET NX PX) and renews it while running, and resume_incomplete() only
+    takes over jobs whose lease has lapsed.
+    """
+
+    def __init__(self, redis_client, llm_service: LLMService, storage_manager: StorageManager,
+                 concurrency: Optional[int] = None, requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None, chunk_size: int = 500):
+        self.redis_client = redis_client
+        self.llm_service = llm_service
+        self.storage_manager = storage_manager
+        self.concurrency = concurrency or int(os.getenv('LLM_CONCURRENCY', 8))
+        self.budget = RequestBudget(
+            requests_per_minute or int(os.getenv('LLM_REQUESTS_PER_MINUTE', 30)),
+            tokens_per_minute or int(os.getenv('LLM_TOKENS_PER_MINUTE', 6000))
+        )
+        self.chunk_size = chunk_size
+        self._tasks: Dict[str, Optional[asyncio.Task]] = {}
+        self.owner = uuid.uuid4().hex
+        self.lease_script = self.redis_client.register_script(LEASE_SCRIPT)
+
+    async def start(self, prompt_template: str, model: str = DEFAULT_MODEL, max_tokens: int = 500,
+                    job_id: Optional[str] = None) -> str:
+        fields = await self.storage_manager.get_csv_fields()
+        if fields:
+            compile_template(prompt_template).validate(fields)
+
+        job_id = job_id or str(uuid.uuid4())
+        if job_id in self._tasks or await self.redis_client.exists(lease_key(job_id)):
+            return job_id
+
+        pipe = self.redis_client.pipeline()
+        pipe.hset(job_key(job_id), mapping={
+            'status': 'running',
+            'prompt_template': prompt_template,
+            'model': model,
+            'max_tokens': max_tokens
+        })
+        # A resumed job keeps its checkpoint, skipping the chunks already done
+        pipe.hsetnx(job_key(job_id), 'checkpoint_row', 0)
+        pipe.hsetnx(job_key(job_id), 'created_at', datetime.now().isoformat())
+        pipe.sadd(JOBS_KEY, job_id)
+        await pipe.execute()
+
+        await self._spawn(job_id)
+        return job_id
+
+    async def resume_incomplete(self) -> List[str]:
+        """Restart every running job that no process holds a lease on"""
+        resumed = []
+        for job_id in await self.redis_client.smembers(JOBS_KEY):
+            job_id = job_id.decode() if isinstance(job_id, bytes) else job_id
+            status = await self.redis_client.hget(job_key(job_id), 'status')
+            status = status.decode() if isinstance(status, bytes) else status
+            if status == 'running' and await self._spawn(job_id):
+                logger.info(f"Resuming personalization job {job_id}")
+                resumed.append(job_id)
+        return resumed
+
+    async def watch(self):
+        """Take over jobs left by stopped processes once their lease lapses"""
+        while True:
+            await asyncio.sleep(LEASE_SECONDS)
+            try:
+                await self.resume_incomplete()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error resuming personalization jobs: {str(e)}")
+
+    async def _spawn(self, job_id: str) -> bool:
+        """Run the job here unless it is already running in this or another process"""
+        if job_id in self._tasks:
+            return False
+        # Reserve the slot before awaiting, so concurrent callers cannot both spawn
+        self._tasks[job_id] = None
+        try:
+            leased = await self.redis_client.set(lease_key(job_id), self.owner, nx=True, px=int(LEASE_SECONDS * 1000))
+        except Exception:
+            self._tasks.pop(job_id, None)
+            raise
+        if not leased:
+            self._tasks.pop(job_id, None)
+            return False
+        task = asyncio.create_task(self._run_leased(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+        return True
+
+    async def _run_leased(self, job_id: str):
+        run = asyncio.create_task(self.run(job_id))
+        try:
+            while not run.done():
+                await asyncio.wait({run}, timeout=LEASE_SECONDS / 3)
+                if run.done():
+                    break
+                if not await self.lease_script(keys=[lease_key(job_id)], args=[self.owner, int(LEASE_SECONDS * 1000)]):
+                    logger.error(f"Lost the lease on personalization job {job_id}, stopping here")
+                    run.cancel()
+            await run
+        finally:
+            run.cancel()
+            await self.lease_script(keys=[lease_key(job_id)], args=[self.owner, ''])
+
+    async def run(self, job_id: str):
+        job = self._decode_hash(await self.redis_client.hgetall(job_key(job_id)))
+        template = compile_template(job['prompt_template'])
+        model = job['model']
+        max_tokens = int(job['max_tokens'])
+        checkpoint = int(job.get('checkpoint_row', 0))
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [
+            asyncio.create_task(self._worker(job_id, queue, template, model, max_tokens))
+            for _ in range(self.concurrency)
+        ]
+        try:
+            row_index = 0
+            async for rows in self.storage_manager.iter_csv_rows(self.chunk_size):
+                chunk_start, row_index = row_index, row_index + len(rows)
+                if row_index <= checkpoint:
+                    continue
+
+                # Skip rows of a partially finished chunk that already have results
+                indexes = list(range(chunk_start, row_index))
+                done = await self.redis_client.hmget(results_key(job_id), indexes)
+                for index, row, result in zip(indexes, rows, done):
+                    if result is None:
+                        await queue.put((index, row))
+                await queue.join()
+
+                await self.redis_client.hset(job_key(job_id), 'checkpoint_row', row_index)
+
+            await self.redis_client.hset(job_key(job_id), mapping={
+                'status': 'completed',
+                'total': row_index,
+                'completed_at': datetime.now().isoformat()
+            })
+            logger.info(f"Personalization job {job_id} completed ({row_index} rows)")
+        except asyncio.CancelledError:
+            # Leave the job 'running' so resume_incomplete picks it up again
+            raise
+        except Exception as e:
+            logger.error(f"Personalization job {job_id} failed: {str(e)}")
+            await self.redis_client.hset(job_key(job_id), mapping={'status': 'failed', 'error': str(e)})
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self, job_id: str, queue: asyncio.Queue, template, model: str, max_tokens: int):
+        while True:
+            index, row = await queue.get()
+            try:
+                prompt = template.render(row)
+                # Rough prompt size estimate (~4 characters per token) plus the completion budget
+                await self.budget.acquire(len(prompt) // 4 + max_tokens)
+                content = await self.llm_service.generate(
+                    messages=[
+                        {"role": "system", "content": EMAIL_SYSTEM_PROMPT},
+                        {"role": "user", "content": prompt}
+                    ],
+                    model=model,
+                    temperature=0.7,
+                    max_tokens=max_tokens
+                )
+                pipe = self.redis_client.pipeline()
+                pipe.hset(results_key(job_id), index, content)
+                pipe.hdel(errors_key(job_id), index)
+                await pipe.execute()
+            except Exception as e:
+                logger.error(f"Error personalizing row {index} of job {job_id}: {str(e)}")
+                await self.redis_client.hset(errors_key(job_id), index, str(e))
+            finally:
+                queue.task_done()
+
+    async def get_progress(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._decode_hash(await self.redis_client.hgetall(job_key(job_id)))
+        if not job:
+            return None
+        job.pop('prompt_template', None)
+        job['job_id'] = job_id
+        job['completed'] = await self.redis_client.hlen(results_key(job_id))
+        job['failed'] = await self.redis_client.hlen(errors_key(job_id))
+        return job
+
+    async def get_results(self, job_id: str, start: int = 0, count: int = 50) -> Dict[int, Optional[str]]:
+        indexes = list(range(start, start + count))
+        values = await self.redis_client.hmget(results_key(job_id), indexes)
+        return {
+            index: value.decode() if isinstance(value, bytes) else value
+            for index, value in zip(indexes, values)
+        }
+
+    @staticmethod
+    def _decode_hash(data: Dict) -> Dict[str, Any]:
+        return {
+            (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+            for k, v in data.items()
+        }
@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import random
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+from redis.exceptions import ResponseError
+
+from .redis_pool import create_redis
+
+logger = logging.getLogger(__name__)
+
+BATCH_STREAM = 'email_batches'
+BATCH_GROUP = 'send_workers'
+DELAYED_KEY = 'email_batches:delayed'   # zset of job JSON scored by due epoch
+DEAD_STREAM = 'email_batches:dead'
+DONE_PREFIX = 'email_batches:done:'     # marker set once a batch has been fully sent
+DEAD_RECIPIENTS_KEY = 'email_dead_letters'  # zset of tracking IDs that failed for good, scored by epoch
+
+MAX_DELIVERIES = int(os.getenv('BATCH_MAX_DELIVERIES', 5))
+
+# Recipients whose send failed transiently are resent in retry batches
+SEND_MAX_ATTEMPTS = int(os.getenv('SEND_MAX_ATTEMPTS', 6))
+RETRY_BASE_SECONDS = float(os.getenv('SEND_RETRY_BASE_SECONDS', 30))
+RETRY_MAX_SECONDS = float(os.getenv('SEND_RETRY_MAX_SECONDS', 3600))
+DEAD_LETTER_RETENTION_SECONDS = int(os.getenv('DEAD_LETTER_RETENTION_SECONDS', 30 * 86400))
+
+
+def retry_delay(attempt: int, retry_after: float = 0.0) -> float:
+    """Exponential backoff with equal jitter for the given retry (1 = first), never before retry_after"""
+    ceiling = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+    return max(ceiling / 2 + random.uniform(0, ceiling / 2), retry_after)
+
+
+# Move due jobs from the delayed zset onto the stream atomically, so several
+# worker processes can promote concurrently without double-enqueueing.
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, job in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('XADD', KEYS[2], '*', 'job', job)
+end
+return #due
+"""
+
+
+class BatchQueue:
+    """Send-batch queue on Redis Streams with at-least-once delivery.
+
+    Future jobs wait in a zset until due and are then appended to the stream.
+    Workers read through a consumer group and acknowledge only after a batch
+    is fully processed; entries left pending by a crashed worker are claimed
+    by others once they have been idle for claim_idle_ms.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None, stream: str = BATCH_STREAM,
+                 group: str = BATCH_GROUP):
+        self.redis_client = redis_client or create_redis()
+        self.stream = stream
+        self.group = group
+        self.promote_script = self.redis_client.register_script(PROMOTE_SCRIPT)
+
+    async def ensure_group(self):
+        try:
+            await self.redis_client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def enqueue_at(self, when: datetime, job: Dict):
+        payload = json.dumps(job, sort_keys=True)
+        if when.timestamp() <= time.time():
+            await self.redis_client.xadd(self.stream, {'job': payload})
+        else:
+            await self.redis_client.zadd(DELAYED_KEY, {payload: when.timestamp()})
+
+    async def enqueue_many(self, jobs: List[Tuple[datetime, Dict]], chunk_size: int = 1000):
+        """Enqueue (when, job) pairs in pipelined round trips"""
+        now = time.time()
+        for start in range(0, len(jobs), chunk_size):
+            pipe = self.redis_client.pipeline(transaction=False)
+            for when, job in jobs[start:start + chunk_size]:
+                payload = json.dumps(job, sort_keys=True)
+                if when.timestamp() <= now:
+                    pipe.xadd(self.stream, {'job': payload})
+                else:
+                    pipe.zadd(DELAYED_KEY, {payload: when.timestamp()})
+            await pipe.execute()
+
+    async def promote_due(self, limit: int = 500) -> int:
+        return int(await self.promote_script(keys=[DELAYED_KEY, self.stream], args=[time.time(), limit]))
+
+    async def read(self, consumer: str, count: int, block_ms: int = 1000) -> List[Tuple[str, Dict]]:
+        response = await self.redis_client.xreadgroup(
+            self.group, consumer, {self.stream: '>'}, count=count, block=block_ms
+        )
+        return [
+            (self._decode(entry_id), json.loads(fields[b'job']))
+            for _, entries in response or []
+            for entry_id, fields in entries
+        ]
+
+    async def claim_stalled(self, consumer: str, min_idle_ms: int, count: int) -> List[Tuple[str, Dict]]:
+        """Take over entries another consumer left unacknowledged; dead-letter poison jobs"""
+        response = await self.redis_client.xautoclaim(
+            self.stream, self.group, consumer, min_idle_time=min_idle_ms, start_id='0-0', count=count
+        )
+        claimed = []
+        for entry_id, fields in response[1]:
+            if not fields:
+                continue
+            entry_id = self._decode(entry_id)
+            pending = await self.redis_client.xpending_range(
+                self.stream, self.group, min=entry_id, max=entry_id, count=1
+            )
+            if pending and pending[0]['times_delivered'] > MAX_DELIVERIES:
+                logger.error(f"Batch {entry_id} failed {MAX_DELIVERIES} deliveries, moving to {DEAD_STREAM}")
+                await self.redis_client.xadd(DEAD_STREAM, fields)
+                await self.ack(entry_id)
+                continue
+            claimed.append((entry_id, json.loads(fields[b'job'])))
+        return claimed
+
+    async def touch(self, consumer: str, entry_ids: List[str]):
+        """Reset the idle time of entries still being processed so they are not reclaimed"""
+        if entry_ids:
+            await self.redis_client.xclaim(
+                self.stream, self.group, consumer, min_idle_time=0, message_ids=entry_ids, justid=True
+            )
+
+    async def ack(self, entry_id: str):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.xack(self.stream, self.group, entry_id)
+        pipe.xdel(self.stream, entry_id)
+        await pipe.execute()
+
+    async def is_done(self, job_id: str) -> bool:
+        return bool(await self.redis_client.exists(DONE_PREFIX + job_id))
+
+    async def mark_done(self, job_id: str, ttl: int = 7 * 86400):
+        await self.redis_client.set(DONE_PREFIX + job_id, 1, ex=ttl)
+
+    async def get_depth(self) -> Dict:
+        """Queue sizes, plus how long the oldest due batch has been waiting to finish"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.xlen(self.stream)
+        pipe.zcard(DELAYED_KEY)
+        pipe.xlen(DEAD_STREAM)
+        pipe.zcard(DEAD_RECIPIENTS_KEY)
+        pipe.xrange(self.stream, count=1)
+        pipe.zrange(DELAYED_KEY, 0, 0, withscores=True)
+        pipe.xpending(self.stream, self.group)
+        # xpending fails until a worker has created the group
+        ready, delayed, dead, dead_recipients, oldest, next_due, pending = await pipe.execute(raise_on_error=False)
+
+        now = time.time()
+        lag_seconds = 0.0
+        if oldest:
+            # Acked entries are deleted, so the oldest entry is the oldest unfinished batch
+            lag_seconds = now - int(self._decode(oldest[0][0]).split('-')[0]) / 1000
+        if next_due:
+            # Due but not yet promoted
+            lag_seconds = max(lag_seconds, now - next_due[0][1])
+        return {
+            'ready': ready,
+            'delayed': delayed,
+            'dead': dead,
+            'dead_recipients': dead_recipients,
+            'pending': pending['pending'] if isinstance(pending, dict) else 0,
+            'lag_seconds': round(max(lag_seconds, 0.0), 3)
+        }
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import os
+import re
+from typing import List, Optional, Tuple
+
+import redis.asyncio as aioredis
+
+from .redis_pool import create_redis
+
+logger = logging.getLogger(__name__)
+
+PERIOD_SECONDS = {
+    'second': 1, 'secondly': 1, 's': 1, 'sec': 1,
+    'minute': 60, 'minutely': 60, 'm': 60, 'min': 60,
+    'hour': 3600, 'hourly': 3600, 'h': 3600,
+}
+
+RATE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*/\s*([a-z]+)\s*$")
+
+# GCRA with reservations over several limiters at once (e.g. campaign + sender).
+# KEYS: one theoretical-arrival-time key per limiter
+# ARGV: permits, then (emission interval in microseconds, burst) per key
+# Returns how many microseconds the caller must wait before sending.
+GCRA_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000000 + tonumber(now_parts[2])
+local permits = tonumber(ARGV[1])
+
+local send_at = now
+local tats = {}
+for i, key in ipairs(KEYS) do
+    local interval = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local tat = tonumber(redis.call('GET', key) or now)
+    if tat < now then tat = now end
+    tats[i] = tat
+    local allowed_at = tat - (burst - 1) * interval
+    if allowed_at > send_at then send_at = allowed_at end
+end
+
+for i, key in ipairs(KEYS) do
+    local interval = tonumber(ARGV[i * 2])
+    local tat = tats[i]
+    if tat < send_at then tat = send_at end
+    local new_tat = tat + permits * interval
+    redis.call('SET', key, string.format('%.0f', new_tat), 'PX', math.ceil((new_tat - now) / 1000) + 1000)
+end
+return send_at - now
+"""
+
+
+def parse_rate(throttle_rate: Optional[str], rate_limit: Optional[float] = None) -> Optional[float]:
+    """Return sends per second for '100/hour' or a period name plus rate_limit, or None for unlimited"""
+    if not throttle_rate:
+        return None
+    match = RATE_PATTERN.match(throttle_rate.lower())
+    if match:
+        count, period = float(match.group(1)), match.group(2)
+    else:
+        if rate_limit is None:
+            return None
+        count, period = float(rate_limit), throttle_rate.strip().lower()
+    if period not in PERIOD_SECONDS:
+        raise ValueError(f"Unknown throttle period: {period}")
+    if count <= 0:
+        raise ValueError("Throttle rate must be positive")
+    return count / PERIOD_SECONDS[period]
+
+
+class RateLimiter:
+    """Distributed GCRA limiter shared by every worker through Redis.
+
+    Each acquire() reserves the next free slot(s) across all given limits and
+    sleeps until then, so sends are spread evenly at the target rate instead
+    of arriving in bursts.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None, burst: Optional[int] = None):
+        self.redis_client = redis_client or create_redis()
+        self.burst = burst or int(os.getenv('THROTTLE_BURST', 1))
+        self.gcra_script = self.redis_client.register_script(GCRA_SCRIPT)
+
+    def limits_for(self, campaign_id: Optional[str] = None, campaign_rate: Optional[float] = None,
+                   sender: Optional[str] = None, sender_rate: Optional[float] = None) -> List[Tuple[str, float]]:
+        limits = []
+        if campaign_id and campaign_rate:
+            limits.append((f"throttle:campaign:{campaign_id}", campaign_rate))
+        if sender and sender_rate:
+            limits.append((f"throttle:sender:{sender}", sender_rate))
+        return limits
+
+    async def reserve(self, limits: List[Tuple[str, float]], permits: int = 1) -> float:
+        """Reserve permits on every limit; returns the seconds to wait before using them"""
+        if not limits:
+            return 0.0
+        args = [permits]
+        for _, rate in limits:
+            args.extend([round(1000000 / rate), self.burst])
+        wait_us = await self.gcra_script(keys=[key for key, _ in limits], args=args)
+        return max(int(wait_us), 0) / 1000000
+
+    async def acquire(self, limits: List[Tuple[str, float]], permits: int = 1):
+        wait = await self.reserve(limits, permits)
+        if wait > 0:
+            await asyncio.sleep(wait)
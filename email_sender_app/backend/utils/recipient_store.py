@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+from typing import AsyncIterable, Dict, List, Optional
+
+import msgpack
+import redis.asyncio as aioredis
+
+from .redis_pool import create_redis
+
+logger = logging.getLogger(__name__)
+
+RECIPIENT_TTL_SECONDS = int(os.getenv('RECIPIENT_TTL_SECONDS', 7 * 86400))
+
+
+def recipients_meta_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}:recipients"
+
+
+def recipients_chunk_key(campaign_id: str, chunk_index: int) -> str:
+    return f"campaign:{campaign_id}:chunk:{chunk_index}"
+
+
+class RecipientStore:
+    """Campaign recipients persisted once, as msgpack-encoded column chunks.
+
+    Each chunk holds chunk_size rows as one list per CSV column, so a send job
+    only needs a campaign ID and a row range to load (and decode) exactly the
+    rows it sends. Chunks are binary, so the client must not decode responses
+    (the shared pool never does).
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None):
+        self.redis_client = redis_client or create_redis()
+
+    async def write_campaign(self, campaign_id: str, fields: List[str], row_chunks: AsyncIterable[List[Dict]],
+                             chunk_size: int) -> Dict:
+        """Write rows (arriving in chunks of exactly chunk_size, except the last) as columnar chunks"""
+        total = 0
+        chunk_index = 0
+        pipe = self.redis_client.pipeline(transaction=False)
+        async for rows in row_chunks:
+            if not rows:
+                continue
+            if len(rows) > chunk_size or total != chunk_index * chunk_size:
+                raise ValueError(f"Row chunks must hold exactly {chunk_size} rows except the last")
+            columns = [[row.get(field) for row in rows] for field in fields]
+            pipe.set(
+                recipients_chunk_key(campaign_id, chunk_index),
+                msgpack.packb(columns, use_bin_type=True),
+                ex=RECIPIENT_TTL_SECONDS
+            )
+            total += len(rows)
+            chunk_index += 1
+            if chunk_index % 50 == 0:
+                await pipe.execute()
+        await pipe.execute()
+
+        meta = {
+            'fields': json.dumps(fields),
+            'chunk_size': chunk_size,
+            'chunk_count': chunk_index,
+            'total': total
+        }
+        pipe = self.redis_client.pipeline()
+        pipe.hset(recipients_meta_key(campaign_id), mapping=meta)
+        pipe.expire(recipients_meta_key(campaign_id), RECIPIENT_TTL_SECONDS)
+        await pipe.execute()
+        return {'total': total, 'chunk_count': chunk_index, 'chunk_size': chunk_size}
+
+    async def get_meta(self, campaign_id: str) -> Optional[Dict]:
+        meta = await self.redis_client.hgetall(recipients_meta_key(campaign_id))
+        if not meta:
+            return None
+        meta = {k.decode(): v for k, v in meta.items()}
+        return {
+            'fields': json.loads(meta['fields']),
+            'chunk_size': int(meta['chunk_size']),
+            'chunk_count': int(meta['chunk_count']),
+            'total': int(meta['total'])
+        }
+
+    async def load_rows(self, campaign_id: str, start: int, end: int) -> List[Dict]:
+        """Load rows [start, end) by fetching only the chunks that cover them"""
+        meta = await self.get_meta(campaign_id)
+        if meta is None:
+            raise KeyError(f"No recipients stored for campaign {campaign_id}")
+
+        chunk_size = meta['chunk_size']
+        end = min(end, meta['total'])
+        if start >= end:
+            return []
+        first, last = start // chunk_size, (end - 1) // chunk_size
+        chunks = await self.redis_client.mget(
+            [recipients_chunk_key(campaign_id, i) for i in range(first, last + 1)]
+        )
+
+        rows = []
+        for chunk_index, packed in zip(range(first, last + 1), chunks):
+            if packed is None:
+                raise KeyError(f"Recipient chunk {chunk_index} of campaign {campaign_id} has expired")
+            columns = msgpack.unpackb(packed, raw=False)
+            offset = chunk_index * chunk_size
+            lo, hi = max(start - offset, 0), min(end - offset, chunk_size)
+            rows.extend(
+                dict(zip(meta['fields'], values))
+                for values in zip(*(column[lo:hi] for column in columns))
+            )
+        return rows
+
+    async def delete_campaign(self, campaign_id: str):
+        meta = await self.get_meta(campaign_id)
+        if meta is None:
+            return
+        keys = [recipients_chunk_key(campaign_id, i) for i in range(meta['chunk_count'])]
+        await self.redis_client.delete(recipients_meta_key(campaign_id), *keys)
@@ -0,0 +1,63 @@
+import logging
+import os
+import time
+
+import redis.asyncio as aioredis
+from redis.asyncio.client import Pipeline
+
+from .metrics import REDIS_COMMAND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def create_pool() -> aioredis.BlockingConnectionPool:
+    """Connection pool configured from the environment.
+
+    Callers wait up to REDIS_POOL_TIMEOUT seconds for a free connection
+    instead of failing once REDIS_MAX_CONNECTIONS are in use. Responses are
+    not decoded, since recipient chunks are binary; components decode the
+    text values they read.
+    """
+    return aioredis.BlockingConnectionPool(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', 6379)),
+        db=int(os.getenv('REDIS_DB', 0)),
+        password=os.getenv('REDIS_PASSWORD', None),
+        max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', 64)),
+        timeout=float(os.getenv('REDIS_POOL_TIMEOUT', 10)),
+        socket_timeout=float(os.getenv('REDIS_SOCKET_TIMEOUT', 5)),
+        socket_connect_timeout=float(os.getenv('REDIS_CONNECT_TIMEOUT', 5)),
+        socket_keepalive=True,
+        health_check_interval=int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30)),
+        retry_on_timeout=True
+    )
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_COMMAND_SECONDS.labels('MULTI' if self.is_transaction else 'PIPELINE').observe(
+                time.perf_counter() - started
+            )
+
+
+class InstrumentedRedis(aioredis.Redis):
+    """Client recording the latency (and so the count) of every command and pipeline"""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_SECONDS.labels(str(args[0]).upper()).observe(time.perf_counter() - started)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def create_redis(pool: aioredis.ConnectionPool = None) -> aioredis.Redis:
+    """Client over the given pool, or over a new pool when none is shared"""
+    return InstrumentedRedis(connection_pool=pool or create_pool())
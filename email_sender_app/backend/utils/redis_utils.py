@@ -1,33 +1,278 @@
-import redis
-import os
-from typing import Dict, Any
+import redis.asyncio as aioredis
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
 import json
 import logging
+from datetime import datetime
+
+from .redis_pool import create_redis
 
 logger = logging.getLogger(__name__)
 
+# Secondary indexes kept next to the email:<tracking_id> hashes so that
+# webhooks and status lookups never have to walk the whole keyspace
+RECIPIENT_INDEX_KEY = 'email_index:recipient'  # recipient address -> tracking_id
+CAMPAIGN_INDEX_KEY = 'email_index:campaign'    # tracking_id -> campaign_id
+
+# Analytics counters, updated in the same script as the status hash itself
+STATUS_COUNTERS_KEY = 'analytics:status'
+DELIVERY_COUNTERS_KEY = 'analytics:delivery'
+SCHEDULED_KEY = 'analytics:scheduled'  # zset tracking_id -> scheduled epoch
+TOTAL_KEY = 'analytics:total'
+
+# KEYS: email hash, status counters, delivery counters, scheduled zset, total,
+#       and optionally the campaign's member set, status counters and delivery counters
+# ARGV: tracking_id, scheduled epoch ('' to leave untouched), '1' to only update an
+#       existing record ('' to create it), field, value, ...
+# Returns 1 when the record was created, 0 when updated, -1 when skipped
+UPDATE_STATUS_SCRIPT = """
+local is_new = redis.call('EXISTS', KEYS[1]) == 0
+if is_new and ARGV[3] == '1' then
+    return -1
+end
+local old_status = redis.call('HGET', KEYS[1], 'status')
+local old_delivery = redis.call('HGET', KEYS[1], 'delivery_status')
+
+for i = 4, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+
+local new_status = redis.call('HGET', KEYS[1], 'status')
+local new_delivery = redis.call('HGET', KEYS[1], 'delivery_status')
+
+local function move(counters, old, new)
+    if old ~= new then
+        if old then redis.call('HINCRBY', counters, old, -1) end
+        if new then redis.call('HINCRBY', counters, new, 1) end
+    end
+end
+
+if is_new then
+    redis.call('INCR', KEYS[5])
+end
+move(KEYS[2], old_status, new_status)
+move(KEYS[3], old_delivery, new_delivery)
+if #KEYS >= 8 then
+    redis.call('SADD', KEYS[6], ARGV[1])
+    move(KEYS[7], old_status, new_status)
+    move(KEYS[8], old_delivery, new_delivery)
+end
+if ARGV[2] ~= '' then
+    redis.call('ZADD', KEYS[4], ARGV[2], ARGV[1])
+end
+return is_new and 1 or 0
+"""
+
+
+def email_key(tracking_id: str) -> str:
+    return f"email:{tracking_id}"
+
+
+def campaign_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}"
+
+
+def campaign_members_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}:members"
+
+
+def campaign_status_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}:status"
+
+
+def campaign_delivery_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}:delivery"
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _scheduled_score(scheduled_time) -> str:
+    if not scheduled_time:
+        return ''
+    if isinstance(scheduled_time, str):
+        scheduled_time = datetime.fromisoformat(scheduled_time)
+    return str(scheduled_time.timestamp())
+
+
 class RedisService:
-    def __init__(self):
-        self.redis_client = redis.Redis(
-            host=os.getenv('REDIS_HOST', 'localhost'),
-            port=int(os.getenv('REDIS_PORT', 6379)),
-            db=int(os.getenv('REDIS_DB', 0))
-        )
-
-    async def store_email_status(self, tracking_id: str, status_data: Dict[str, Any]):
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None):
+        self.redis_client = redis_client or create_redis()
+        self.update_status_script = self.redis_client.register_script(UPDATE_STATUS_SCRIPT)
+
+    async def store_email_status(self, tracking_id: str, status_data: Dict[str, Any],
+                                 campaign_id: Optional[str] = None):
         try:
-            self.redis_client.hset(
-                f"email:{tracking_id}",
-                mapping=status_data
-            )
+            pipe = self.redis_client.pipeline()
+            await self.queue_email_status(pipe, tracking_id, status_data, campaign_id)
+            await pipe.execute()
         except Exception as e:
             logger.error(f"Error storing email status: {str(e)}")
             raise
 
+    async def queue_email_status(self, pipe, tracking_id: str, status_data: Dict[str, Any],
+                                 campaign_id: Optional[str] = None, existing_only: bool = False):
+        """Queue a status write, its counters and its index entries on an existing pipeline.
+
+        With campaign_id the recipient also joins the campaign's member set and
+        counters. existing_only skips recipients whose record is gone, e.g.
+        expired after their campaign was archived.
+        """
+        args = [tracking_id, _scheduled_score(status_data.get('scheduled_time')), '1' if existing_only else '']
+        for field, value in status_data.items():
+            if value is not None:
+                args.extend([field, str(value)])
+        keys = [email_key(tracking_id), STATUS_COUNTERS_KEY, DELIVERY_COUNTERS_KEY, SCHEDULED_KEY, TOTAL_KEY]
+        if campaign_id:
+            keys += [campaign_members_key(campaign_id), campaign_status_key(campaign_id),
+                     campaign_delivery_key(campaign_id)]
+        await self.update_status_script(keys=keys, args=args, client=pipe)
+
+        to_email = status_data.get('to_email')
+        if to_email:
+            pipe.hset(RECIPIENT_INDEX_KEY, to_email, tracking_id)
+        if campaign_id:
+            pipe.hset(CAMPAIGN_INDEX_KEY, tracking_id, campaign_id)
+
     async def get_email_status(self, tracking_id: str) -> Dict[str, Any]:
         try:
-            status = self.redis_client.hgetall(f"email:{tracking_id}")
-            return {k.decode(): v.decode() for k, v in status.items()}
+            status = await self.redis_client.hgetall(email_key(tracking_id))
+            return {_decode(k): _decode(v) for k, v in status.items()}
         except Exception as e:
             logger.error(f"Error getting email status: {str(e)}")
-            raise 
\ No newline at end of file
+            raise
+
+    async def get_tracking_id(self, to_email: str) -> Optional[str]:
+        try:
+            return _decode(await self.redis_client.hget(RECIPIENT_INDEX_KEY, to_email))
+        except Exception as e:
+            logger.error(f"Error resolving recipient {to_email}: {str(e)}")
+            raise
+
+    async def get_campaign_id(self, tracking_id: str) -> Optional[str]:
+        try:
+            return _decode(await self.redis_client.hget(CAMPAIGN_INDEX_KEY, tracking_id))
+        except Exception as e:
+            logger.error(f"Error resolving campaign for {tracking_id}: {str(e)}")
+            raise
+
+    async def get_email_status_by_recipient(self, to_email: str) -> Optional[Dict[str, Any]]:
+        tracking_id = await self.get_tracking_id(to_email)
+        if not tracking_id:
+            return None
+        status = await self.get_email_status(tracking_id)
+        status['tracking_id'] = tracking_id
+        return status
+
+    async def list_recipients(self, cursor: int = 0, count: int = 100) -> Tuple[int, List[Dict[str, str]]]:
+        """One HSCAN page of the recipient index; a returned cursor of 0 means the listing is complete"""
+        try:
+            cursor, page = await self.redis_client.hscan(RECIPIENT_INDEX_KEY, cursor=cursor, count=count)
+            return cursor, [
+                {'email': _decode(email), 'tracking_id': _decode(tracking_id)}
+                for email, tracking_id in page.items()
+            ]
+        except Exception as e:
+            logger.error(f"Error listing recipients: {str(e)}")
+            raise
+
+    async def iter_recipients(self, batch_size: int = 1000) -> AsyncIterator[List[Dict[str, str]]]:
+        """Walk the whole recipient index page by page without blocking Redis"""
+        cursor = 0
+        while True:
+            cursor, page = await self.list_recipients(cursor, batch_size)
+            if page:
+                yield page
+            if cursor == 0:
+                return
+
+    async def rebuild_recipient_index(self, batch_size: int = 1000) -> int:
+        """Rebuild the recipient index from the email:* hashes (repair only)"""
+        indexed = 0
+        pipe = self.redis_client.pipeline()
+        async for key in self.redis_client.scan_iter(match='email:*', count=batch_size):
+            key = _decode(key)
+            tracking_id = key.split(':', 1)[1]
+            to_email = _decode(await self.redis_client.hget(key, 'to_email')) or tracking_id
+            pipe.hset(RECIPIENT_INDEX_KEY, to_email, tracking_id)
+            indexed += 1
+            if indexed % batch_size == 0:
+                await pipe.execute()
+        await pipe.execute()
+        return indexed
+
+    async def get_analytics(self) -> Dict[str, Any]:
+        """Read the incrementally maintained counters; cost does not depend on campaign size"""
+        try:
+            now = datetime.now().timestamp()
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.get(TOTAL_KEY)
+            pipe.hgetall(STATUS_COUNTERS_KEY)
+            pipe.hgetall(DELIVERY_COUNTERS_KEY)
+            pipe.zcount(SCHEDULED_KEY, '-inf', f"({now}")
+            pipe.zcount(SCHEDULED_KEY, now, '+inf')
+            total, statuses, deliveries, past, upcoming = await pipe.execute()
+
+            return {
+                "total_emails": int(total or 0),
+                "status_breakdown": {
+                    _decode(k): int(v) for k, v in statuses.items() if int(v) > 0
+                },
+                "delivery_status": {
+                    _decode(k): int(v) for k, v in deliveries.items() if int(v) > 0
+                },
+                "scheduled_breakdown": {
+                    "past": past,
+                    "upcoming": upcoming
+                }
+            }
+        except Exception as e:
+            logger.error(f"Error getting analytics: {str(e)}")
+            raise
+
+    async def rebuild_analytics(self, batch_size: int = 1000) -> Dict[str, Any]:
+        """Recompute every analytics counter from the email:* hashes (repair only)"""
+        total = 0
+        statuses: Dict[str, int] = {}
+        deliveries: Dict[str, int] = {}
+        scheduled: Dict[str, float] = {}
+
+        keys = []
+        async for key in self.redis_client.scan_iter(match='email:*', count=batch_size):
+            keys.append(_decode(key))
+            if len(keys) >= batch_size:
+                total += await self._tally(keys, statuses, deliveries, scheduled)
+                keys = []
+        total += await self._tally(keys, statuses, deliveries, scheduled)
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(STATUS_COUNTERS_KEY, DELIVERY_COUNTERS_KEY, SCHEDULED_KEY)
+        pipe.set(TOTAL_KEY, total)
+        if statuses:
+            pipe.hset(STATUS_COUNTERS_KEY, mapping=statuses)
+        if deliveries:
+            pipe.hset(DELIVERY_COUNTERS_KEY, mapping=deliveries)
+        if scheduled:
+            pipe.zadd(SCHEDULED_KEY, scheduled)
+        await pipe.execute()
+
+        logger.info(f"Rebuilt analytics counters from {total} email records")
+        return await self.get_analytics()
+
+    async def _tally(self, keys, statuses, deliveries, scheduled) -> int:
+        if not keys:
+            return 0
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, 'status', 'delivery_status', 'scheduled_time')
+        for key, (status, delivery, scheduled_time) in zip(keys, await pipe.execute()):
+            if status:
+                statuses[_decode(status)] = statuses.get(_decode(status), 0) + 1
+            if delivery:
+                deliveries[_decode(delivery)] = deliveries.get(_decode(delivery), 0) + 1
+            if scheduled_time:
+                try:
+                    scheduled[key.split(':', 1)[1]] = float(_scheduled_score(_decode(scheduled_time)))
+                except ValueError:
+                    logger.warning(f"Skipping unparseable scheduled_time on {key}")
+        return len(keys)
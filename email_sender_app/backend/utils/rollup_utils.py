@@ -0,0 +1,107 @@
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+
+from .redis_pool import create_redis
+from .redis_utils import _decode
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+HOUR = 3600
+# Bucket size -> seconds its buckets are kept
+RESOLUTIONS = {
+    MINUTE: int(os.getenv('ROLLUP_MINUTE_RETENTION_SECONDS', 2 * 86400)),
+    HOUR: int(os.getenv('ROLLUP_HOUR_RETENTION_SECONDS', 90 * 86400)),
+}
+# Range queries read at most this many source buckets; coarser steps use hourly buckets
+MAX_SOURCE_BUCKETS = 1440
+MAX_POINTS = 1000
+
+
+def rollup_key(resolution: int, bucket: int, campaign_id: Optional[str] = None) -> str:
+    """One hash of event -> count per bucket, globally or for one campaign"""
+    scope = f"campaign:{campaign_id}:" if campaign_id else ''
+    return f"{scope}rollup:{resolution}:{bucket}"
+
+
+class EventRollups:
+    """Event counts (sent, delivered, opened, ...) in per-minute and per-hour buckets.
+
+    Writers add their counts to the pipeline that records the events, so a
+    batch costs a few HINCRBYs per bucket it touches rather than per event.
+    A range query reads only the buckets in range and sums them into the
+    requested step.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None):
+        self.redis_client = redis_client or create_redis()
+
+    @staticmethod
+    def queue_counts(pipe, events: Iterable[Tuple[str, float]], campaign_id: Optional[str] = None):
+        """Queue increments for (event, epoch) pairs on an existing pipeline"""
+        counts: Dict[Tuple[int, int], Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        for event, at in events:
+            for resolution in RESOLUTIONS:
+                counts[(resolution, int(at // resolution * resolution))][event] += 1
+
+        for (resolution, bucket), bucket_counts in counts.items():
+            for scope in ({None, campaign_id} if campaign_id else {None}):
+                key = rollup_key(resolution, bucket, scope)
+                for event, count in bucket_counts.items():
+                    pipe.hincrby(key, event, count)
+                pipe.expire(key, RESOLUTIONS[resolution])
+
+    @staticmethod
+    def bucket_keys(at: float, campaign_id: Optional[str] = None) -> List[Tuple[str, int]]:
+        """(key, retention seconds) of every bucket an event at epoch `at` counts in"""
+        return [
+            (rollup_key(resolution, int(at // resolution * resolution), scope), retention)
+            for resolution, retention in RESOLUTIONS.items()
+            for scope in ([None, campaign_id] if campaign_id else [None])
+        ]
+
+    async def query(self, start: float, end: float, step: Optional[int] = None,
+                    campaign_id: Optional[str] = None, events: Optional[List[str]] = None) -> Dict:
+        """Counts per step over [start, end), read from the coarsest buckets that fit the step.
+
+        Without a step, one is picked so that at most MAX_POINTS are returned.
+        """
+        try:
+            span = max(end - start, MINUTE)
+            step = max(int(step or 0), MINUTE, int(-(-span // MAX_POINTS)))
+            if step % HOUR == 0 or span / MINUTE > MAX_SOURCE_BUCKETS or start < time.time() - RESOLUTIONS[MINUTE]:
+                resolution = HOUR
+            else:
+                resolution = MINUTE
+            # Output steps are whole source buckets
+            step = -(-step // resolution) * resolution
+
+            first = int(start // step * step)
+            buckets = list(range(int(start // resolution * resolution), int(end), resolution))
+            pipe = self.redis_client.pipeline(transaction=False)
+            for bucket in buckets:
+                pipe.hgetall(rollup_key(resolution, bucket, campaign_id))
+
+            points: Dict[int, Dict[str, int]] = {t: {} for t in range(first, int(end), step)}
+            for bucket, counts in zip(buckets, await pipe.execute()):
+                point = points.setdefault(bucket // step * step, {})
+                for event, count in counts.items():
+                    event = _decode(event)
+                    if events is None or event in events:
+                        point[event] = point.get(event, 0) + int(count)
+
+            return {
+                'start': first,
+                'end': int(end),
+                'step': step,
+                'resolution': resolution,
+                'points': [{'t': t, **counts} for t, counts in sorted(points.items())]
+            }
+        except Exception as e:
+            logger.error(f"Error querying event rollups: {str(e)}")
+            raise
@@ -1,85 +1,379 @@
-import redis
-import pandas as pd
+import asyncio
+import redis.asyncio as aioredis
 from datetime import datetime, timedelta
-from rq import Queue
-from rq_scheduler import Scheduler
 from .esp_utils import ESPService
+from .redis_utils import RedisService, campaign_key
+from .campaign_utils import CampaignStore
+from .rollup_utils import EventRollups
+from .template_utils import compile_template
+from .storage_utils import StorageManager
+from .recipient_store import RecipientStore
+from .rate_limit_utils import RateLimiter, parse_rate
+from .queue_utils import (BatchQueue, DEAD_LETTER_RETENTION_SECONDS, DEAD_RECIPIENTS_KEY, SEND_MAX_ATTEMPTS,
+                          retry_delay)
+from .metrics import SEND_RETRIES
+from .redis_pool import create_redis
+from typing import Dict, List, Optional
 import os
 import logging
 import uuid
 
-from io import StringIO
 logger = logging.getLogger(__name__)
 
+# Stored with each recipient so the send path reuses the ID assigned at scheduling time
+TRACKING_FIELD = '_tracking_id'
+
+# Campaigns whose recipients are being scheduled. The scheduling process holds a
+# lease on each and renews it; a campaign whose lease lapsed was interrupted
+SCHEDULING_KEY = 'campaigns:scheduling'
+SCHEDULING_LEASE_SECONDS = float(os.getenv('SCHEDULING_LEASE_SECONDS', 30))
+
+
+def scheduling_lease_key(campaign_id: str) -> str:
+    return f"campaign:{campaign_id}:scheduling_lease"
+
+
 class EmailScheduler:
-    def __init__(self):
-        self.redis_conn = redis.Redis(
-            host=os.getenv('REDIS_HOST', 'localhost'),
-            port=int(os.getenv('REDIS_PORT', 6379)),
-            db=int(os.getenv('REDIS_DB', 0))
-        )
-        self.queue = Queue(connection=self.redis_conn)
-        self.scheduler = Scheduler(queue=self.queue, connection=self.redis_conn)
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None):
+        self.redis_conn = redis_client or create_redis()
+        self.batch_queue = BatchQueue(self.redis_conn)
         self.esp_service = ESPService()
+        self.redis_service = RedisService(self.redis_conn)
+        self.storage_manager = StorageManager(self.redis_conn)
+        self.recipient_store = RecipientStore(self.redis_conn)
+        self.rate_limiter = RateLimiter(self.redis_conn)
+        self.campaign_store = CampaignStore(self.redis_conn)
 
-    async def process_email_batch(self, batch_data: list, template: str, subject: str):
-        for row in batch_data:
-            tracking_id = str(uuid.uuid4())
-            content = template
-            
-            # Replace placeholders
-            for key, value in row.items():
-                content = content.replace(f"{{{key}}}", str(value))
-                subject = subject.replace(f"{{{key}}}", str(value))
-
-            # Send email
-            result = await self.esp_service.send_email(
-                to_email=row['email'],
-                subject=subject,
-                content=content,
-                tracking_id=tracking_id
-            )
+    async def process_email_batch(self, batch_data: list, template: str, subject: str,
+                                  campaign_id: str = None, bulk: bool = False,
+                                  campaign_rate: float = None, final_attempt: bool = True):
+        """Send a batch and record each recipient's outcome.
+
+        Transient failures are marked 'retrying' for the caller to resend,
+        unless this is the final attempt; other failures are marked 'failed'
+        and added to the dead-letter set.
+        """
+        # Pace sends against the campaign's and the sender account's shared rate limits
+        limits = self.rate_limiter.limits_for(
+            campaign_id=campaign_id,
+            campaign_rate=campaign_rate,
+            sender=os.getenv('SENDER_EMAIL'),
+            sender_rate=parse_rate(os.getenv('SENDER_THROTTLE_RATE'))
+        )
+
+        async def throttle(permits: int):
+            await self.rate_limiter.acquire(limits, permits)
+
+        if bulk:
+            # One request per up to 1000 recipients, personalized by SendGrid substitutions
+            messages = [
+                {'to_email': row['email'], 'tracking_id': row.get(TRACKING_FIELD) or str(uuid.uuid4()), 'row': row}
+                for row in batch_data
+            ]
+            results = await self.esp_service.send_bulk(messages, subject, template, throttle=throttle)
+        else:
+            # Render every body and subject column-wise from the parsed templates
+            import pandas as pd
+            batch_df = pd.DataFrame(batch_data)
+            contents = compile_template(template).render_frame(batch_df)
+            subjects = compile_template(subject).render_frame(batch_df)
+            if TRACKING_FIELD in batch_df:
+                tracking_ids = batch_df[TRACKING_FIELD]
+            else:
+                tracking_ids = [str(uuid.uuid4()) for _ in range(len(batch_df))]
 
-            # Store email status
-            self.redis_conn.hset(
-                f"email:{tracking_id}",
-                mapping={
-                    'to_email': row['email'],
-                    'status': result['status'],
-                    'delivery_status': 'pending',
-                    'sent_time': datetime.now().isoformat()
+            messages = [
+                {
+                    'to_email': to_email,
+                    'subject': row_subject,
+                    'content': content,
+                    'tracking_id': tracking_id
                 }
+                for to_email, row_subject, content, tracking_id in zip(
+                    batch_df['email'], subjects, contents, tracking_ids
+                )
+            ]
+
+            # Send the whole batch concurrently over the pooled connections
+            results = await self.esp_service.send_many(messages, throttle=throttle)
+
+        for result in results:
+            if not result['success']:
+                result['status'] = 'retrying' if result.get('retryable') and not final_attempt else 'failed'
+
+        # Store email statuses, index the recipients and roll up the outcomes in one round trip
+        now = datetime.now()
+        sent_time = now.isoformat()
+        pipe = self.redis_conn.pipeline(transaction=False)
+        EventRollups.queue_counts(pipe, [(result['status'], now.timestamp()) for result in results], campaign_id)
+        dead_letters = {}
+        for message, result in zip(messages, results):
+            status_data = {
+                'to_email': message['to_email'],
+                'status': result['status'],
+                'delivery_status': 'pending',
+                'sent_time': sent_time
+            }
+            if not result['success']:
+                status_data['error'] = result.get('error') or ''
+            if result['status'] == 'failed':
+                dead_letters[message['tracking_id']] = now.timestamp()
+            await self.redis_service.queue_email_status(
+                pipe, message['tracking_id'], status_data, campaign_id=campaign_id
             )
+        if dead_letters:
+            pipe.zadd(DEAD_RECIPIENTS_KEY, dead_letters)
+            pipe.zremrangebyscore(DEAD_RECIPIENTS_KEY, '-inf', now.timestamp() - DEAD_LETTER_RETENTION_SECONDS)
+            SEND_RETRIES.labels('dead_letter').inc(len(dead_letters))
+        await pipe.execute()
+        return results
 
-    async def schedule_batch(self, prompt_template: str, subject: str, schedule_time: str,
-                           batch_size: int, interval_minutes: int) -> str:
+    async def process_campaign_batch(self, campaign_id: str, start: int, end: int,
+                                     positions: Optional[List[int]] = None, attempt: int = 0,
+                                     job_id: Optional[str] = None):
+        """Send rows [start, end) of a campaign, loading only that slice of recipients.
+
+        positions restricts a retry to the listed rows of the range. Rows that
+        failed transiently are enqueued again as a retry job after a jittered
+        exponential backoff (at least the ESP's Retry-After), up to
+        SEND_MAX_ATTEMPTS sends in all.
+        """
+        config = {
+            k.decode(): v.decode()
+            for k, v in (await self.redis_conn.hgetall(campaign_key(campaign_id))).items()
+        }
+        if not config:
+            raise KeyError(f"Campaign {campaign_id} not found")
+        rows = await self.recipient_store.load_rows(campaign_id, start, end)
+        indexes = list(range(start, start + len(rows)))
+        if positions is not None:
+            wanted = set(positions)
+            indexes = [index for index in indexes if index in wanted]
+            rows = [rows[index - start] for index in indexes]
+
+        results = await self.process_email_batch(
+            rows,
+            config['prompt_template'],
+            config['subject'],
+            campaign_id=campaign_id,
+            bulk=config.get('bulk') == '1',
+            campaign_rate=float(config['send_rate']) if config.get('send_rate') else None,
+            final_attempt=attempt + 1 >= SEND_MAX_ATTEMPTS
+        )
+
+        retry = [index for index, result in zip(indexes, results) if result['status'] == 'retrying']
+        if retry:
+            retry_after = max(result.get('retry_after') or 0 for result in results)
+            delay = retry_delay(attempt + 1, retry_after)
+            base_id = (job_id or f"email_batch_{campaign_id}_{start}").split(':retry')[0]
+            await self.batch_queue.enqueue_at(datetime.now() + timedelta(seconds=delay), {
+                'job_id': f"{base_id}:retry{attempt + 1}:{uuid.uuid4().hex[:8]}",
+                'campaign_id': campaign_id,
+                'start': start,
+                'end': end,
+                'positions': retry,
+                'attempt': attempt + 1
+            })
+            SEND_RETRIES.labels('retry').inc(len(retry))
+            logger.info(f"Retrying {len(retry)} recipients of {base_id} in {delay:.1f}s (attempt {attempt + 2})")
+        return results
+
+    async def create_campaign(self, prompt_template: str, subject: str, schedule_time: str,
+                              batch_size: int, interval_minutes: int, bulk: bool = False,
+                              throttle_rate: str = None, rate_limit: int = None) -> Dict:
+        """Validate and record a campaign; schedule_campaign() does the per-recipient work"""
+        # With a send rate, the limiter paces delivery and batches no longer wait out intervals
+        send_rate = parse_rate(throttle_rate, rate_limit)
+        datetime.fromisoformat(schedule_time)
+
+        fields = await self.storage_manager.get_csv_fields()
+        if not fields:
+            raise ValueError("No recipient data uploaded")
+
+        # Report unknown placeholders now rather than at send time
+        compile_template(prompt_template).validate(fields)
+        compile_template(subject).validate(fields)
+
+        campaign_id = str(uuid.uuid4())
+        total_records = await self.storage_manager.get_total_records()
+        batch_count = (total_records + batch_size - 1) // batch_size
+        await self.campaign_store.create(campaign_id, {
+            'prompt_template': prompt_template,
+            'subject': subject,
+            'schedule_time': schedule_time,
+            'batch_size': batch_size,
+            'interval_minutes': interval_minutes,
+            'bulk': int(bulk),
+            'throttle_rate': throttle_rate or '',
+            'rate_limit': rate_limit or '',
+            'send_rate': send_rate or '',
+            'created_at': datetime.now().isoformat(),
+            'scheduling_status': 'pending',
+            'total_records': total_records,
+            'batch_count': batch_count,
+            'recipients_scheduled': 0,
+            'batches_enqueued': 0
+        })
+        return {'campaign_id': campaign_id, 'total_records': total_records, 'batch_count': batch_count}
+
+    async def schedule_campaign(self, campaign_id: str) -> Dict:
+        """Persist recipients, mark them Scheduled and enqueue one job per batch.
+
+        Recipient statuses are written one pipeline per batch and progress is
+        published on the campaign hash after each batch.
+        """
+        key = campaign_key(campaign_id)
+        renewal: Optional[asyncio.Task] = None
         try:
-            csv_data = self.redis_conn.get('current_csv_data')
-            df = pd.read_csv(StringIO(csv_data.decode('utf-8')))
-            
-            total_records = len(df)
-            batch_count = (total_records + batch_size - 1) // batch_size
-            
-            job_ids = []
-            schedule_dt = datetime.fromisoformat(schedule_time)
-            
-            for i in range(batch_count):
-                start_idx = i * batch_size
-                end_idx = min((i + 1) * batch_size, total_records)
-                batch_df = df.iloc[start_idx:end_idx]
-                
-                batch_time = schedule_dt + timedelta(minutes=i * interval_minutes)
-                
-                job = self.scheduler.enqueue_at(
-                    batch_time,
-                    self.process_email_batch,
-                    args=[batch_df.to_dict('records'), prompt_template, subject],
-                    job_id=f"email_batch_{i}"
-                )
-                job_ids.append(job.id)
-            
-            return job_ids[0]  # Return first job ID as reference
-            
+            config = {k.decode(): v.decode() for k, v in (await self.redis_conn.hgetall(key)).items()}
+            if not config:
+                raise KeyError(f"Campaign {campaign_id} not found")
+            batch_size = int(config['batch_size'])
+            interval_minutes = int(config['interval_minutes'])
+            schedule_dt = datetime.fromisoformat(config['schedule_time'])
+            paced = bool(config.get('send_rate'))
+            fields = await self.storage_manager.get_csv_fields()
+            pipe = self.redis_conn.pipeline(transaction=True)
+            pipe.set(scheduling_lease_key(campaign_id), 1, px=int(SCHEDULING_LEASE_SECONDS * 1000))
+            pipe.sadd(SCHEDULING_KEY, campaign_id)
+            pipe.hset(key, 'scheduling_status', 'running')
+            await pipe.execute()
+            renewal = asyncio.create_task(self._renew_scheduling_lease(campaign_id))
+
+            def batch_time(index: int) -> datetime:
+                if paced:
+                    return schedule_dt
+                return schedule_dt + timedelta(minutes=index * interval_minutes)
+
+            async def chunks():
+                index = 0
+                async for rows in self.storage_manager.iter_csv_rows(batch_size):
+                    scheduled_time = batch_time(index).isoformat()
+                    pipe = self.redis_conn.pipeline(transaction=False)
+                    for row in rows:
+                        row[TRACKING_FIELD] = str(uuid.uuid4())
+                        await self.redis_service.queue_email_status(
+                            pipe,
+                            row[TRACKING_FIELD],
+                            {'to_email': row.get('email'), 'status': 'Scheduled', 'scheduled_time': scheduled_time},
+                            campaign_id=campaign_id
+                        )
+                    pipe.hincrby(key, 'recipients_scheduled', len(rows))
+                    await pipe.execute()
+                    index += 1
+                    yield rows
+
+            # Recipients are stored once; jobs only carry row ranges
+            stored = await self.recipient_store.write_campaign(
+                campaign_id, fields + [TRACKING_FIELD], chunks(), batch_size
+            )
+            total_records = stored['total']
+            batch_count = stored['chunk_count']
+            await self.batch_queue.enqueue_many([
+                (batch_time(i), {
+                    'job_id': f"email_batch_{campaign_id}_{i}",
+                    'campaign_id': campaign_id,
+                    'start': i * batch_size,
+                    'end': min((i + 1) * batch_size, total_records)
+                })
+                for i in range(batch_count)
+            ])
+
+            await self.redis_conn.hset(key, mapping={
+                'scheduling_status': 'scheduled',
+                'total_records': total_records,
+                'batch_count': batch_count,
+                'batches_enqueued': batch_count,
+                'scheduled_at': datetime.now().isoformat()
+            })
+            # Batches may all have been sent before the campaign was marked scheduled
+            await self.campaign_store.record_batch_sent(campaign_id)
+            logger.info(f"Campaign {campaign_id} scheduled: {total_records} recipients in {batch_count} batches")
+            return {'campaign_id': campaign_id, 'total_records': total_records, 'batch_count': batch_count}
+
         except Exception as e:
-            logger.error(f"Error in schedule_batch: {str(e)}")
-            raise
\ No newline at end of file
+            logger.error(f"Error scheduling campaign {campaign_id}: {str(e)}")
+            await self.redis_conn.hset(key, mapping={'scheduling_status': 'failed', 'error': str(e)})
+            raise
+        finally:
+            if renewal is not None:
+                renewal.cancel()
+                pipe = self.redis_conn.pipeline(transaction=True)
+                pipe.delete(scheduling_lease_key(campaign_id))
+                pipe.srem(SCHEDULING_KEY, campaign_id)
+                await pipe.execute()
+
+    async def _renew_scheduling_lease(self, campaign_id: str):
+        while True:
+            await asyncio.sleep(SCHEDULING_LEASE_SECONDS / 3)
+            await self.redis_conn.pexpire(scheduling_lease_key(campaign_id), int(SCHEDULING_LEASE_SECONDS * 1000))
+
+    async def fail_interrupted_scheduling(self) -> List[str]:
+        """Mark campaigns whose scheduling process stopped mid-way as failed, so they can be rescheduled.
+
+        Batches are only enqueued once every recipient is scheduled, so unless
+        the process stopped during that final enqueue nothing of an
+        interrupted campaign has been sent.
+        """
+        failed = []
+        for campaign_id in await self.redis_conn.smembers(SCHEDULING_KEY):
+            campaign_id = campaign_id.decode()
+            if await self.redis_conn.exists(scheduling_lease_key(campaign_id)):
+                continue
+            pipe = self.redis_conn.pipeline(transaction=True)
+            pipe.srem(SCHEDULING_KEY, campaign_id)
+            pipe.hget(campaign_key(campaign_id), 'scheduling_status')
+            _, status = await pipe.execute()
+            if status == b'running':
+                await self.redis_conn.hset(campaign_key(campaign_id), mapping={
+                    'scheduling_status': 'failed',
+                    'error': 'Scheduling was interrupted by a restart; schedule the campaign again'
+                })
+                logger.warning(f"Scheduling of campaign {campaign_id} was interrupted; marked failed")
+                failed.append(campaign_id)
+        return failed
+
+    async def watch_scheduling(self):
+        """Fail campaigns left mid-scheduling by stopped processes once their lease lapses"""
+        while True:
+            try:
+                await self.fail_interrupted_scheduling()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error checking interrupted scheduling: {str(e)}")
+            await asyncio.sleep(SCHEDULING_LEASE_SECONDS)
+
+    async def schedule_batch(self, prompt_template: str, subject: str, schedule_time: str,
+                           batch_size: int, interval_minutes: int, bulk: bool = False,
+                           throttle_rate: str = None, rate_limit: int = None) -> str:
+        campaign = await self.create_campaign(
+            prompt_template, subject, schedule_time, batch_size, interval_minutes,
+            bulk=bulk, throttle_rate=throttle_rate, rate_limit=rate_limit
+        )
+        await self.schedule_campaign(campaign['campaign_id'])
+        return campaign['campaign_id']
+
+    async def get_scheduling_progress(self, campaign_id: str) -> Optional[Dict]:
+        values = await self.redis_conn.hmget(
+            campaign_key(campaign_id),
+            ['scheduling_status', 'total_records', 'recipients_scheduled', 'batch_count',
+             'batches_enqueued', 'schedule_time', 'error']
+        )
+        if values[0] is None:
+            return None
+        status, total, scheduled, batch_count, enqueued, schedule_time, error = [
+            v.decode() if v is not None else None for v in values
+        ]
+        progress = {
+            'campaign_id': campaign_id,
+            'status': status,
+            'total_records': int(total or 0),
+            'recipients_scheduled': int(scheduled or 0),
+            'batch_count': int(batch_count or 0),
+            'batches_enqueued': int(enqueued or 0),
+            'schedule_time': schedule_time
+        }
+        if error:
+            progress['error'] = error
+        return progress
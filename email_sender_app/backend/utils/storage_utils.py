@@ -1,72 +1,202 @@
-import redis
-import pandas as pd
+import redis.asyncio as aioredis
+import csv
 import json
-from typing import List, Dict
-import os
+from typing import TYPE_CHECKING, List, Dict, AsyncIterator, Optional
 import logging
 import io
+import codecs
+import uuid
+
+from .redis_pool import create_redis
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+# Uploaded rows are kept as a Redis list of JSON value arrays (one per row);
+# column names live once in csv_fields instead of being repeated per row
+CSV_ROWS_KEY = 'csv_rows'
+CSV_FIELDS_KEY = 'csv_fields'
+CSV_META_KEY = 'csv_meta'
+CSV_TTL_SECONDS = 86400  # 24 hours
+
+INGEST_READ_SIZE = 1024 * 1024  # bytes pulled from the upload per read
+INGEST_ROWS_PER_WRITE = 5000    # rows per pipelined RPUSH
+
+
+def upload_progress_key(upload_id: str) -> str:
+    return f"csv_upload:{upload_id}"
+
+
+def _split_complete_records(buffer: str):
+    """Split text after the last newline that is not inside a quoted field"""
+    index = buffer.rfind('\n')
+    while index != -1:
+        if buffer.count('"', 0, index) % 2 == 0:
+            return buffer[:index + 1], buffer[index + 1:]
+        index = buffer.rfind('\n', 0, index)
+    return '', buffer
+
+
 class StorageManager:
-    def __init__(self):
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None):
+        self.redis_client = redis_client or create_redis()
+
+    async def ingest_csv_stream(self, chunks: AsyncIterator[bytes], upload_id: Optional[str] = None) -> Dict:
+        """Parse a CSV upload incrementally and store its rows in pipelined chunks.
+
+        Only one read buffer and one write batch are held in memory at a time.
+        Rows land in a staging list that replaces csv_rows when the upload
+        completes, so readers never see a half-written dataset. Progress is
+        published on csv_upload:<upload_id> while the upload runs.
+        """
+        upload_id = upload_id or str(uuid.uuid4())
+        staging_key = f"{CSV_ROWS_KEY}:{upload_id}"
+        progress_key = upload_progress_key(upload_id)
+        decoder = codecs.getincrementaldecoder('utf-8-sig')()
+
+        fields: Optional[List[str]] = None
+        buffer = ''
+        pending: List[str] = []
+        total_records = 0
+        bytes_read = 0
+
+        async def flush():
+            pipe = self.redis_client.pipeline(transaction=False)
+            if pending:
+                pipe.rpush(staging_key, *pending)
+                pipe.expire(staging_key, CSV_TTL_SECONDS)
+            pipe.hset(progress_key, mapping={
+                'status': 'running', 'bytes_read': bytes_read, 'rows': total_records
+            })
+            pipe.expire(progress_key, CSV_TTL_SECONDS)
+            await pipe.execute()
+            pending.clear()
+
+        async def parse(text: str):
+            nonlocal fields, total_records
+            for record in csv.reader(io.StringIO(text)):
+                if not record:
+                    continue
+                if fields is None:
+                    fields = [name.strip() for name in record]
+                    continue
+                # Pad short rows and drop extra cells so every row matches the header
+                record = (record + [''] * len(fields))[:len(fields)]
+                pending.append(json.dumps(record))
+                total_records += 1
+                if len(pending) >= INGEST_ROWS_PER_WRITE:
+                    await flush()
+
         try:
-            self.redis_client = redis.Redis(
-                host=os.getenv('REDIS_HOST', 'localhost'),
-                port=int(os.getenv('REDIS_PORT', 6379)),
-                db=int(os.getenv('REDIS_DB', 0)),
-                decode_responses=True
-            )
-            self.redis_client.ping()  # Test connection
-        except redis.ConnectionError as e:
-            raise Exception(f"Failed to connect to Redis: {str(e)}")
-
-    async def store_csv_data(self, csv_data: pd.DataFrame) -> bool:
+            await self.redis_client.delete(staging_key)
+            async for chunk in chunks:
+                bytes_read += len(chunk)
+                buffer += decoder.decode(chunk)
+                complete, buffer = _split_complete_records(buffer)
+                if complete:
+                    await parse(complete)
+            buffer += decoder.decode(b'', final=True)
+            if buffer.strip():
+                await parse(buffer)
+
+            if fields is None:
+                raise ValueError("CSV file is empty")
+            await flush()
+
+            # Swap the finished upload in atomically
+            pipe = self.redis_client.pipeline(transaction=True)
+            if total_records:
+                pipe.rename(staging_key, CSV_ROWS_KEY)
+                pipe.expire(CSV_ROWS_KEY, CSV_TTL_SECONDS)
+            else:
+                pipe.delete(CSV_ROWS_KEY)
+            pipe.set(CSV_FIELDS_KEY, json.dumps(fields), ex=CSV_TTL_SECONDS)
+            pipe.hset(CSV_META_KEY, mapping={'upload_id': upload_id, 'total_records': total_records})
+            pipe.expire(CSV_META_KEY, CSV_TTL_SECONDS)
+            pipe.hset(progress_key, 'status', 'completed')
+            await pipe.execute()
+
+            return {'upload_id': upload_id, 'fields': fields, 'total_records': total_records}
+        except Exception as e:
+            logger.error(f"Error ingesting CSV upload {upload_id}: {str(e)}")
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.delete(staging_key)
+            pipe.hset(progress_key, mapping={'status': 'failed', 'error': str(e)})
+            await pipe.execute()
+            raise
+
+    async def get_upload_progress(self, upload_id: str) -> Optional[Dict]:
+        progress = await self.redis_client.hgetall(upload_progress_key(upload_id))
+        return {self._decode(k): self._decode(v) for k, v in progress.items()} or None
+
+    async def store_csv_data(self, csv_data: 'pd.DataFrame') -> bool:
         try:
             # Validate DataFrame
             if csv_data.empty:
                 raise ValueError("CSV data is empty")
 
-            # Convert to JSON and store
-            json_data = csv_data.to_json(orient='records')
-            pipe = self.redis_client.pipeline()
-            
-            # Store data with expiration (24 hours)
-            pipe.set('current_csv_data', json_data)
-            pipe.expire('current_csv_data', 86400)  # 24 hours
-            
-            # Store fields with expiration
-            pipe.set('csv_fields', json.dumps(list(csv_data.columns)))
-            pipe.expire('csv_fields', 86400)  # 24 hours
-            
-            pipe.execute()
+            buffer = io.StringIO()
+            csv_data.to_csv(buffer, index=False)
+            data = buffer.getvalue().encode('utf-8')
+
+            async def chunks():
+                for start in range(0, len(data), INGEST_READ_SIZE):
+                    yield data[start:start + INGEST_READ_SIZE]
+
+            await self.ingest_csv_stream(chunks())
             return True
-            
+
         except Exception as e:
             logger.error(f"Error storing CSV data: {str(e)}")
             return False
 
     async def get_csv_data(self) -> List[Dict]:
         try:
-            data = self.redis_client.get('current_csv_data')
-            return json.loads(data) if data else []
+            return [row async for rows in self.iter_csv_rows() for row in rows]
         except Exception:
             return []
 
     async def get_csv_fields(self) -> List[str]:
         try:
-            fields = self.redis_client.get('csv_fields')
+            fields = await self.redis_client.get(CSV_FIELDS_KEY)
             return json.loads(fields) if fields else []
         except Exception:
             return []
 
+    async def get_total_records(self) -> int:
+        return await self.redis_client.llen(CSV_ROWS_KEY)
+
     async def get_csv_preview(self, num_rows=5):
         try:
-            data = self.redis_client.get('current_csv_data')
-            if not data:
-                return None
-            df = pd.read_json(io.StringIO(data), orient='records')
-            return df.head(num_rows).to_dict('records')
+            rows = await self.get_csv_rows(0, num_rows)
+            return rows or None
         except Exception as e:
             logger.error(f"Error getting CSV preview: {str(e)}")
-            return None
\ No newline at end of file
+            return None
+
+    async def get_csv_rows(self, start: int, count: int) -> List[Dict]:
+        """Read rows [start, start + count) as dicts keyed by the CSV header"""
+        if count <= 0:
+            return []
+        fields = await self.redis_client.get(CSV_FIELDS_KEY)
+        if not fields:
+            return []
+        fields = json.loads(fields)
+        values = await self.redis_client.lrange(CSV_ROWS_KEY, start, start + count - 1)
+        return [dict(zip(fields, json.loads(value))) for value in values]
+
+    async def iter_csv_rows(self, chunk_size: int = 1000) -> AsyncIterator[List[Dict]]:
+        """Yield the uploaded CSV as lists of row dicts, chunk_size rows at a time"""
+        start = 0
+        while True:
+            rows = await self.get_csv_rows(start, chunk_size)
+            if not rows:
+                return
+            yield rows
+            start += len(rows)
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
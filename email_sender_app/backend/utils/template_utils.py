@@ -0,0 +1,97 @@
+import itertools
+import logging
+import re
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Iterable, List, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# {field}: a field name of word characters, dots, dashes and single inner spaces.
+# Other braces, e.g. CSS rules and inline scripts, are literal text, and so is
+# everything inside <style> and <script> elements
+PLACEHOLDER_PATTERN = re.compile(
+    r"<(style|script)\b.*?</\1\s*>|\{(\w[\w.-]*(?: [\w.-]+)*)\}",
+    re.DOTALL | re.IGNORECASE
+)
+
+
+class TemplateError(ValueError):
+    """Raised when a template references fields the recipient data does not have"""
+
+    def __init__(self, unknown_fields: List[str]):
+        self.unknown_fields = unknown_fields
+        super().__init__(f"Unknown placeholders: {', '.join('{' + f + '}' for f in unknown_fields)}")
+
+
+class CompiledTemplate:
+    """A {field} template parsed once into literal and placeholder segments"""
+
+    def __init__(self, template: str):
+        self.template = template
+        self.segments: List[Tuple[bool, str]] = []  # (is_placeholder, text or field name)
+
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(template):
+            if match.group(2) is None:
+                continue
+            if match.start() > position:
+                self.segments.append((False, template[position:match.start()]))
+            self.segments.append((True, match.group(2)))
+            position = match.end()
+        if position < len(template):
+            self.segments.append((False, template[position:]))
+
+    @property
+    def placeholders(self) -> List[str]:
+        return list(dict.fromkeys(text for is_field, text in self.segments if is_field))
+
+    def unknown_fields(self, fields: Iterable[str]) -> List[str]:
+        fields = set(fields)
+        return [field for field in self.placeholders if field not in fields]
+
+    def validate(self, fields: Iterable[str]):
+        unknown = self.unknown_fields(fields)
+        if unknown:
+            raise TemplateError(unknown)
+
+    def render(self, row: Dict) -> str:
+        parts = []
+        for is_field, text in self.segments:
+            if not is_field:
+                parts.append(text)
+            elif text in row:
+                parts.append('' if row[text] is None else str(row[text]))
+            else:
+                parts.append(f"{{{text}}}")
+        return ''.join(parts)
+
+    def render_frame(self, df: 'pd.DataFrame') -> List[str]:
+        """Render one string per DataFrame row.
+
+        Each referenced column is converted to strings once, column-wise, and
+        the rows are then assembled with a single join per row. Placeholders
+        without a matching column are left untouched, like render().
+        """
+        if not self.placeholders:
+            return [self.template] * len(df)
+
+        columns = {
+            field: df[field].fillna('').astype(str).tolist()
+            for field in self.placeholders if field in df.columns
+        }
+        if not columns:
+            return [self.render({})] * len(df)
+        parts = [
+            columns[text] if is_field and text in columns
+            else itertools.repeat(f"{{{text}}}" if is_field else text)
+            for is_field, text in self.segments
+        ]
+        return list(map(''.join, zip(*parts)))
+
+
+@lru_cache(maxsize=128)
+def compile_template(template: str) -> CompiledTemplate:
+    return CompiledTemplate(template)
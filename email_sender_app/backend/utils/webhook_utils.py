@@ -0,0 +1,274 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+from redis.exceptions import ResponseError
+
+from .redis_pool import create_redis
+from .redis_utils import (RECIPIENT_INDEX_KEY, CAMPAIGN_INDEX_KEY, DELIVERY_COUNTERS_KEY, _decode,
+                          campaign_delivery_key, email_key)
+from .rollup_utils import EventRollups
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_STREAM = 'webhook_events'
+WEBHOOK_GROUP = 'webhook_consumers'
+WEBHOOK_DEAD_STREAM = 'webhook_events:dead'
+WEBHOOK_STATS_KEY = 'webhook:stats'
+SEEN_PREFIX = 'webhook:seen:'  # sg_event_id markers for deduplicating retried deliveries
+
+SEEN_TTL_SECONDS = int(os.getenv('WEBHOOK_DEDUPE_TTL_SECONDS', 3 * 86400))
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 50))          # payloads per read
+WEBHOOK_BLOCK_MS = int(os.getenv('WEBHOOK_BLOCK_MS', 1000))
+WEBHOOK_CLAIM_IDLE_MS = int(os.getenv('WEBHOOK_CLAIM_IDLE_SECONDS', 60)) * 1000
+
+# ESP event names -> delivery_status values shown on the dashboard
+DELIVERY_STATUSES = {
+    'delivered': 'Delivered',
+    'open': 'Opened',
+    'opened': 'Opened',
+    'click': 'Clicked',
+    'bounce': 'Bounced',
+    'bounced': 'Bounced',
+    'dropped': 'Dropped',
+    'deferred': 'Deferred',
+    'spamreport': 'Spam Report',
+    'unsubscribe': 'Unsubscribed',
+}
+
+# Stages of a message's life; an event never moves delivery_status back to an
+# earlier stage, and within a stage the latest event (by ESP timestamp) wins
+DELIVERY_PRECEDENCE = {
+    'Deferred': 1,
+    'Delivered': 2,
+    'Bounced': 2,
+    'Dropped': 2,
+    'Opened': 3,
+    'Clicked': 4,
+    'Spam Report': 5,
+    'Unsubscribed': 5,
+}
+
+# KEYS: email hash, delivery counters, webhook stats, then the campaign's delivery
+#       counters (with a campaign), the sg_event_id marker (with a dedupe TTL) and
+#       the rollup buckets the event counts in
+# ARGV: delivery_status, event epoch, rollup event name, dedupe TTL ('' without an
+#       sg_event_id), '1' with a campaign, then the TTL of each rollup bucket
+# Returns -2 for a duplicate, -1 when the recipient is not on record (e.g. archived),
+# 0 when the recorded status takes precedence and 1 when the status was updated
+APPLY_EVENT_SCRIPT = """
+local rank = {""" + ', '.join(f"['{status}'] = {rank}" for status, rank in DELIVERY_PRECEDENCE.items()) + """}
+local outcomes = {[-2] = 'duplicates', [-1] = 'unknown_recipients', [0] = 'superseded', [1] = 'applied'}
+
+local function apply()
+    local i = 4
+    local campaign_counters
+    if ARGV[5] == '1' then
+        campaign_counters = KEYS[i]
+        i = i + 1
+    end
+    if ARGV[4] ~= '' then
+        if not redis.call('SET', KEYS[i], 1, 'NX', 'EX', ARGV[4]) then
+            return -2
+        end
+        i = i + 1
+    end
+    for j = i, #KEYS do
+        redis.call('HINCRBY', KEYS[j], ARGV[3], 1)
+        redis.call('EXPIRE', KEYS[j], ARGV[6 + j - i])
+    end
+
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return -1
+    end
+    local current = redis.call('HMGET', KEYS[1], 'delivery_status', 'delivery_status_at')
+    local old_rank = rank[current[1]] or 0
+    local new_rank = rank[ARGV[1]] or 0
+    if new_rank < old_rank or (new_rank == old_rank and current[2] and tonumber(ARGV[2]) < tonumber(current[2])) then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'delivery_status', ARGV[1], 'delivery_status_at', ARGV[2])
+    if current[1] ~= ARGV[1] then
+        for _, counters in ipairs({KEYS[2], campaign_counters}) do
+            if current[1] then redis.call('HINCRBY', counters, current[1], -1) end
+            redis.call('HINCRBY', counters, ARGV[1], 1)
+        end
+    end
+    return 1
+end
+
+local outcome = apply()
+redis.call('HINCRBY', KEYS[3], outcomes[outcome], 1)
+return outcome
+"""
+
+
+def _event_time(event: Dict) -> float:
+    """When the ESP says the event happened, falling back to now"""
+    try:
+        return float(event['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+
+class WebhookIngest:
+    """ESP webhook events, acknowledged on arrival and applied in batches.
+
+    The HTTP handler only appends the raw request body to a stream. A
+    consumer group reads payloads in batches, resolves each event to a
+    tracking ID and applies them with one script call each, which drops
+    events whose sg_event_id was already seen and never moves a recipient's
+    delivery_status back (see DELIVERY_PRECEDENCE). The script calls and the
+    stream acks go in a single MULTI, so a crash never applies a batch twice.
+    """
+
+    def __init__(self, redis_client: Optional[aioredis.Redis] = None, consumer: Optional[str] = None):
+        self.redis_client = redis_client or create_redis()
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.apply_script = self.redis_client.register_script(APPLY_EVENT_SCRIPT)
+
+    async def append(self, body: bytes, source: str = 'sendgrid') -> str:
+        """Queue one raw webhook payload; returns the stream entry ID"""
+        return _decode(await self.redis_client.xadd(WEBHOOK_STREAM, {'source': source, 'payload': body}))
+
+    async def ensure_group(self):
+        try:
+            await self.redis_client.xgroup_create(WEBHOOK_STREAM, WEBHOOK_GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def consume(self, on_batch: Optional[Callable[[int], Awaitable[None]]] = None):
+        """Apply queued payloads until cancelled; on_batch runs once per applied batch"""
+        await self.ensure_group()
+        loop_count = 0
+        while True:
+            try:
+                entries = []
+                if loop_count % 100 == 0:
+                    entries = await self.claim_stalled()
+                entries += await self.read(block_ms=None if entries else WEBHOOK_BLOCK_MS)
+                loop_count += 1
+                if not entries:
+                    continue
+                applied = await self.apply(entries)
+                if applied and on_batch:
+                    await on_batch(applied)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error consuming webhook events: {str(e)}")
+                await asyncio.sleep(1)
+
+    async def read(self, block_ms: Optional[int] = None) -> List[Tuple[str, Dict]]:
+        response = await self.redis_client.xreadgroup(
+            WEBHOOK_GROUP, self.consumer, {WEBHOOK_STREAM: '>'}, count=WEBHOOK_BATCH_SIZE, block=block_ms
+        )
+        return [
+            (_decode(entry_id), fields)
+            for _, entries in response or []
+            for entry_id, fields in entries
+        ]
+
+    async def claim_stalled(self) -> List[Tuple[str, Dict]]:
+        """Take over payloads a crashed consumer read but never applied"""
+        response = await self.redis_client.xautoclaim(
+            WEBHOOK_STREAM, WEBHOOK_GROUP, self.consumer,
+            min_idle_time=WEBHOOK_CLAIM_IDLE_MS, start_id='0-0', count=WEBHOOK_BATCH_SIZE
+        )
+        return [(_decode(entry_id), fields) for entry_id, fields in response[1] if fields]
+
+    async def apply(self, entries: List[Tuple[str, Dict]]) -> int:
+        """Apply one batch of payloads; returns the number of status updates written"""
+        events = []
+        dead = []
+        for entry_id, fields in entries:
+            fields = {_decode(k): v for k, v in fields.items()}
+            try:
+                payload = json.loads(fields['payload'])
+            except (KeyError, ValueError) as e:
+                logger.error(f"Unreadable webhook payload {entry_id}: {str(e)}")
+                dead.append(fields)
+                continue
+            for event in payload if isinstance(payload, list) else [payload]:
+                if isinstance(event, dict):
+                    events.append(event)
+
+        # Resolve events that only carry the recipient address
+        unresolved = [e['email'] for e in events if not e.get('tracking_id') and e.get('email')]
+        by_email = {}
+        if unresolved:
+            by_email = dict(zip(unresolved, await self.redis_client.hmget(RECIPIENT_INDEX_KEY, unresolved)))
+
+        updates = []
+        for event in events:
+            status = DELIVERY_STATUSES.get(str(event.get('event', '')).lower())
+            tracking_id = event.get('tracking_id') or _decode(by_email.get(event.get('email')))
+            if status and tracking_id:
+                updates.append((event.get('sg_event_id'), tracking_id, status, _event_time(event)))
+
+        campaigns = {}
+        if updates:
+            tracking_ids = list({update[1] for update in updates})
+            campaign_ids = await self.redis_client.hmget(CAMPAIGN_INDEX_KEY, tracking_ids)
+            campaigns = {t: _decode(c) for t, c in zip(tracking_ids, campaign_ids) if c}
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        for event_id, tracking_id, status, at in updates:
+            await self._queue_event(pipe, event_id, tracking_id, status, at, campaigns.get(tracking_id))
+        for fields in dead:
+            pipe.xadd(WEBHOOK_DEAD_STREAM, fields)
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipe.xack(WEBHOOK_STREAM, WEBHOOK_GROUP, *entry_ids)
+        pipe.xdel(WEBHOOK_STREAM, *entry_ids)
+        pipe.hincrby(WEBHOOK_STATS_KEY, 'payloads', len(entries))
+        pipe.hincrby(WEBHOOK_STATS_KEY, 'events', len(events))
+        pipe.hset(WEBHOOK_STATS_KEY, 'last_applied_at', time.time())
+        results = await pipe.execute()
+        return results[:len(updates)].count(1)
+
+    async def _queue_event(self, pipe, event_id: Optional[str], tracking_id: str, status: str, at: float,
+                           campaign_id: Optional[str]):
+        keys = [email_key(tracking_id), DELIVERY_COUNTERS_KEY, WEBHOOK_STATS_KEY]
+        args = [status, at, status.lower().replace(' ', '_'), SEEN_TTL_SECONDS if event_id else '',
+                '1' if campaign_id else '']
+        if campaign_id:
+            keys.append(campaign_delivery_key(campaign_id))
+        if event_id:
+            keys.append(SEEN_PREFIX + event_id)
+        for key, retention in EventRollups.bucket_keys(at, campaign_id):
+            keys.append(key)
+            args.append(retention)
+        await self.apply_script(keys=keys, args=args, client=pipe)
+
+    async def get_lag(self) -> Dict:
+        """Backlog size and the age of the oldest payload not yet applied"""
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.xlen(WEBHOOK_STREAM)
+        pipe.xrange(WEBHOOK_STREAM, count=1)
+        pipe.xlen(WEBHOOK_DEAD_STREAM)
+        pipe.hgetall(WEBHOOK_STATS_KEY)
+        backlog, oldest, dead, stats = await pipe.execute()
+
+        lag_seconds = 0.0
+        if oldest:
+            oldest_ms = int(_decode(oldest[0][0]).split('-')[0])
+            lag_seconds = max(time.time() - oldest_ms / 1000, 0.0)
+        stats = {_decode(k): float(v) for k, v in stats.items()}
+        return {
+            'backlog_payloads': backlog,
+            'lag_seconds': round(lag_seconds, 3),
+            'dead_payloads': dead,
+            'payloads': int(stats.get('payloads', 0)),
+            'events': int(stats.get('events', 0)),
+            'applied': int(stats.get('applied', 0)),
+            'duplicates': int(stats.get('duplicates', 0)),
+            'superseded': int(stats.get('superseded', 0)),
+            'unknown_recipients': int(stats.get('unknown_recipients', 0)),
+            'last_applied_at': stats.get('last_applied_at')
+        }
@@ -1,28 +1,231 @@
-from fastapi import WebSocket
-from typing import List
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Optional
 import json
 import asyncio
+import os
 import logging
 
+import redis.asyncio as aioredis
+
+if TYPE_CHECKING:
+    from fastapi import WebSocket
+
 logger = logging.getLogger(__name__)
 
+# Broadcasts per second at most; updates arriving in between are coalesced
+WS_MAX_BROADCAST_RATE = float(os.getenv('WS_MAX_BROADCAST_RATE', 2))
+# Messages buffered per connection before the client is resynced
+WS_QUEUE_SIZE = int(os.getenv('WS_QUEUE_SIZE', 16))
+# A send slower than this drops the connection
+WS_SEND_TIMEOUT = float(os.getenv('WS_SEND_TIMEOUT_SECONDS', 5))
+
+# Every API process relays messages on this channel to its own dashboards
+ANALYTICS_CHANNEL = 'analytics:updates'
+
+
+def diff(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """Changed keys of new relative to old, recursing into dicts; removed keys map to None"""
+    changes = {}
+    for key, value in new.items():
+        previous = old.get(key)
+        if isinstance(value, dict) and isinstance(previous, dict):
+            nested = diff(previous, value)
+            if nested:
+                changes[key] = nested
+        elif value != previous or key not in old:
+            changes[key] = value
+    for key in old.keys() - new.keys():
+        changes[key] = None
+    return changes
+
+
+class Connection:
+    """One dashboard: a bounded outbox drained by its own sender task"""
+
+    def __init__(self, websocket: 'WebSocket'):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+        self.sender: Optional[asyncio.Task] = None
+
+    def offer(self, message: str) -> bool:
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def reset(self, message: str):
+        """Discard everything queued and replace it with a single message"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+
 class WebSocketManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    """Analytics fan-out to every open dashboard.
+
+    notify() only marks the analytics as dirty. A single broadcaster task
+    recomputes the snapshot at most WS_MAX_BROADCAST_RATE times per second,
+    diffs it against the previous one and encodes the delta once. Each
+    connection has a bounded queue and its own sender, so a slow client
+    never delays the others: when its queue is full the backlog is replaced
+    by a full snapshot, and a send that times out closes the connection.
+
+    Messages are {"type": "snapshot", "seq", "data"} or
+    {"type": "delta", "seq", "changes"}; a client that sees a gap in seq
+    sends "resync" to get a snapshot.
+
+    Updates are announced on the ANALYTICS_CHANNEL pub/sub channel rather
+    than to this process alone, so any API process (or send worker) can
+    trigger a refresh on every dashboard regardless of which process holds
+    its socket.
+    """
+
+    def __init__(self, max_rate: float = WS_MAX_BROADCAST_RATE):
+        self.active_connections: Dict['WebSocket', Connection] = {}
+        self.min_interval = 1 / max_rate if max_rate > 0 else 0
+        self.snapshot_provider: Optional[Callable[[], Awaitable[Dict]]] = None
+        self.snapshot: Optional[Dict] = None
+        self.seq = 0
+        self.dirty = asyncio.Event()
+        self.broadcaster: Optional[asyncio.Task] = None
+        self.relay: Optional[asyncio.Task] = None
+        self.stats = {'broadcasts': 0, 'resyncs': 0, 'dropped': 0}
 
-    async def connect(self, websocket: WebSocket):
+    def start(self, snapshot_provider: Callable[[], Awaitable[Dict]],
+              pubsub_client: Optional[aioredis.Redis] = None):
+        """Start broadcasting; with pubsub_client, also relay updates published by other processes"""
+        self.snapshot_provider = snapshot_provider
+        self.dirty = asyncio.Event()
+        self.broadcaster = asyncio.create_task(self._broadcast_loop())
+        if pubsub_client is not None:
+            self.relay = asyncio.create_task(self._relay_loop(pubsub_client))
+
+    async def stop(self):
+        for task in (self.broadcaster, self.relay):
+            if task:
+                task.cancel()
+        for connection in list(self.active_connections.values()):
+            await self._close(connection)
+
+    def notify(self):
+        """Request a broadcast; cheap enough to call on every update"""
+        self.dirty.set()
+
+    async def _relay_loop(self, pubsub_client: aioredis.Redis):
+        while True:
+            pubsub = pubsub_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(ANALYTICS_CHANNEL)
+                # Also covers updates missed while (re)subscribing
+                self.notify()
+                while True:
+                    # Poll with a timeout below the socket timeout so idle periods are not errors
+                    if await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0):
+                        self.notify()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Analytics relay lost its subscription: {str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
+
+    async def connect(self, websocket: 'WebSocket'):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        connection = Connection(websocket)
+        self.active_connections[websocket] = connection
+        connection.sender = asyncio.create_task(self._send_loop(connection))
+        await self.resync(websocket)
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def disconnect(self, websocket: 'WebSocket'):
+        connection = self.active_connections.pop(websocket, None)
+        if connection and connection.sender and connection.sender is not asyncio.current_task():
+            connection.sender.cancel()
+
+    async def resync(self, websocket: 'WebSocket'):
+        """Replace whatever the client has queued with a full snapshot"""
+        connection = self.active_connections.get(websocket)
+        if connection is None:
+            return
+        if self.snapshot is None:
+            await self._refresh()
+        connection.reset(self._snapshot_message())
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
+        """Send an arbitrary message to every connection without waiting on any of them"""
+        encoded = json.dumps(message)
+        for connection in list(self.active_connections.values()):
+            if not connection.offer(encoded):
+                self.stats['dropped'] += 1
+                await self._close(connection)
+
+    async def _broadcast_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.dirty.wait()
+            self.dirty.clear()
+            started = loop.time()
             try:
-                await connection.send_json(message)
+                if self.active_connections:
+                    await self._publish()
+                else:
+                    # Nobody listening: keep the baseline fresh for the next connect
+                    self.snapshot = None
             except Exception as e:
-                logger.error(f"Error broadcasting to websocket: {str(e)}")
-                await self.disconnect(connection)
+                logger.error(f"Error broadcasting update: {str(e)}")
+            # Coalesce everything that arrives before the next slot
+            await asyncio.sleep(max(self.min_interval - (loop.time() - started), 0))
+
+    async def _publish(self):
+        previous = self.snapshot
+        current = await self.snapshot_provider()
+        changes = diff(previous, current) if previous is not None else None
+        if changes == {}:
+            return
+        self.snapshot = current
+        self.seq += 1
+        if changes is None:
+            message = self._snapshot_message()
+        else:
+            message = json.dumps({'type': 'delta', 'seq': self.seq, 'changes': changes})
+        self.stats['broadcasts'] += 1
+
+        snapshot_message = None
+        for connection in list(self.active_connections.values()):
+            if not connection.offer(message):
+                # Too far behind for deltas to help: resync from the latest state
+                snapshot_message = snapshot_message or self._snapshot_message()
+                connection.reset(snapshot_message)
+                self.stats['resyncs'] += 1
+
+    async def _refresh(self):
+        self.snapshot = await self.snapshot_provider()
+        self.seq += 1
+
+    def _snapshot_message(self) -> str:
+        return json.dumps({'type': 'snapshot', 'seq': self.seq, 'data': self.snapshot})
+
+    async def _send_loop(self, connection: Connection):
+        try:
+            while True:
+                message = await connection.queue.get()
+                await asyncio.wait_for(connection.websocket.send_text(message), WS_SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Dropping websocket client: {type(e).__name__} {str(e)}")
+            self.stats['dropped'] += 1
+            await self._close(connection)
+
+    async def _close(self, connection: Connection):
+        self.disconnect(connection.websocket)
+        try:
+            await connection.websocket.close()
+        except Exception:
+            pass
+
+    def get_stats(self) -> Dict[str, int]:
+        return {'connections': len(self.active_connections), 'seq': self.seq, **self.stats}
+
 
-ws_manager = WebSocketManager() 
\ No newline at end of file
+ws_manager = WebSocketManager()
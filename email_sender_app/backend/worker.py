@@ -0,0 +1,179 @@
+"""Send worker: one asyncio event loop per process, one process per core.
+
+Each process pulls campaign batches from the email_batches stream through
+the send_workers consumer group, keeps up to --concurrency batches in
+flight, and acknowledges a batch only after it has been sent. Batches left
+pending by a dead worker are reclaimed after --claim-idle seconds.
+
+Usage:
+    python worker.py --processes 4 --concurrency 8
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from dotenv import load_dotenv
+
+from utils.metrics import record_startup
+from websocket_handler import ANALYTICS_CHANNEL
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class SendWorker:
+    def __init__(self, name: str, concurrency: int, claim_idle_ms: int, shutdown_timeout: float):
+        self.created = time.perf_counter()
+        from utils.scheduler_utils import EmailScheduler
+
+        self.name = name
+        self.concurrency = concurrency
+        self.claim_idle_ms = claim_idle_ms
+        self.shutdown_timeout = shutdown_timeout
+        self.scheduler = EmailScheduler()
+        self.queue = self.scheduler.batch_queue
+        self.stopping = asyncio.Event()
+        self.in_flight = {}
+        self.slots = asyncio.Semaphore(concurrency)
+
+    async def run(self):
+        await self.queue.ensure_group()
+        logger.info(f"Worker {self.name} started (concurrency={self.concurrency})")
+        record_startup(f"Worker {self.name}", setup=time.perf_counter() - self.created)
+        loop_count = 0
+        while not self.stopping.is_set():
+            await self.queue.promote_due()
+            # Heartbeat: batches still sending must not look stalled to other workers
+            await self.queue.touch(self.name, list(self.in_flight.values()))
+
+            if loop_count % 600 == 0:
+                await self.archive_campaigns()
+
+            # Reclaim stalled batches every few iterations, when there is capacity
+            jobs = []
+            free = self.concurrency - len(self.in_flight)
+            if loop_count % 10 == 0 and free > 0:
+                jobs = await self.queue.claim_stalled(self.name, self.claim_idle_ms, free)
+            free -= len(jobs)
+            if free > 0:
+                jobs += await self.queue.read(self.name, free, block_ms=1000)
+            loop_count += 1
+
+            for entry_id, job in jobs:
+                await self.slots.acquire()
+                task = asyncio.create_task(self.process(entry_id, job))
+                self.in_flight[task] = entry_id
+                task.add_done_callback(self._finished)
+
+            if not jobs and len(self.in_flight) >= self.concurrency:
+                await asyncio.sleep(0.1)
+
+        await self.drain()
+
+    def _finished(self, task: asyncio.Task):
+        self.in_flight.pop(task, None)
+        self.slots.release()
+
+    async def process(self, entry_id: str, job: dict):
+        job_id = job['job_id']
+        try:
+            # Retry jobs resend part of a batch that already counted as sent
+            is_retry = bool(job.get('attempt'))
+            # A batch can be redelivered if its worker died between sending and acking
+            if await self.queue.is_done(job_id):
+                if not is_retry:
+                    await self.scheduler.campaign_store.record_batch_sent(job['campaign_id'], job_id)
+                await self.queue.ack(entry_id)
+                return
+            await self.scheduler.process_campaign_batch(
+                job['campaign_id'], job['start'], job['end'],
+                positions=job.get('positions'), attempt=job.get('attempt', 0), job_id=job_id
+            )
+            await self.queue.mark_done(job_id)
+            if not is_retry:
+                await self.scheduler.campaign_store.record_batch_sent(job['campaign_id'], job_id)
+            await self.queue.ack(entry_id)
+            await self.queue.redis_client.publish(ANALYTICS_CHANNEL, 'analytics')
+            count = len(job['positions']) if is_retry else job['end'] - job['start']
+            logger.info(f"Batch {job_id} sent ({count} recipients)")
+        except Exception as e:
+            # Left pending: another worker reclaims it after claim_idle_ms
+            logger.error(f"Batch {job_id} failed, will be retried: {str(e)}")
+
+    async def archive_campaigns(self):
+        """Archive completed campaigns past their grace period"""
+        try:
+            await self.scheduler.campaign_store.archive_due()
+        except Exception as e:
+            logger.error(f"Error archiving campaigns: {str(e)}")
+
+    async def drain(self):
+        if self.in_flight:
+            logger.info(f"Worker {self.name} finishing {len(self.in_flight)} in-flight batches")
+            await asyncio.wait(list(self.in_flight), timeout=self.shutdown_timeout)
+        await self.scheduler.esp_service.close()
+        logger.info(f"Worker {self.name} stopped")
+
+
+def run_process(index: int, args):
+    load_dotenv()
+    if args.metrics_port:
+        from prometheus_client import start_http_server
+        start_http_server(args.metrics_port + index)
+
+    async def main():
+        worker = SendWorker(
+            name=f"{socket.gethostname()}-{os.getpid()}-{index}",
+            concurrency=args.concurrency,
+            claim_idle_ms=int(args.claim_idle * 1000),
+            shutdown_timeout=args.shutdown_timeout
+        )
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, worker.stopping.set)
+        await worker.run()
+
+    asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=int(os.getenv('WORKER_PROCESSES', os.cpu_count() or 1)))
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('WORKER_CONCURRENCY', 8)),
+                        help="batches in flight per process")
+    parser.add_argument('--claim-idle', type=float, default=float(os.getenv('WORKER_CLAIM_IDLE_SECONDS', 300)),
+                        help="seconds before a dead worker's unacknowledged batch is reclaimed")
+    parser.add_argument('--shutdown-timeout', type=float, default=60.0)
+    parser.add_argument('--metrics-port', type=int, default=int(os.getenv('WORKER_METRICS_PORT', 0)),
+                        help="serve Prometheus metrics on this port plus the process index (0: off)")
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run_process(0, args)
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_process, args=(i, args), name=f"send-worker-{i}")
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def forward(signum, _frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
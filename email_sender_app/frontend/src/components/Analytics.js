@@ -4,8 +4,24 @@ import { Alert, AlertDescription } from '../components/ui/alert';
 import { Progress } from '../components/ui/progress';
 import { BarChart, LineChart, XAxis, YAxis, CartesianGrid, Tooltip, Legend, Bar, Line } from 'recharts';
 
+// Apply a server delta: nested objects are merged, null removes a key
+const applyDelta = (state, changes) => {
+  const next = { ...state };
+  Object.entries(changes).forEach(([key, value]) => {
+    if (value === null) {
+      delete next[key];
+    } else if (typeof value === 'object' && !Array.isArray(value) && typeof next[key] === 'object' && next[key] !== null) {
+      next[key] = applyDelta(next[key], value);
+    } else {
+      next[key] = value;
+    }
+  });
+  return next;
+};
+
 const Analytics = () => {
   const [analytics, setAnalytics] = useState(null);
+  const [hourlyStats, setHourlyStats] = useState([]);
   const [error, setError] = useState(null);
 
   useEffect(() => {
@@ -20,18 +36,52 @@ const Analytics = () => {
       }
     };
 
+    // Hourly event counts for the last day, read from the server-side rollups
+    const fetchHourlyStats = async () => {
+      try {
+        const response = await fetch('/api/analytics/timeseries?hours=24&step=3600&events=sent,delivered,opened');
+        if (!response.ok) throw new Error('Failed to fetch send history');
+        const data = await response.json();
+        setHourlyStats(data.points.map((point) => ({
+          hour: new Date(point.t * 1000).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' }),
+          sent: point.sent || 0,
+          delivered: point.delivered || 0,
+          opened: point.opened || 0
+        })));
+      } catch (err) {
+        setError(err.message);
+      }
+    };
+
     // Initial fetch
     fetchAnalytics();
+    fetchHourlyStats();
 
     // Set up WebSocket connection
+    // Snapshots replace the state; deltas patch it in sequence
     const ws = new WebSocket('ws://localhost:8000/ws/analytics');
+    let lastSeq = null;
     ws.onmessage = (event) => {
-      const data = JSON.parse(event.data);
-      setAnalytics(data);
+      const message = JSON.parse(event.data);
+      if (message.type === 'snapshot') {
+        lastSeq = message.seq;
+        setAnalytics(message.data);
+      } else if (message.type === 'delta') {
+        if (lastSeq === null || message.seq !== lastSeq + 1) {
+          // Missed an update: ask for a fresh snapshot
+          ws.send('resync');
+          return;
+        }
+        lastSeq = message.seq;
+        setAnalytics((current) => (current ? applyDelta(current, message.changes) : current));
+      }
     };
 
     // Polling fallback
-    const pollInterval = setInterval(fetchAnalytics, 30000);
+    const pollInterval = setInterval(() => {
+      fetchAnalytics();
+      fetchHourlyStats();
+    }, 30000);
 
     return () => {
       ws.close();
@@ -161,11 +211,14 @@ const Analytics = () => {
           <CardTitle>Hourly Send Rate</CardTitle>
         </CardHeader>
         <CardContent>
-          <LineChart width={300} height={200} data={analytics.hourly_stats}>
+          <LineChart width={300} height={200} data={hourlyStats}>
             <XAxis dataKey="hour" />
             <YAxis />
             <Tooltip />
+            <Legend />
             <Line type="monotone" dataKey="sent" stroke="#8884d8" />
+            <Line type="monotone" dataKey="delivered" stroke="#82ca9d" />
+            <Line type="monotone" dataKey="opened" stroke="#ffc658" />
           </LineChart>
         </CardContent>
       </Card>